@@ -0,0 +1,597 @@
+#!/usr/local/bin/python3
+'''
+S3GetBucketStats benchmarks
+Compares the aggregation paths of s3bucketstats.py on generated data, no AWS account required.
+The suite benchmark runs every source of bucket stats end to end against a local stand-in for S3.
+The select benchmark is the exception, it scans real inventory files of --bucket with S3 Select.
+'''
+import bisect
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+import s3bucketstats
+
+storage_classes = ['STANDARD', 'STANDARD_IA', 'ONEZONE_IA', 'REDUCED_REDUNDANCY', 'GLACIER', 'DEEP_ARCHIVE',
+                   'INTELLIGENT_TIERING', 'GLACIER_IR']
+
+
+def generate_listing_pages(objects, classes, page_size=1000, distinct_pages=16, seed=1):
+    # Same shape as the 'Contents' of a list_objects_v2 page. A small set of pages is built once and
+    # replayed so that generating the input neither dominates the timings nor the memory peak.
+    rnd = random.Random(seed)
+    epoch = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    pages = [[{'Key': "prefix/{:012d}".format(p * page_size + i),
+               'Size': rnd.randint(0, 1 << 20),
+               'StorageClass': classes[rnd.randrange(len(classes))],
+               'LastModified': epoch + timedelta(seconds=rnd.randrange(1 << 26)),
+               'ETag': '"0"'}
+              for i in range(page_size)] for p in range(distinct_pages)]
+    for start in range(0, objects, page_size):
+        page = pages[(start // page_size) % distinct_pages]
+        yield page if objects - start >= page_size else page[:objects - start]
+
+
+def pandas_lowmemory(pages):
+    # The per-page DataFrame path used by -lowmemory before the streaming aggregator.
+    datas = pd.concat((pd.DataFrame(d, columns=['StorageClass', 'Size', 'LastModified']).groupby(
+        ['StorageClass']).agg({'StorageClass': 'count', 'Size': 'sum', 'LastModified': 'max'}).rename(
+        columns={'StorageClass': 'Count'}) for d in pages)).groupby(
+        'StorageClass').agg({'Count': 'sum', 'Size': 'sum', 'LastModified': 'max'})
+    return datas.reset_index()
+
+
+def pandas_highmemory(pages):
+    # The single DataFrame path used without -lowmemory before the streaming aggregator.
+    datas = pd.concat(pd.DataFrame(d, columns=['StorageClass', 'Size', 'LastModified']) for d in pages)
+    return datas.groupby(['StorageClass']).agg(
+        {'StorageClass': 'count', 'Size': 'sum', 'LastModified': 'max'}).rename(
+        columns={'StorageClass': 'Count'}).reset_index()
+
+
+def streaming(pages):
+    aggregate = s3bucketstats.StorageClassAggregate()
+    for contents in pages:
+        aggregate.add_objects(contents)
+    return aggregate
+
+
+def measure(name, function, objects, make_args):
+    # Timed without tracing first, tracemalloc slows allocation heavy code down too much to time it.
+    start = time.perf_counter()
+    function(*make_args())
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(*make_args())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{:30}{:>15.3f}{:>20,.0f}{:>20.1f}".format(name, elapsed, objects / elapsed, peak / (1 << 20)))
+
+
+def bench_listing(arguments):
+    classes = storage_classes[:arguments.classes]
+    print("{:30}{:>15}{:>20}{:>20}".format("ListObjects path", "Seconds", "Objects/sec", "Peak MB"))
+    make_args = lambda: (generate_listing_pages(arguments.objects, classes),)
+    for name, function in [("pandas -lowmemory", pandas_lowmemory), ("pandas high memory", pandas_highmemory),
+                           ("streaming aggregate", streaming)]:
+        measure(name, function, arguments.objects, make_args)
+
+
+inventory_schema = ['Bucket', 'Key', 'Size', 'LastModifiedDate', 'StorageClass', 'ETag', 'IsMultipartUploaded',
+                    'ReplicationStatus', 'EncryptionStatus']
+
+
+class LocalInventoryClient(object):
+    # Serves get_object, ranged or not, and head_object from files of a local directory.
+    def __init__(self, directory):
+        self.directory = directory
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': os.path.getsize(os.path.join(self.directory, Key))}
+
+    def get_object(self, Bucket, Key, Range=None):
+        with open(os.path.join(self.directory, Key), 'rb') as datafile:
+            if Range is None:
+                return {'Body': io.BytesIO(datafile.read())}
+            start, end = (int(value) for value in Range[len("bytes="):].split("-"))
+            datafile.seek(start)
+            return {'Body': io.BytesIO(datafile.read(end - start + 1))}
+
+
+def generate_inventory_frame(objects, classes, seed=1):
+    rnd = random.Random(seed)
+    epoch = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    return pd.DataFrame({
+        'Bucket': "bench",
+        'Key': ["prefix/{:012d}".format(i) for i in range(objects)],
+        'Size': [rnd.randint(0, 1 << 20) for i in range(objects)],
+        'LastModifiedDate': [epoch + timedelta(seconds=rnd.randrange(1 << 26)) for i in range(objects)],
+        'StorageClass': [classes[rnd.randrange(len(classes))] for i in range(objects)],
+        'ETag': "0123456789abcdef0123456789abcdef",
+        'IsMultipartUploaded': False,
+        'ReplicationStatus': "",
+        'EncryptionStatus': "SSE-S3"})
+
+
+def write_inventory_files(directory, objects, classes):
+    # The same inventory in every format, column names and types as delivered by S3 Inventory.
+    import pyarrow
+    import pyarrow.orc
+    import pyarrow.parquet
+    frame = generate_inventory_frame(objects, classes)
+    with gzip.open(os.path.join(directory, "inventory.csv.gz"), 'wt') as csvfile:
+        frame.assign(LastModifiedDate=frame['LastModifiedDate'].dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")).to_csv(
+            csvfile, header=False, index=False)
+    table = pyarrow.Table.from_pandas(frame.rename(columns=s3bucketstats.columnar_inventory_name), preserve_index=False)
+    pyarrow.parquet.write_table(table, os.path.join(directory, "inventory.parquet"), row_group_size=1 << 17)
+    pyarrow.orc.write_table(table, os.path.join(directory, "inventory.orc"), compression="zlib")
+
+
+def run_inventory_reader(directory, reader_name, key, chunk_rows, results):
+    # Runs in its own process so that the peak RSS belongs to this reader alone.
+    s3bucketstats.settings = s3bucketstats.Settings()
+    s3bucketstats.settings.set_csv_chunk_rows(chunk_rows)
+    s3bucketstats.inventory_transfer_client = lambda bucket_name: LocalInventoryClient(directory)
+    start = time.perf_counter()
+    aggregate = getattr(s3bucketstats, reader_name)("bench", key, inventory_schema)
+    elapsed = time.perf_counter() - start
+    results.put((elapsed, aggregate.count(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def bench_inventory(arguments):
+    classes = storage_classes[:arguments.classes]
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        # Generated in a child as well, a process keeps its peak RSS across the fork and exec of its children.
+        process = context.Process(target=write_inventory_files, args=(directory, arguments.objects, classes))
+        process.start()
+        process.join()
+        print("{:30}{:>15}{:>15}{:>20}{:>20}".format("Inventory format", "File MB", "Seconds", "Objects/sec",
+                                                     "Peak RSS MB"))
+        for name, reader_name, key in [("CSV (gzip)", "read_inventory_file", "inventory.csv.gz"),
+                                       ("Parquet", "read_parquet_inventory_file", "inventory.parquet"),
+                                       ("ORC", "read_orc_inventory_file", "inventory.orc")]:
+            results = context.Queue()
+            process = context.Process(target=run_inventory_reader,
+                                      args=(directory, reader_name, key, arguments.chunk_rows, results))
+            process.start()
+            elapsed, objects, peak = results.get()
+            process.join()
+            print("{:30}{:>15.1f}{:>15.3f}{:>20,.0f}{:>20.1f}".format(
+                name, os.path.getsize(os.path.join(directory, key)) / (1 << 20), elapsed, objects / elapsed, peak))
+
+
+def bench_select(arguments):
+    # Both S3 Select modes over the same inventory files, the Stats event reports what was scanned and returned.
+    inventory = next(i for i in s3bucketstats.get_inventory_configurations(arguments.bucket)
+                     if i['Format'] == "CSV" and i['IsEnabled'])
+    manifest = s3bucketstats.load_manifest(inventory['Bucket'], s3bucketstats.find_latest_inventory_manifest_key(
+        arguments.bucket, inventory['Bucket'], inventory['Id'], inventory['Prefix']))
+    schema = [item.strip() for item in manifest['fileSchema'].split(",")]
+    files = [f['key'] for f in manifest['files'][:arguments.files]]
+    print("{:30}{:>15}{:>20}{:>20}".format("S3 Select mode", "Seconds", "Objects", "Returned MB"))
+    for name, function in [("rows", s3bucketstats.s3select_inventory_csv),
+                           ("pushdown", s3bucketstats.s3select_pushdown_inventory_csv)]:
+        aggregate = s3bucketstats.StorageClassAggregate()
+        start = time.perf_counter()
+        for key in files:
+            aggregate.merge(function(inventory['Bucket'], key, schema))
+        elapsed = time.perf_counter() - start
+        print("{:30}{:>15.3f}{:>20,}{:>20.3f}".format(name, elapsed, aggregate.count(),
+                                                       aggregate.scan_stats.get('BytesReturned', 0) / (1 << 20)))
+
+
+'''
+The suite benchmark runs the real entry points of s3bucketstats.py against LocalS3, a stand-in for the S3, Pricing and
+SSM clients. Listed objects are synthesized from seeded columns, the inventory files, manifest and object cache are
+generated from the same columns, so every path must report the same objects. Each path runs in its own process.
+'''
+
+suite_bucket = "bench"
+suite_inventory_bucket = "bench-inventory"
+suite_inventory_id = "csv"
+suite_delivery = "2024-01-01T00-00Z/"
+suite_epoch = datetime(2020, 1, 1, tzinfo=timezone.utc)
+suite_regions = ['us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2']
+suite_pricing_lookups = 100000
+# Keys a split of the first shard cuts at: every single letter key is a split bound and must be listed exactly once.
+suite_split_bucket = "bench-split"
+suite_split_keys = ["a{:04d}".format(index) for index in range(3000)] + [chr(letter) for letter in range(98, 123)]
+
+
+def synthetic_columns(objects, classes, seed=1):
+    rnd = np.random.default_rng(seed)
+    return (rnd.integers(0, 1 << 20, objects), rnd.integers(0, classes, objects).astype('u1'),
+            rnd.integers(0, 1 << 26, objects))
+
+
+class SyntheticKeys(object):
+    # Sorted keys of the generated bucket, spread evenly over prefixes so that -sharded has shards to list.
+    def __init__(self, objects, prefixes):
+        self.objects = objects
+        self.prefixes = max(1, prefixes)
+
+    def __len__(self):
+        return self.objects
+
+    def __getitem__(self, index):
+        return "{:04d}/{:012d}".format(index * self.prefixes // self.objects, index)
+
+
+def list_keys(keys, make_object, Prefix="", Delimiter=None, StartAfter="", ContinuationToken=None, MaxKeys=1000):
+    # ListObjectsV2 over any sorted sequence of keys. The continuation token is the last key or common prefix returned.
+    start = bisect.bisect_left(keys, Prefix)
+    if ContinuationToken is not None:
+        if Delimiter and ContinuationToken.endswith(Delimiter):
+            start = max(start, bisect.bisect_left(keys, ContinuationToken[:-1] + chr(ord(Delimiter) + 1)))
+        else:
+            start = max(start, bisect.bisect_right(keys, ContinuationToken))
+    elif StartAfter:
+        start = max(start, bisect.bisect_right(keys, StartAfter))
+    contents = []
+    prefixes = []
+    index = start
+    last = None
+    while index < len(keys) and len(contents) + len(prefixes) < MaxKeys:
+        key = keys[index]
+        if not key.startswith(Prefix):
+            break
+        cut = key.find(Delimiter, len(Prefix)) if Delimiter else -1
+        if cut >= 0:
+            last = key[:cut + 1]
+            prefixes.append({'Prefix': last})
+            index = bisect.bisect_left(keys, key[:cut] + chr(ord(Delimiter) + 1))
+        else:
+            last = key
+            contents.append(make_object(index, key))
+            index += 1
+    page = {'KeyCount': len(contents) + len(prefixes), 'MaxKeys': MaxKeys, 'Prefix': Prefix,
+            'IsTruncated': index < len(keys) and keys[index].startswith(Prefix)}
+    if contents:
+        page['Contents'] = contents
+    if prefixes:
+        page['CommonPrefixes'] = prefixes
+    if page['IsTruncated']:
+        page['NextContinuationToken'] = last
+    return page
+
+
+class LocalPaginator(object):
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        if self.operation == "get_products":
+            yield self.client.get_products(**kwargs)
+            return
+        if PaginationConfig and 'PageSize' in PaginationConfig:
+            kwargs['MaxKeys'] = PaginationConfig['PageSize']
+        while True:
+            page = self.client.list_objects_v2(**kwargs)
+            yield page
+            if not page['IsTruncated']:
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+class LocalS3(object):
+    '''
+    Serves the generated bucket from its synthetic columns and every other bucket from the files of directory/<bucket>.
+    API calls are counted per operation.
+    '''
+
+    def __init__(self, directory, objects, classes, prefixes, seed=1):
+        self.directory = directory
+        self.classes = classes
+        self.keys = SyntheticKeys(objects, prefixes)
+        self.sizes, self.class_codes, self.seconds = synthetic_columns(objects, len(classes), seed)
+        self.calls = Counter()
+        self._lock = Lock()
+        self._files = {}
+
+    def count(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+
+    def make_object(self, index, key):
+        return {'Key': key, 'Size': int(self.sizes[index]), 'StorageClass': self.classes[self.class_codes[index]],
+                'LastModified': suite_epoch + timedelta(seconds=int(self.seconds[index])), 'ETag': '"0"'}
+
+    def file_keys(self, bucket):
+        with self._lock:
+            if bucket not in self._files:
+                root = os.path.join(self.directory, bucket)
+                self._files[bucket] = sorted(os.path.relpath(os.path.join(folder, name), root).replace(os.sep, "/")
+                                             for folder, folders, names in os.walk(root) for name in names)
+            return self._files[bucket]
+
+    def file_path(self, Bucket, Key):
+        path = os.path.join(self.directory, Bucket, Key)
+        if not os.path.isfile(path):
+            raise ClientError({'Error': {'Code': "NoSuchKey", 'Message': Key}}, "GetObject")
+        return path
+
+    def get_paginator(self, operation):
+        return LocalPaginator(self, operation)
+
+    def list_objects_v2(self, Bucket, **kwargs):
+        self.count("ListObjectsV2")
+        if Bucket == suite_bucket:
+            return list_keys(self.keys, self.make_object, **kwargs)
+        if Bucket == suite_split_bucket:
+            return list_keys(suite_split_keys, lambda index, key: self.make_object(index % len(self.sizes), key),
+                             **kwargs)
+        return list_keys(self.file_keys(Bucket), lambda index, key: {'Key': key}, **kwargs)
+
+    def head_object(self, Bucket, Key):
+        self.count("HeadObject")
+        path = self.file_path(Bucket, Key)
+        return {'ContentLength': os.path.getsize(path), 'ETag': '"{}"'.format(os.path.getmtime(path)),
+                'LastModified': datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.count("GetObject")
+        path = self.file_path(Bucket, Key)
+        if Range is None:
+            return {'Body': open(path, 'rb')}
+        start, end = (int(value) for value in Range[len("bytes="):].split("-"))
+        with open(path, 'rb') as datafile:
+            datafile.seek(start)
+            return {'Body': io.BytesIO(datafile.read(end - start + 1))}
+
+    def select_object_content(self, Bucket, Key, Expression, InputSerialization, OutputSerialization, **kwargs):
+        # Only the column projections of s3select_inventory_csv, anything else is refused as S3 would refuse an
+        # unsupported query.
+        self.count("SelectObjectContent")
+        columns = [int(column) - 1 for column in re.findall(r"_(\d+)", Expression)]
+        if not re.match(r"^select [_\d,]+ from s3object$", Expression):
+            raise ClientError({'Error': {'Code': "UnsupportedSqlOperation", 'Message': Expression}},
+                              "SelectObjectContent")
+        return {'Payload': self.select_events(self.file_path(Bucket, Key), columns)}
+
+    def select_events(self, path, columns):
+        stats = {'BytesScanned': os.path.getsize(path), 'BytesProcessed': 0, 'BytesReturned': 0}
+        with gzip.open(path, 'rb') as csvfile:
+            for chunk in pd.read_csv(csvfile, header=None, usecols=columns, dtype=str, keep_default_na=False,
+                                     chunksize=100000):
+                records = chunk[columns].to_csv(header=False, index=False).encode('utf-8')
+                stats['BytesReturned'] += len(records)
+                for start in range(0, len(records), 1 << 16):
+                    yield {'Records': {'Payload': records[start:start + (1 << 16)]}}
+            stats['BytesProcessed'] = csvfile.tell()
+        yield {'Stats': {'Details': stats}}
+        yield {'End': {}}
+
+    def list_bucket_inventory_configurations(self, Bucket, **kwargs):
+        self.count("ListBucketInventoryConfigurations")
+        if Bucket != suite_bucket:
+            return {'IsTruncated': False}
+        return {'IsTruncated': False, 'InventoryConfigurationList': [{
+            'Id': suite_inventory_id, 'IsEnabled': True, 'IncludedObjectVersions': "Current",
+            'Destination': {'S3BucketDestination': {'Bucket': "arn:aws:s3:::" + suite_inventory_bucket,
+                                                    'Format': "CSV"}}}]}
+
+    def get_bucket_accelerate_configuration(self, Bucket):
+        self.count("GetBucketAccelerateConfiguration")
+        return {}
+
+    def get_products(self, **kwargs):
+        self.count("GetProducts")
+        dimensions = {'1': {'beginRange': "0", 'endRange': "51200", 'pricePerUnit': {'USD': "0.023"}},
+                      '2': {'beginRange': "51200", 'endRange': "Inf", 'pricePerUnit': {'USD': "0.022"}}}
+        return {'PriceList': [json.dumps({'terms': {'OnDemand': {'1': {'priceDimensions': dimensions}}}})]}
+
+    def get_parameter(self, Name):
+        self.count("GetParameter")
+        return {'Parameter': {'Value': "Region " + Name.split("/")[-2]}}
+
+
+class LocalClientPool(object):
+    # Takes the place of s3bucketstats.client_pool, every service is served by the same LocalS3.
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, service, region=None, accelerate=False):
+        return self.client
+
+    def set_pool_size(self, pool_size):
+        pass
+
+    def stats(self):
+        return {}
+
+    def limiter_stats(self):
+        return {}
+
+
+def write_suite_files(directory, objects, classes, prefixes, files):
+    # The inventory of the generated bucket, its manifest and its object cache, all from the synthetic columns.
+    local = LocalS3(directory, objects, classes, prefixes)
+    base = s3bucketstats.inventory_base_prefix(suite_bucket, suite_inventory_id)
+    manifest_files = []
+    for number, start in enumerate(range(0, objects, -(-objects // max(1, files)))):
+        end = min(objects, start + -(-objects // max(1, files)))
+        key = "{}data/part-{:05d}.csv.gz".format(base, number)
+        path = os.path.join(directory, suite_inventory_bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        frame = pd.DataFrame({
+            'Bucket': suite_bucket,
+            'Key': [local.keys[index] for index in range(start, end)],
+            'Size': local.sizes[start:end],
+            'LastModifiedDate': (pd.Timestamp(suite_epoch) + pd.to_timedelta(local.seconds[start:end], unit='s')
+                                 ).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            'StorageClass': np.array(classes)[local.class_codes[start:end]],
+            'ETag': "0123456789abcdef0123456789abcdef",
+            'IsMultipartUploaded': False,
+            'ReplicationStatus': "",
+            'EncryptionStatus': "SSE-S3"}, columns=inventory_schema)
+        with gzip.open(path, 'wt') as csvfile:
+            frame.to_csv(csvfile, header=False, index=False)
+        with open(path, 'rb') as datafile:
+            checksum = hashlib.md5(datafile.read()).hexdigest()
+        manifest_files.append({'key': key, 'size': os.path.getsize(path), 'MD5checksum': checksum})
+    manifest_path = os.path.join(directory, suite_inventory_bucket, base + suite_delivery + "manifest.json")
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'w') as manifest:
+        json.dump({'sourceBucket': suite_bucket, 'destinationBucket': "arn:aws:s3:::" + suite_inventory_bucket,
+                   'fileFormat': "CSV", 'fileSchema': ", ".join(inventory_schema), 'files': manifest_files}, manifest)
+    s3bucketstats.settings = s3bucketstats.Settings()
+    s3bucketstats.settings.set_cache_dir(directory)
+    writer = s3bucketstats.ObjectCacheWriter(suite_bucket)
+    for start in range(0, objects, 10000):
+        writer.append([local.make_object(index, local.keys[index])
+                       for index in range(start, min(objects, start + 10000))])
+    writer.close()
+
+
+def suite_listing():
+    s3bucketstats.settings.set_sharded(False)
+    return s3bucketstats.list_bucket_aggregates(suite_bucket).count()
+
+
+def suite_sharded_listing():
+    s3bucketstats.settings.set_sharded(True)
+    return s3bucketstats.list_bucket_aggregates(suite_bucket).count()
+
+
+def suite_split_listing():
+    # Splits after every page, regression check of the keys equal to a split bound.
+    s3bucketstats.settings.set_sharded(True)
+    s3bucketstats.settings.set_shard_split_pages(1)
+    return s3bucketstats.list_bucket_aggregates(suite_split_bucket).count()
+
+
+def suite_inventory():
+    s3bucketstats.settings.set_s3select(False)
+    return s3bucketstats.load_inventory(suite_bucket, s3bucketstats.get_inventory_configurations(suite_bucket)).count()
+
+
+def suite_select():
+    s3bucketstats.settings.set_s3select(True)
+    return s3bucketstats.load_inventory(suite_bucket, s3bucketstats.get_inventory_configurations(suite_bucket)).count()
+
+
+def suite_cache():
+    return s3bucketstats.read_object_cache(suite_bucket).count()
+
+
+def suite_pricing():
+    # Cold lookups go to GetProducts and SSM once per region and class, the rest are served from memory.
+    volume_types = ['STANDARD', 'STANDARD_IA', 'ONEZONE_IA', 'REDUCED_REDUNDANCY', 'GLACIER']
+    pairs = [(region, volume_type) for region in suite_regions for volume_type in volume_types]
+    for lookup in range(suite_pricing_lookups):
+        region, volume_type = pairs[lookup % len(pairs)]
+        s3bucketstats.get_bucket_cost_for_storageclass(region, volume_type, lookup << 20)
+    return suite_pricing_lookups
+
+
+suite_paths = {
+    'listing': ("ListObjects", suite_listing),
+    'sharded': ("ListObjects -sharded", suite_sharded_listing),
+    'split': ("ListObjects -sharded splits", suite_split_listing),
+    'inventory': ("Inventory read_inventory_file", suite_inventory),
+    's3select': ("Inventory -s3select", suite_select),
+    'cache': ("Object cache read", suite_cache),
+    'pricing': ("Pricing lookups", suite_pricing),
+}
+
+
+def run_suite_path(directory, arguments, path, results):
+    s3bucketstats.settings = s3bucketstats.Settings()
+    s3bucketstats.settings.set_verbose(0)
+    s3bucketstats.settings.set_cache_dir(directory)
+    s3bucketstats.settings.set_csv_chunk_rows(arguments.chunk_rows)
+    s3bucketstats.settings.set_file_workers(arguments.file_workers)
+    s3bucketstats.settings.set_list_workers(arguments.list_workers)
+    local = LocalS3(directory, arguments.objects, storage_classes[:arguments.classes], arguments.prefixes)
+    s3bucketstats.client_pool = LocalClientPool(local)
+    for bucket_name in (suite_bucket, suite_inventory_bucket, suite_split_bucket):
+        s3bucketstats.bucket_regions.set(bucket_name, suite_regions[0])
+    start = time.perf_counter()
+    items = suite_paths[path][1]()
+    elapsed = time.perf_counter() - start
+    results.put((elapsed, items, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, dict(local.calls)))
+
+
+def bench_suite(arguments):
+    classes = storage_classes[:arguments.classes]
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        process = context.Process(target=write_suite_files, args=(directory, arguments.objects, classes,
+                                                                   arguments.prefixes, arguments.files))
+        process.start()
+        process.join()
+        print("{:32}{:>12}{:>15}{:>15}{:>12}  {}".format("Path", "Seconds", "Items/sec", "Peak RSS MB", "API calls",
+                                                         "By operation"))
+        for path in arguments.paths or list(suite_paths):
+            results = context.Queue()
+            process = context.Process(target=run_suite_path, args=(directory, arguments, path, results))
+            process.start()
+            elapsed, items, peak, calls = results.get()
+            process.join()
+            print("{:32}{:>12.3f}{:>15,.0f}{:>15.1f}{:>12,}  {}".format(
+                suite_paths[path][0], elapsed, items / elapsed, peak, sum(calls.values()),
+                " ".join("{}={}".format(operation, count) for operation, count in sorted(calls.items()))))
+            # Every object path reads the same generated bucket, a different count is a bug, not noise.
+            expected = len(suite_split_keys) if path == 'split' else arguments.objects
+            if path != 'pricing' and items != expected:
+                print("  {} objects instead of {}".format(items, expected), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("benchmark", choices=["listing", "inventory", "select", "suite"],
+                        help="Which path to benchmark")
+    parser.add_argument("-n", "--objects", dest="objects", type=int, default=200000,
+                        help="Number of generated objects, default=200000")
+    parser.add_argument("-c", "--classes", dest="classes", type=int, default=3,
+                        help="Number of distinct storage classes, default=3")
+    parser.add_argument("--chunk-rows", dest="chunk_rows", type=int, default=100000,
+                        help="inventory: rows per parsed chunk or batch, default=100000")
+    parser.add_argument("-b", "--bucket", dest="bucket",
+                        help="select: bucket whose latest CSV inventory is scanned, needs AWS credentials")
+    parser.add_argument("-f", "--files", dest="files", type=int, default=4,
+                        help="select: number of inventory data files to scan, suite: number generated, default=4")
+    parser.add_argument("-p", "--paths", dest="paths", nargs='+', choices=list(suite_paths),
+                        help="suite: paths to run, default=all")
+    parser.add_argument("--prefixes", dest="prefixes", type=int, default=16,
+                        help="suite: top level prefixes of the generated bucket, default=16")
+    parser.add_argument("--file-workers", dest="file_workers", type=int, default=4,
+                        help="suite: --file-workers of s3bucketstats, default=4")
+    parser.add_argument("--list-workers", dest="list_workers", type=int, default=8,
+                        help="suite: --list-workers of s3bucketstats, default=8")
+    arguments = parser.parse_args()
+    if arguments.classes < 1 or arguments.classes > len(storage_classes):
+        parser.error("--classes must be between 1 and {}".format(len(storage_classes)))
+    if arguments.benchmark == "select" and not arguments.bucket:
+        parser.error("the select benchmark needs --bucket")
+
+    s3bucketstats.settings = s3bucketstats.Settings()
+    if arguments.benchmark == "listing":
+        bench_listing(arguments)
+    elif arguments.benchmark == "inventory":
+        bench_inventory(arguments)
+    elif arguments.benchmark == "select":
+        bench_select(arguments)
+    elif arguments.benchmark == "suite":
+        bench_suite(arguments)
+    sys.exit(0)
@@ -5,32 +5,96 @@ version 1.0.0
 By Andre Couture
 Coveo Challenge
 '''
-import concurrent
+import concurrent.futures
+import codecs
+import cProfile
 import csv
 import gzip
+import heapq
 import itertools
 import json
 import math
+import multiprocessing
 import os
+import pstats
 import re
+import shutil
 import sys
 import time
+import zlib
 from argparse import ArgumentParser
-from datetime import timedelta
-from io import BytesIO, StringIO
-from threading import Thread
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BufferedReader, RawIOBase, SEEK_CUR, SEEK_END, SEEK_SET, StringIO
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread, get_ident, local
+from urllib.parse import unquote, unquote_plus
 
 import boto3
+import numpy as np
 import pandas as pd
 import requests
 from botocore.config import Config
+from botocore.exceptions import ClientError
+
+try:
+    import pyarrow.orc
+    import pyarrow.parquet
+except ImportError:
+    # Only needed for Parquet and ORC inventories.
+    pyarrow = None
 
 groups_dict = {'REDUCED_REDUNDANCY', 'STANDARD', 'STANDARD_IA'}
 sizes_name = ["B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB"]
-csv_columns = ['Bucket', 'Key', 'ETag', 'Size', 'LastModified', 'StorageClass']
+inventory_columns = ['Size', 'LastModifiedDate', 'StorageClass']
+inventory_dtypes = {'Size': 'float64', 'LastModifiedDate': str, 'StorageClass': str}
+select_parse_bytes = 1 << 20
+# BucketSizeBytes StorageType of the stored bytes of every class, the per object overheads are left out as the
+# listing and inventory paths do not count them either.
+cloudwatch_storage_types = {
+    'StandardStorage': 'STANDARD',
+    'IntelligentTieringFAStorage': 'INTELLIGENT_TIERING',
+    'IntelligentTieringIAStorage': 'INTELLIGENT_TIERING',
+    'IntelligentTieringAAStorage': 'INTELLIGENT_TIERING',
+    'IntelligentTieringAIAStorage': 'INTELLIGENT_TIERING',
+    'IntelligentTieringDAAStorage': 'INTELLIGENT_TIERING',
+    'StandardIAStorage': 'STANDARD_IA',
+    'OneZoneIAStorage': 'ONEZONE_IA',
+    'ReducedRedundancyStorage': 'REDUCED_REDUNDANCY',
+    'GlacierInstantRetrievalStorage': 'GLACIER_IR',
+    'GlacierStorage': 'GLACIER',
+    'DeepArchiveStorage': 'DEEP_ARCHIVE',
+    'ExpressOneZone': 'EXPRESS_ONEZONE',
+}
+cloudwatch_metrics_per_call = 500
+# Rough compressed size of one inventory row, to estimate object counts from manifest file sizes.
+inventory_bytes_per_object = {'CSV': 60, 'Parquet': 40, 'ORC': 40}
+object_cache_meta_name = "meta.json"
+object_cache_columns = [('StorageClass', 'u1'), ('Size', '<i8'), ('LastModified', '<i8')]
+object_cache_key_columns = [('KeyEnd', '<i8'), ('Key', 'u1')]
+object_cache_chunk_rows = 1 << 22
+inventory_delivery_folder = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z/$")
+inventory_formats = ("CSV", "Parquet", "ORC")
+columnar_read_buffer = 1 << 20
+known_storage_classes = ['STANDARD', 'REDUCED_REDUNDANCY', 'STANDARD_IA', 'ONEZONE_IA', 'INTELLIGENT_TIERING',
+                         'GLACIER', 'DEEP_ARCHIVE', 'OUTPOSTS', 'GLACIER_IR', 'SNOW', 'EXPRESS_ONEZONE']
+throttling_error_codes = {'SlowDown', 'Throttling', 'ThrottlingException', 'ThrottledException',
+                          'RequestLimitExceeded', 'TooManyRequestsException', 'RequestThrottled',
+                          'RequestThrottledException', 'ProvisionedThroughputExceededException', 'BandwidthLimitExceeded',
+                          'EC2ThrottledException', 'PriorRequestNotComplete'}
+transient_error_codes = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                         'TooManyRequestsException', 'InternalError', 'ServiceUnavailable', 'RequestTimeout'}
+hedge_samples = 1000
+hedge_min_samples = 20
+hedge_min_delay = 0.05
+hedge_burst = 5
+hedge_threads = 256
+pricing_cache_name = "pricing.cache.json"
+region_cache_name = "regions.cache.json"
 
 def put_inventory_configuration(bucket):
-    s3.put_bucket_inventory_configuration(
+    bucket_client(bucket).put_bucket_inventory_configuration(
         Bucket=bucket,
         Id=bucket + "-inventory",
         InventoryConfiguration={
@@ -68,11 +132,6 @@ def put_inventory_configuration(bucket):
     )
 
 
-global grand_total_objects
-global grand_total_size
-global grand_total_cost
-
-
 class Settings(object):
     def __init__(self):
         self._REGEX = ".*"
@@ -81,16 +140,123 @@ class Settings(object):
         self._DISPLAY_SIZE = 0
         self._REGION_FILTER = '.*'
         self._OUTPUT_FILE = ''
+        self._OUTPUT_FORMAT = 'dict'
         self._VERBOSE = 1
         self._CACHE = None
         self._REFRESHCACHE = None
+        self._CACHE_KEYS = False
+        self._PREFIX_DEPTH = 0
+        self._MAX_PREFIXES = 10000
+        self._SHARD_TTL = 168
         self._INVENTORY = None
         self._S3SELECT = None
         self._LOWMEMORY = False
         self._THREADED = 0
         self._MAX_THREADS = 0
+        self._PROCESSES = os.cpu_count() or 1
+        self._MAX_BUCKETS = 64
+        self._SOURCE = 'auto'
+        self._METRICS_FALLBACK = False
+        self._MAX_ATTEMPTS = 10
+        self._MAX_REQUEST_RATE = 0
         self._BUCKETS = None
         self._PUT_INVENTORY = False
+        self._CACHE_DIR = '.'
+        self._PRICING_TTL = 168
+        self._REFRESH_PRICING = False
+        self._REGION_TTL = 720
+        self._REGION_WORKERS = 32
+        self._METADATA = list(metadata_collectors)
+        self._METADATA_THREADS = 12
+        self._SHARDED = False
+        self._LIST_WORKERS = 8
+        self._SHARD_SPLIT_PAGES = 10
+        self._FILE_WORKERS = 4
+        self._CSV_CHUNK_ROWS = 100000
+        self._PUSHDOWN = False
+        self._HEDGE = False
+        self._HEDGE_PERCENTILE = 95
+        self._HEDGE_BUDGET = 5
+        self._RESUME = False
+        self._CHECKPOINT_INTERVAL = 60
+        self._PROFILE = False
+        self._PROFILE_TOP = 10
+        self._CPROFILE = ''
+        self._DAEMON = False
+        self._REFRESH_INTERVAL = 1
+        self._LISTEN = '127.0.0.1:9180'
+
+    def set_daemon(self, value):
+        self._DAEMON = value
+
+    def set_refresh_interval(self, value):
+        self._REFRESH_INTERVAL = value
+
+    def set_listen(self, value):
+        self._LISTEN = value
+
+    def set_profile(self, value):
+        self._PROFILE = value
+
+    def set_profile_top(self, value):
+        self._PROFILE_TOP = value
+
+    def set_cprofile(self, value):
+        self._CPROFILE = value
+
+    def set_resume(self, value):
+        self._RESUME = value
+
+    def set_checkpoint_interval(self, value):
+        self._CHECKPOINT_INTERVAL = value
+
+    def set_hedge(self, value):
+        self._HEDGE = value
+
+    def set_hedge_percentile(self, value):
+        self._HEDGE_PERCENTILE = value
+
+    def set_hedge_budget(self, value):
+        self._HEDGE_BUDGET = value
+
+    def set_pushdown(self, value):
+        self._PUSHDOWN = value
+
+    def set_csv_chunk_rows(self, value):
+        self._CSV_CHUNK_ROWS = value
+
+    def set_file_workers(self, value):
+        self._FILE_WORKERS = value
+
+    def set_sharded(self, value):
+        self._SHARDED = value
+
+    def set_list_workers(self, value):
+        self._LIST_WORKERS = value
+
+    def set_shard_split_pages(self, value):
+        self._SHARD_SPLIT_PAGES = value
+
+    def set_metadata(self, value):
+        self._METADATA = value
+
+    def set_metadata_threads(self, value):
+        self._METADATA_THREADS = value
+
+    def set_region_ttl(self, value):
+        self._REGION_TTL = value
+
+    def set_region_workers(self, value):
+        self._REGION_WORKERS = value
+
+    def set_cache_dir(self, value):
+        self._CACHE_DIR = value
+
+    def set_pricing_ttl(self, value):
+        self._PRICING_TTL = value
+
+    def set_refresh_pricing(self, value):
+        self._REFRESH_PRICING = value
 
     def set_put_inventory(self, value):
         self._PUT_INVENTORY = value
@@ -101,6 +267,24 @@ class Settings(object):
     def set_maxthreads(self, value):
         self._MAX_THREADS = value
 
+    def set_processes(self, value):
+        self._PROCESSES = value
+
+    def set_max_buckets(self, value):
+        self._MAX_BUCKETS = value
+
+    def set_source(self, value):
+        self._SOURCE = value
+
+    def set_metrics_fallback(self, value):
+        self._METRICS_FALLBACK = value
+
+    def set_max_attempts(self, value):
+        self._MAX_ATTEMPTS = value
+
+    def set_max_request_rate(self, value):
+        self._MAX_REQUEST_RATE = value
+
     def set_threaded(self, value):
         self._THREADED = value
 
@@ -122,9 +306,24 @@ class Settings(object):
     def set_cache(self, value):
         self._CACHE = value
 
+    def set_cache_keys(self, value):
+        self._CACHE_KEYS = value
+
+    def set_prefix_depth(self, value):
+        self._PREFIX_DEPTH = value
+
+    def set_max_prefixes(self, value):
+        self._MAX_PREFIXES = value
+
+    def set_shard_ttl(self, value):
+        self._SHARD_TTL = value
+
     def set_output_file(self, output_file):
         self._OUTPUT_FILE = output_file
 
+    def set_output_format(self, value):
+        self._OUTPUT_FORMAT = value
+
     def set_region_filter(self, regex):
         self._REGION_FILTER = regex
 
@@ -141,63 +340,849 @@ class Settings(object):
         self._KEY_PREFIX = regex
 
 
+class RunTotals(object):
+    '''
+    Objects, bytes and cost of every bucket analysed in the run, added to from any bucket thread.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self.objects = 0
+        self.size = 0
+        self.cost = 0.0
+        self.failures = {}
+
+    def add(self, objects, size, cost):
+        with self._lock:
+            self.objects += objects
+            self.size += size
+            self.cost += cost
+
+    def pop_failure(self, bucket_name):
+        with self._lock:
+            return self.failures.pop(bucket_name, None)
+
+    def add_failure(self, bucket_name, error):
+        with self._lock:
+            self.failures[bucket_name] = str(error)
+        print("Bucket {} could not be analysed: {}".format(bucket_name, error), file=sys.stderr)
+        if output_sink is not None:
+            output_sink.write({'Name': bucket_name, 'Error': str(error)})
+
+
+class WorkQueue(object):
+    '''
+    Sub-tasks, inventory files or listing shards, of the buckets too large to be left to a single worker.
+    Bucket workers with no bucket left take tasks from here, so the end of a run is not spent on one bucket alone.
+    '''
+
+    def __init__(self):
+        self._tasks = deque()
+        self._lock = Lock()
+        self._available = Condition(self._lock)
+        self.stolen = 0
+
+    def submit(self, function, *args):
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._tasks.append((future, function, args))
+            self._available.notify()
+        return future
+
+    def run_one(self, timeout=0.0):
+        with self._lock:
+            if not self._tasks and timeout > 0:
+                self._available.wait(timeout)
+            if not self._tasks:
+                return False
+            future, function, args = self._tasks.popleft()
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        return True
+
+    def help_until(self, futures, stealing=False):
+        # Runs queued tasks, of any bucket, until every one of futures is done.
+        while not all(future.done() for future in futures):
+            if self.run_one(0.05) and stealing:
+                with self._lock:
+                    self.stolen += 1
+
+
+class SingleFlightCache(object):
+    '''
+    Thread-safe memo of key -> value.
+    Concurrent misses on the same key wait for a single loader call instead of each issuing their own request.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}
+        self._loading = {}
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def get(self, key, loader):
+        while True:
+            with self._lock:
+                if key in self._values:
+                    return self._values[key]
+                event = self._loading.get(key)
+                owner = event is None
+                if owner:
+                    event = self._loading[key] = Event()
+            if owner:
+                break
+            # Another thread is loading this key, wait for it and retry in case its loader failed.
+            event.wait()
+        try:
+            value = loader()
+            with self._lock:
+                self._values[key] = value
+            return value
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+
+class ClientPool(object):
+    '''
+    One boto3 client per (service, region, accelerate), shared by every thread.
+    Connection pools are sized for the configured concurrency and request slots are metered
+    so time spent waiting on a saturated pool shows up in the statistics.
+    '''
+
+    def __init__(self, pool_size=10):
+        self._lock = Lock()
+        self._clients = {}
+        self._meters = {}
+        self._limiters = {}
+        self._pool_size = pool_size
+
+    def set_pool_size(self, pool_size):
+        # Only applies to clients created from now on.
+        with self._lock:
+            self._pool_size = pool_size
+
+    def get(self, service, region=None, accelerate=False):
+        key = (service, region, accelerate)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = self._create_client(key)
+        return client
+
+    def _create_client(self, key):
+        service, region, accelerate = key
+        # Standard retry mode backs off with full jitter, throttling errors included.
+        config = Config(max_pool_connections=self._pool_size,
+                        retries={'mode': 'standard', 'total_max_attempts': max(1, settings._MAX_ATTEMPTS)},
+                        s3={'use_accelerate_endpoint': True} if accelerate else None)
+        # boto3 sessions are not thread-safe, one per client keeps creation independent of the default session.
+        client = boto3.session.Session().client(service, region_name=region, config=config)
+        meter = self._meters[key] = PoolMeter(self._pool_size)
+        # Accelerated and regular endpoints of a bucket share the same request rate limits.
+        limiter = self._limiters.get((service, region))
+        if limiter is None:
+            limiter = self._limiters[(service, region)] = AdaptiveLimiter(self._pool_size,
+                                                                         settings._MAX_REQUEST_RATE or None)
+        client.meta.events.register('before-parameter-build', request_counters.tag_request)
+        client.meta.events.register('before-parameter-build', profiler.tag_request)
+        client.meta.events.register('before-send', limiter.acquire)
+        client.meta.events.register('before-send', meter.acquire)
+        client.meta.events.register('response-received', meter.release)
+        client.meta.events.register('response-received', limiter.release)
+        client.meta.events.register('response-received', request_counters.count_response)
+        client.meta.events.register('response-received', profiler.count_response)
+        client.meta.events.register('after-call', profiler.end_call)
+        client.meta.events.register('after-call-error', profiler.end_call)
+        return client
+
+    def stats(self):
+        with self._lock:
+            meters = list(self._meters.items())
+        return {"{}:{}{}".format(service, region or 'default', ':accelerate' if accelerate else ''): meter.stats()
+                for (service, region, accelerate), meter in meters}
+
+    def limiter_stats(self):
+        with self._lock:
+            limiters = list(self._limiters.items())
+        return {"{}:{}".format(service, region or 'default'): limiter.stats() for (service, region), limiter in limiters}
+
+
+def is_throttling_response(parsed_response):
+    error = (parsed_response or {}).get('Error', {})
+    status = (parsed_response or {}).get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return error.get('Code') in throttling_error_codes or status == 429
+
+
+def is_throttling_error(exception):
+    return isinstance(exception, ClientError) and is_throttling_response(exception.response)
+
+
+class AdaptiveLimiter(object):
+    '''
+    Request concurrency and rate of one service in one region, shared by all of its clients.
+    Both adapt AIMD style: a throttled response halves the concurrency limit and cuts the token bucket rate to 70% of
+    the rate observed, at most once a second, while every successful response adds a little of both back.
+    '''
+
+    def __init__(self, max_concurrency, rate=None):
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._held = local()
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.rate = rate
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.throttles = 0
+        self.decreases = 0
+        self.waits = 0
+        self._refilled = time.monotonic()
+        self._decreased = 0.0
+        self._window_start = self._refilled
+        self._window_sent = 0
+        self._observed_rate = None
+
+    def acquire(self, **kwargs):
+        with self._changed:
+            while self.in_flight >= int(self.limit):
+                self.waits += 1
+                self._changed.wait()
+            self.in_flight += 1
+            now = time.monotonic()
+            self._window_sent += 1
+            if now - self._window_start >= 1.0:
+                self._observed_rate = self._window_sent / (now - self._window_start)
+                self._window_start, self._window_sent = now, 0
+            delay = 0.0
+            if self.rate is not None:
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = -self.tokens / self.rate
+        self._held.count = getattr(self._held, 'count', 0) + 1
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self, parsed_response=None, **kwargs):
+        if getattr(self._held, 'count', 0) == 0:
+            return
+        self._held.count -= 1
+        throttled = is_throttling_response(parsed_response)
+        with self._changed:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttles += 1
+                if now - self._decreased >= 1.0:
+                    self._decreased = now
+                    self.decreases += 1
+                    self.limit = max(1.0, self.limit / 2)
+                    observed = self._observed_rate or max(1.0, self._window_sent / max(0.1, now - self._window_start))
+                    self.rate = max(1.0, 0.7 * min(observed, self.rate or observed))
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+                if self.rate is not None:
+                    self.rate += max(1.0, 0.05 * self.rate) / self.rate
+            self._changed.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return {'Throttles': self.throttles, 'Decreases': self.decreases, 'Waits': self.waits,
+                    'ConcurrencyLimit': int(self.limit), 'Rate': None if self.rate is None else round(self.rate, 1)}
+
+
+class RequestCounters(object):
+    '''
+    Requests, retries and throttled responses per bucket named in the request.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self.buckets = {}
+
+    def tag_request(self, params=None, context=None, **kwargs):
+        if context is not None and params:
+            context['stats_bucket'] = params.get('Bucket')
+
+    def count_response(self, parsed_response=None, context=None, **kwargs):
+        bucket_name = (context or {}).get('stats_bucket')
+        if bucket_name is None:
+            return
+        retry = context.get('retries', {}).get('attempt', 1) > 1
+        throttled = is_throttling_response(parsed_response)
+        with self._lock:
+            counters = self.buckets.setdefault(bucket_name, {'Requests': 0, 'Retries': 0, 'Throttles': 0})
+            counters['Requests'] += 1
+            counters['Retries'] += retry
+            counters['Throttles'] += throttled
+
+    def get(self, bucket_name):
+        with self._lock:
+            return dict(self.buckets.get(bucket_name, {'Requests': 0, 'Retries': 0, 'Throttles': 0}))
+
+
+class PoolMeter(object):
+    '''
+    Counts requests per client and how long they waited for one of the pool's connections.
+    '''
+
+    def __init__(self, pool_size):
+        self._slots = BoundedSemaphore(pool_size)
+        self._lock = Lock()
+        self._held = local()
+        self.pool_size = pool_size
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def acquire(self, **kwargs):
+        waited = 0.0
+        if not self._slots.acquire(blocking=False):
+            start = time.perf_counter()
+            self._slots.acquire()
+            waited = time.perf_counter() - start
+        self._held.count = getattr(self._held, 'count', 0) + 1
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if waited > 0:
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def release(self, **kwargs):
+        if getattr(self._held, 'count', 0) == 0:
+            return
+        self._held.count -= 1
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'PoolSize': self.pool_size, 'Requests': self.requests, 'Waits': self.waits,
+                    'WaitTime': round(self.wait_time, 3), 'MaxWait': round(self.max_wait, 3),
+                    'PeakInFlight': self.peak_in_flight}
+
+
+class RequestHedger(object):
+    '''
+    -hedge: a listing page or inventory GET still unanswered after the --hedge-percentile latency of its operation is
+    sent a second time and the first response wins. Latencies are learned from the run's own requests and the
+    duplicates are capped at --hedge-budget percent of the requests, plus a small burst.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._executor = None
+        self._latencies = {}
+        self._thresholds = {}
+        self._counters = {}
+        self._recorded = 0
+
+    def call(self, operation, function, discard=None, **kwargs):
+        # discard receives the response of the losing request, a streaming body must be closed to free its connection.
+        if not settings._HEDGE:
+            return function(**kwargs)
+        executor = self.get_executor()
+        delay = self.delay(operation)
+        self.count(operation, 'Requests')
+        # Every request gets its own copy of the parameters, the caller may reuse its dict for its next request while a
+        # losing duplicate is still queued or running.
+        futures = [executor.submit(profiler.bind(self.timed_call), operation, function, dict(kwargs))]
+        if delay is not None:
+            done, pending = concurrent.futures.wait(futures, timeout=delay)
+            if pending:
+                if self.take_budget(operation):
+                    futures.append(executor.submit(profiler.bind(self.timed_call), operation, function,
+                                                   dict(kwargs)))
+                else:
+                    self.count(operation, 'OverBudget')
+        winner = None
+        pending = set(futures)
+        while pending and winner is None:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            winner = next((future for future in futures if future in done and future.exception() is None), None)
+        if winner is None:
+            # Every request failed, the error of the original one is the one reported.
+            raise futures[0].exception()
+        if winner is not futures[0]:
+            self.count(operation, 'HedgeWins')
+        if discard is not None:
+            for future in futures:
+                if future is not winner:
+                    future.add_done_callback(
+                        lambda future: future.exception() is None and discard(future.result()))
+        return winner.result()
+
+    def timed_call(self, operation, function, kwargs):
+        start = time.monotonic()
+        result = function(**kwargs)
+        self.record(operation, time.monotonic() - start)
+        return result
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=hedge_threads)
+            return self._executor
+
+    def record(self, operation, latency):
+        with self._lock:
+            self._recorded += 1
+            latencies = self._latencies.setdefault(operation, deque(maxlen=hedge_samples))
+            latencies.append(latency)
+            # The percentile is recomputed every few samples, sorting on every request would cost more than it saves.
+            if len(latencies) >= hedge_min_samples and (operation not in self._thresholds or
+                                                        self._recorded % 32 == 0):
+                ordered = sorted(latencies)
+                index = int(round(min(100.0, max(0.0, settings._HEDGE_PERCENTILE)) / 100 * (len(ordered) - 1)))
+                self._thresholds[operation] = max(hedge_min_delay, ordered[index])
+
+    def delay(self, operation):
+        with self._lock:
+            return self._thresholds.get(operation)
+
+    def take_budget(self, operation):
+        with self._lock:
+            counters = self._counters[operation]
+            if counters['Hedged'] >= counters['Requests'] * settings._HEDGE_BUDGET / 100.0 + hedge_burst:
+                return False
+            counters['Hedged'] += 1
+            return True
+
+    def count(self, operation, name):
+        with self._lock:
+            counters = self._counters.setdefault(operation, {'Requests': 0, 'Hedged': 0, 'HedgeWins': 0,
+                                                             'OverBudget': 0})
+            counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return {operation: dict(counters, Threshold=None if self._thresholds.get(operation) is None else round(
+                self._thresholds[operation], 3)) for operation, counters in self._counters.items()}
+
+
+class Profiler(object):
+    '''
+    -profile: wall time of every phase of a bucket and the time, HTTP requests, bytes received and retries of the API
+    calls made for it, per phase and per operation. The bucket and phase are thread-local, tasks handed to worker
+    threads carry them along through bind. Phases run by several workers at once, InventoryRead and S3Select, report
+    the summed time of their workers. --cprofile also captures every bound task and bucket thread with cProfile.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._current = local()
+        self.buckets = {}
+        self.cprofiles = []
+
+    def current(self):
+        return getattr(self._current, 'context', (None, None))
+
+    @contextmanager
+    def phase(self, bucket_name, phase):
+        if not settings._PROFILE:
+            yield
+            return
+        previous = self.current()
+        self._current.context = (bucket_name, phase)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current.context = previous
+            self.add(bucket_name, 'Phases', phase, Time=time.perf_counter() - start)
+
+    def bind(self, function, phase=None):
+        if not settings._PROFILE and not settings._CPROFILE:
+            return function
+        bucket_name, current_phase = self.current()
+        context = (bucket_name, phase or current_phase)
+
+        def bound(*args, **kwargs):
+            previous = self.current()
+            self._current.context = context
+            start = time.perf_counter()
+            try:
+                return self.run_cprofiled(function, args, kwargs)
+            finally:
+                self._current.context = previous
+                if phase is not None and settings._PROFILE:
+                    self.add(bucket_name, 'Phases', phase, Time=time.perf_counter() - start)
+
+        return bound
+
+    def run_cprofiled(self, function, args, kwargs):
+        # One profile per task, a thread already being captured, by the task that runs this one, is not captured twice.
+        if not settings._CPROFILE or getattr(self._current, 'cprofiling', False):
+            return function(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 and later profile every thread at once, another capture already covers this one.
+            return function(*args, **kwargs)
+        self._current.cprofiling = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._current.cprofiling = False
+            with self._lock:
+                self.cprofiles.append(profile)
+
+    def add(self, bucket_name, section, name, Time=0.0, Requests=0, Bytes=0, Retries=0):
+        with self._lock:
+            entry = self.buckets.setdefault(bucket_name, {'Phases': {}, 'Operations': {}})[section].setdefault(
+                name, {'Time': 0.0, 'Requests': 0, 'Bytes': 0, 'Retries': 0})
+            entry['Time'] += Time
+            entry['Requests'] += Requests
+            entry['Bytes'] += Bytes
+            entry['Retries'] += Retries
+
+    def tag_request(self, params=None, model=None, context=None, **kwargs):
+        if context is not None and (settings._PROFILE or settings._CPROFILE):
+            bucket_name, phase = self.current()
+            context['profile'] = (bucket_name or (params or {}).get('Bucket'), phase or 'Other',
+                                  model.name if model is not None else 'Unknown', time.perf_counter())
+
+    def count_response(self, response_dict=None, context=None, **kwargs):
+        tag = (context or {}).get('profile')
+        if tag is None:
+            return
+        bucket_name, phase, operation, start = tag
+        headers = (response_dict or {}).get('headers') or {}
+        size = int(headers.get('content-length') or 0)
+        retry = int(context.get('retries', {}).get('attempt', 1) > 1)
+        self.add(bucket_name, 'Phases', phase, Requests=1, Bytes=size, Retries=retry)
+        self.add(bucket_name, 'Operations', operation, Requests=1, Bytes=size, Retries=retry)
+
+    def end_call(self, context=None, **kwargs):
+        # Emitted once per API call, retries and their backoff included.
+        tag = (context or {}).get('profile')
+        if tag is not None:
+            bucket_name, phase, operation, start = tag
+            self.add(bucket_name, 'Operations', operation, Time=time.perf_counter() - start)
+
+    def bucket_profile(self, bucket_name, processing_time):
+        with self._lock:
+            profile = self.buckets.setdefault(bucket_name, {'Phases': {}, 'Operations': {}})
+            profile['Time'] = processing_time
+            return {'Time': round(processing_time, 3),
+                    'Phases': {name: dict(entry, Time=round(entry['Time'], 3)) for name, entry in
+                               sorted(profile['Phases'].items())},
+                    'Operations': {name: dict(entry, Time=round(entry['Time'], 3)) for name, entry in
+                                   sorted(profile['Operations'].items())}}
+
+    def summary(self, top):
+        with self._lock:
+            buckets = sorted(((name, profile) for name, profile in self.buckets.items() if 'Time' in profile),
+                             key=lambda item: item[1]['Time'], reverse=True)[:top]
+            operations = {}
+            for profile in self.buckets.values():
+                for name, entry in profile['Operations'].items():
+                    total = operations.setdefault(name, {'Time': 0.0, 'Requests': 0, 'Bytes': 0, 'Retries': 0})
+                    for key, value in entry.items():
+                        total[key] += value
+        lines = ["Slowest buckets:"]
+        for name, profile in buckets:
+            lines.append("  {:60}{:>12.3f}s  {}".format(name, profile['Time'], ", ".join(
+                "{} {:.3f}s".format(phase, entry['Time']) for phase, entry in
+                sorted(profile['Phases'].items(), key=lambda item: item[1]['Time'], reverse=True))))
+        lines.append("Slowest operations:")
+        for name, entry in sorted(operations.items(), key=lambda item: item[1]['Time'], reverse=True)[:top]:
+            lines.append("  {:40}{:>12.3f}s{:>12} requests{:>16} bytes{:>8} retries".format(
+                name, entry['Time'], entry['Requests'], entry['Bytes'], entry['Retries']))
+        return "\n".join(lines)
+
+    def dump_cprofile(self, path):
+        with self._lock:
+            profiles = list(self.cprofiles)
+        if not profiles:
+            return False
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        return True
+
+
+request_counters = RequestCounters()
+profiler = Profiler()
+request_hedger = RequestHedger()
+client_pool = ClientPool()
+price_tables = SingleFlightCache()
+price_table_entries = None
+price_table_lock = Lock()
+region_names = SingleFlightCache()
+bucket_regions = SingleFlightCache()
+bucket_creation_dates = {}
+bucket_metrics = {}
+bucket_accelerations = SingleFlightCache()
+pushdown_disabled = Event()
+inventory_manifests = SingleFlightCache()
+inventory_configurations = SingleFlightCache()
+manifest_contents = SingleFlightCache()
+metadata_executor = None
+metadata_executor_lock = Lock()
+inventory_process_pool = None
+inventory_process_pool_lock = Lock()
+run_totals = RunTotals()
+output_sink = None
+daemon_state = None
+shared_work = WorkQueue()
+oversized_buckets = set()
+region_entries = None
+region_lock = Lock()
+region_session = None
+
+
+def cache_path(name):
+    return os.path.join(settings._CACHE_DIR, name)
+
+
+def read_json_cache(name):
+    try:
+        with open(cache_path(name)) as cachefile:
+            return json.load(cachefile)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json_cache(name, contents):
+    # Write to a temporary file first so a concurrent reader or a crash never sees a partial file.
+    path = cache_path(name)
+    tmp = "{}.{}.{}.tmp".format(path, os.getpid(), get_ident())
+    with open(tmp, 'w') as cachefile:
+        json.dump(contents, cachefile, default=str)
+    os.replace(tmp, path)
+
+
 def append_output(results):
     with open(settings._OUTPUT_FILE, "a") as output:
         output.write(results)
 
 
+'''
+With --output-format ndjson or csv, every bucket is appended to --output as soon as its stats are built, one line each
+and flushed right away, so a crashed run keeps the buckets it completed and the file can be tailed. Sizes, counts and
+costs are written as numbers next to their display strings. Failed buckets are written with an Error.
+'''
+
+output_csv_columns = ['Name', 'Region', 'CreationDate', 'LastModified', 'Count', 'SizeBytes', 'Size', 'CostUSD',
+                      'Cost', 'Error'] + ["{}_{}".format(storage_class, field)
+                                          for storage_class in known_storage_classes
+                                          for field in ('Count', 'SizeBytes', 'CostUSD')]
+
+
+class OutputSink(object):
+    def __init__(self, path, output_format):
+        self.output_format = output_format
+        self._lock = Lock()
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a", newline="" if output_format == 'csv' else None, encoding="utf-8")
+        self._writer = None
+        if output_format == 'csv':
+            self._writer = csv.DictWriter(self._file, fieldnames=output_csv_columns, extrasaction='ignore')
+            # Appending to the file of an earlier run keeps its header.
+            if new_file:
+                self._writer.writeheader()
+                self._file.flush()
+
+    def write(self, stats):
+        if self._writer is not None:
+            line = output_csv_row(stats)
+        else:
+            line = json.dumps(stats, default=output_json_value) + "\n"
+        with self._lock:
+            if self._writer is not None:
+                self._writer.writerow(line)
+            else:
+                self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def output_json_value(value):
+    # Counts and sizes read from the object cache are numpy scalars, dates are written as strings.
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def output_csv_row(stats):
+    row = dict(stats)
+    for entry in stats.get('Content', []):
+        row[entry['StorageClass'] + "_Count"] = entry['Count']
+        row[entry['StorageClass'] + "_SizeBytes"] = entry['Size']
+        row[entry['StorageClass'] + "_CostUSD"] = entry.get('CostUSD')
+    return row
+
+
+'''
+Bucket regions are resolved once per run (concurrently for the whole bucket list) over a pooled HTTP session
+and remembered in the cache directory across runs.
+'''
+
+
 def get_region(bucket_name):
+    return bucket_regions.get(bucket_name, lambda: lookup_bucket_region(bucket_name))
+
+
+def get_region_session():
+    global region_session
+    with region_lock:
+        if region_session is None:
+            region_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings._REGION_WORKERS)
+            region_session.mount("http://", adapter)
+    return region_session
+
+
+def load_region_disk_cache():
+    global region_entries
+    with region_lock:
+        if region_entries is None:
+            region_entries = read_json_cache(region_cache_name).get('Entries', {})
+        return region_entries
+
+
+def lookup_bucket_region(bucket_name):
+    entry = load_region_disk_cache().get(bucket_name)
+    if entry is not None and time.time() - entry['Resolved'] < settings._REGION_TTL * 3600:
+        return entry['Region']
     try:
-        response = requests.get("http://" + bucket_name + ".s3.amazonaws.com/")
+        # The region header is returned even on 301/403 responses, so a HEAD without credentials is enough.
+        response = get_region_session().head("http://" + bucket_name + ".s3.amazonaws.com/", timeout=30)
         region = response.headers.get("x-amz-bucket-region")
-        return region
     except Exception as e:
-        print("Error: couldn't connect to '{0}' bucket. Details: {1}".format(response, e))
+        print("Error: couldn't connect to '{0}' bucket. Details: {1}".format(bucket_name, e))
+        return None
+    if region is not None:
+        entries = load_region_disk_cache()
+        with region_lock:
+            entries[bucket_name] = {'Region': region, 'Resolved': time.time()}
+    return region
+
+
+def resolve_bucket_regions(bucket_names):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, settings._REGION_WORKERS)) as executor:
+        regions = dict(zip(bucket_names, executor.map(get_region, bucket_names)))
+    with region_lock:
+        if region_entries is not None:
+            try:
+                write_json_cache(region_cache_name, {'Version': 1, 'Entries': region_entries})
+            except OSError as e:
+                if settings._VERBOSE > 1:
+                    print("Could not write region cache:", e)
+    return regions
+
+
+def bucket_client(bucket_name, accelerate=False):
+    # Talking to the bucket's own region avoids a 301 redirect round trip on every call.
+    return client_pool.get('s3', get_region(bucket_name), accelerate)
+
+
+def bucket_threads(bucket_count):
+    # Buckets processed at the same time.
+    if settings._THREADED == 1:
+        return max(1, min(bucket_count, settings._MAX_BUCKETS))
+    elif settings._THREADED in (2, 3):
+        return max(1, settings._MAX_THREADS)
+    return 1
+
+
+def client_pool_size(bucket_count):
+    bucket_concurrency = max(1, settings._METADATA_THREADS, settings._FILE_WORKERS)
+    if settings._SHARDED:
+        bucket_concurrency = max(bucket_concurrency, settings._LIST_WORKERS)
+    return max(10, bucket_threads(bucket_count) * bucket_concurrency)
+
+
+def metadata_fallback(error, missing):
+    # Value of a configuration section whose call failed. Still throttled after every retry fails the bucket rather
+    # than reporting it wrong, a configuration that does not exist is reported as missing and any other error as is.
+    if is_throttling_error(error):
+        raise error
+    if not isinstance(error, ClientError):
+        return missing
+    code = error.response.get('Error', {}).get('Code', "")
+    if code.startswith("NoSuch") or code.endswith("NotFound") or code.endswith("NotFoundError"):
+        return missing
+    return "Error: {}".format(code)
 
 
 def get_encryption(bucket_name):
     try:
         encryption = {
-            "ServerSizeEncryption": s3.get_bucket_encryption(Bucket=bucket_name)['ServerSideEncryptionConfiguration'][
+            "ServerSizeEncryption": bucket_client(bucket_name).get_bucket_encryption(Bucket=bucket_name)['ServerSideEncryptionConfiguration'][
                 'Rules']}
-    except Exception:
-        encryption = "Disabled"
+    except Exception as e:
+        encryption = metadata_fallback(e, "Disabled")
     return encryption
 
 
 def get_website(bucket_name):
     try:
-        website = s3.get_bucket_website(Bucket=bucket_name)
+        website = bucket_client(bucket_name).get_bucket_website(Bucket=bucket_name)
         response = {
             "IndexDocument": website.get("IndexDocument", None),
             "ErrorDocument": website.get("ErrorDocument", None)
         }
-    except Exception:
-        response = {}
+    except Exception as e:
+        response = metadata_fallback(e, {})
     return response
 
 
 def get_location(bucket_name):
     try:
-        location = s3.get_bucket_location(Bucket=bucket_name)['LocationConstraint']
-    except Exception:
-        location = None
+        location = bucket_client(bucket_name).get_bucket_location(Bucket=bucket_name)['LocationConstraint']
+    except Exception as e:
+        location = metadata_fallback(e, None)
     return location
 
 
 def get_versioning(bucket_name):
     try:
-        versioning = s3.get_bucket_versioning(Bucket=bucket_name)['Status']
-    except Exception:
-        versioning = "Disabled"
+        versioning = bucket_client(bucket_name).get_bucket_versioning(Bucket=bucket_name)['Status']
+    except Exception as e:
+        versioning = metadata_fallback(e, "Disabled")
     return versioning
 
 
 def get_grantees(bucket_name):
-    acl = boto3.resource("s3").Bucket(bucket_name).Acl()
+    try:
+        grants = bucket_client(bucket_name).get_bucket_acl(Bucket=bucket_name)['Grants']
+    except Exception as e:
+        return metadata_fallback(e, [])
     grantees = []
     try:
-        groups = itertools.groupby(sorted(acl.grants, key=lambda k: k['Permission']), lambda k: k['Permission'])
+        groups = itertools.groupby(sorted(grants, key=lambda k: k['Permission']), lambda k: k['Permission'])
     except Exception:
         return grantees
     for k, g in groups:
@@ -218,39 +1203,60 @@ def get_grantees(bucket_name):
 
 
 def get_acceleration(bucket_name):
+    return bucket_accelerations.get(bucket_name, lambda: lookup_acceleration(bucket_name))
+
+
+def lookup_acceleration(bucket_name):
     try:
-        s3_client = boto3.client("s3", config=Config(s3={'use_accelerate_endpoint': True}))
-        status = s3_client.get_bucket_accelerate_configuration(Bucket=bucket_name)['Status']
-    except Exception:
-        status = "Disabled"
+        status = bucket_client(bucket_name).get_bucket_accelerate_configuration(Bucket=bucket_name)['Status']
+    except Exception as e:
+        status = metadata_fallback(e, "Disabled")
     return status
 
 
+def inventory_transfer_client(bucket_name):
+    # Inventory files are large, download them through the accelerate endpoint when the bucket allows it.
+    return bucket_client(bucket_name, get_acceleration(bucket_name) == "Enabled")
+
+
 def get_object_lock_configuration(bucket_name):
     try:
-        bucket_configuration = s3.get_object_lock_configuration(Bucket=bucket_name)
+        bucket_configuration = bucket_client(bucket_name).get_object_lock_configuration(Bucket=bucket_name)
         response = bucket_configuration['ObjectLockConfiguration']['ObjectLockEnabled']
-    except Exception:
-        response = "Disabled"
+    except Exception as e:
+        response = metadata_fallback(e, "Disabled")
     return response
 
 
 def get_inventory_configurations(bucket_name):
+    # Memoized, both the bucket size estimate and the analysis need it.
+    return inventory_configurations.get(bucket_name, lambda: fetch_inventory_configurations(bucket_name))
+
+
+def fetch_inventory_configurations(bucket_name):
     response = []
     try:
-        bucket_configuration = s3.list_bucket_inventory_configurations(Bucket=bucket_name)
-        if "InventoryConfigurationList" in bucket_configuration:
-            for inventory_bucket in bucket_configuration['InventoryConfigurationList']:
+        kwargs = {'Bucket': bucket_name}
+        while True:
+            bucket_configuration = bucket_client(bucket_name).list_bucket_inventory_configurations(**kwargs)
+            for inventory_bucket in bucket_configuration.get('InventoryConfigurationList', []):
                 response.append(
                     {
                         'Id': inventory_bucket['Id'],
                         'IsEnabled': inventory_bucket['IsEnabled'],
                         'Bucket': inventory_bucket['Destination']['S3BucketDestination']['Bucket'].split(':')[-1],
+                        'Prefix': inventory_bucket['Destination']['S3BucketDestination'].get('Prefix', ""),
                         'Format': inventory_bucket['Destination']['S3BucketDestination']['Format'],
                         'Versions': inventory_bucket['IncludedObjectVersions']
                     }
                 )
-    except Exception:
+            if not bucket_configuration.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = bucket_configuration['NextContinuationToken']
+    except Exception as e:
+        # Also decides whether the bucket is read from its inventory, any error other than throttling means listing.
+        if is_throttling_error(e):
+            raise
         return response
     return response
 
@@ -258,7 +1264,7 @@ def get_inventory_configurations(bucket_name):
 def get_replication(bucket_name):
     response = []
     try:
-        configurations = s3.get_bucket_replication(Bucket=bucket_name)
+        configurations = bucket_client(bucket_name).get_bucket_replication(Bucket=bucket_name)
         if "ReplicationConfiguration" in configurations and "Rules" in configurations['ReplicationConfiguration']:
             for configuration in configurations['ReplicationConfiguration']['Rules']:
                 response.append(
@@ -268,86 +1274,665 @@ def get_replication(bucket_name):
                         'Destination': configuration['Destination']
                     }
                 )
-    except Exception:
-        response = []
+    except Exception as e:
+        response = metadata_fallback(e, [])
     return response
 
 
 def get_policy(bucket_name):
     try:
-        policy = s3.get_bucket_policy(Bucket=bucket_name)['Policy']
+        policy = bucket_client(bucket_name).get_bucket_policy(Bucket=bucket_name)['Policy']
         response = "Enabled"
-    except Exception:
-        response = "Disabled"
+    except Exception as e:
+        response = metadata_fallback(e, "Disabled")
     return response
 
 
 def get_analytics(bucket_name):
     try:
-        bucket_analytics = s3.list_bucket_analytics_configurations(Bucket=bucket_name)['AnalyticsConfigurationList']
+        bucket_analytics = bucket_client(bucket_name).list_bucket_analytics_configurations(Bucket=bucket_name)['AnalyticsConfigurationList']
         response = 'Enabled'
-    except Exception:
-        response = 'Disabled'
+    except Exception as e:
+        response = metadata_fallback(e, 'Disabled')
     return response
 
 
-def find_latest_inventory_manifest_key(bucket_name, inventory_bucket, inventory_id):
-    kwargs = {'Bucket': inventory_bucket, 'Prefix': bucket_name + "/" + inventory_id + "/"}
-    latest = sorted(s3.list_objects_v2(**kwargs)['Contents'], key=lambda obj: obj['LastModified'], reverse=True)
-    manifest = next(key['Key'] for key in latest if key['Key'].endswith("manifest.json"))
-    return manifest
+def get_creation_date(bucket_name):
+    # Creation dates already come with list_buckets, buckets we do not own have none to report.
+    creation_date = bucket_creation_dates.get(bucket_name)
+    return None if creation_date is None else str(creation_date)
+
+
+'''
+Bucket configuration sections, in output order, and the call used to collect each of them.
+'''
+metadata_collectors = {
+    'Versioning': get_versioning,
+    'WebSite': get_website,
+    'Analytics': get_analytics,
+    'Acceleration': get_acceleration,
+    'Replication': get_replication,
+    'Policy': get_policy,
+    'ObjectLock': get_object_lock_configuration,
+    'Inventory': get_inventory_configurations,
+    'LocationConstraint': get_location,
+    'Grantee': get_grantees,
+    'Encryption': get_encryption
+}
+
+
+def get_metadata_executor():
+    global metadata_executor
+    with metadata_executor_lock:
+        if metadata_executor is None:
+            # Sized for the most buckets that can be in flight, the executor only starts the threads it needs.
+            metadata_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, settings._METADATA_THREADS * bucket_threads(settings._MAX_BUCKETS)))
+    return metadata_executor
+
+
+def get_inventory_process_pool():
+    # -t 3: inventory files are parsed in worker processes, decompression and CSV parsing do not release the GIL.
+    # Workers are spawned rather than forked, forking a process with running threads and open connections is unsafe.
+    global inventory_process_pool
+    with inventory_process_pool_lock:
+        if inventory_process_pool is None:
+            inventory_process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(1, settings._PROCESSES), mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_inventory_process, initargs=(settings, dict(bucket_regions.items())))
+    return inventory_process_pool
+
+
+def init_inventory_process(parent_settings, regions):
+    # Runs once in every worker: its own clients, the parent's settings and the regions already resolved.
+    global settings
+    global client_pool
+    settings = parent_settings
+    client_pool = ClientPool()
+    client_pool.set_pool_size(max(1, settings._FILE_WORKERS))
+    for bucket_name, region in regions.items():
+        bucket_regions.set(bucket_name, region)
+
+
+def timed_metadata_call(collector, bucket_name):
+    start = time.perf_counter()
+    value = collector(bucket_name)
+    return value, round(time.perf_counter() - start, 3)
+
+
+def collect_bucket_metadata(bucket_name, inventory=None):
+    metadata = {}
+    latency = {}
+    futures = {}
+    for section in settings._METADATA:
+        if section == 'Inventory' and inventory is not None:
+            # Already fetched by the statistics path, no need to ask again.
+            metadata[section] = inventory
+            latency[section] = 0.0
+        else:
+            futures[section] = get_metadata_executor().submit(profiler.bind(timed_metadata_call),
+                                                              metadata_collectors[section], bucket_name)
+    for section, future in futures.items():
+        metadata[section], latency[section] = future.result()
+    return {section: metadata[section] for section in metadata_collectors if section in metadata}, latency
+
+
+'''
+Inventories are delivered under <destination prefix>/<bucket>/<inventory id>/, one YYYY-MM-DDTHH-MMZ/ folder per
+delivery holding its manifest.json, next to the data/ and hive/ folders. Only the folders are listed, newest first,
+so finding the latest manifest costs a page per thousand deliveries plus a HEAD, whatever the number of data files.
+Manifest locations and contents are memoized for the run.
+'''
+
+
+def inventory_base_prefix(bucket_name, inventory_id, prefix=""):
+    return (prefix.strip("/") + "/" if prefix.strip("/") else "") + bucket_name + "/" + inventory_id + "/"
+
+
+def find_latest_inventory_manifest(bucket_name, inventory_bucket, inventory_id, prefix=""):
+    base = inventory_base_prefix(bucket_name, inventory_id, prefix)
+    return inventory_manifests.get((inventory_bucket, base),
+                                   lambda: lookup_latest_inventory_manifest(inventory_bucket, base))
+
+
+def lookup_latest_inventory_manifest(inventory_bucket, base):
+    client = bucket_client(inventory_bucket)
+    folders = []
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=inventory_bucket, Prefix=base, Delimiter="/"):
+        folders.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    for folder in sorted((f for f in folders if inventory_delivery_folder.match(f[len(base):])), reverse=True):
+        # A delivery still being written has no manifest yet, the previous one is then the latest.
+        try:
+            head = client.head_object(Bucket=inventory_bucket, Key=folder + "manifest.json")
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                continue
+            raise
+        return {'Key': folder + "manifest.json", 'ETag': head['ETag'], 'LastModified': head['LastModified']}
+    raise KeyError("No inventory manifest under s3://{}/{}".format(inventory_bucket, base))
+
+
+def find_latest_inventory_manifest_key(bucket_name, inventory_bucket, inventory_id, prefix=""):
+    return find_latest_inventory_manifest(bucket_name, inventory_bucket, inventory_id, prefix)['Key']
 
 
 def load_manifest(bucket_name, key):
+    return manifest_contents.get((bucket_name, key), lambda: fetch_manifest(bucket_name, key))
+
+
+def fetch_manifest(bucket_name, key):
     kwargs = {'Bucket': bucket_name, 'Key': key}
-    data = s3.get_object(**kwargs)
+    data = bucket_client(bucket_name).get_object(**kwargs)
     contents = json.loads(data['Body'].read())
     return contents
 
 
-def load_inventory_csv(bucket_name, inventory_ids):
-    inv_agg = []
+def load_inventory(bucket_name, inventory_ids):
+    aggregate = StorageClassAggregate()
+    state = read_refresh_state(bucket_name) if settings._CACHE else None
     for inventory in inventory_ids:
-        if inventory['Format'] == "CSV" and inventory['IsEnabled']:
+        if inventory['Format'] in columnar_inventory_readers and pyarrow is None:
+            if settings._VERBOSE > 0:
+                print("Skipping {} Inventory Id '{}' for bucket '{}', pyarrow is not installed".format(
+                    inventory['Format'], inventory['Id'], bucket_name))
+            continue
+        if inventory['Format'] in inventory_formats and inventory['IsEnabled']:
             try:
                 if settings._VERBOSE > 0:
                     print("Using Inventory Id '{}' for bucket '{}'".format(inventory['Id'], bucket_name), end="\r")
                 try:
-                    inventory_manifest = find_latest_inventory_manifest_key(bucket_name, inventory['Bucket'],
-                                                                        inventory['Id'])
+                    latest = find_latest_inventory_manifest(bucket_name, inventory['Bucket'], inventory['Id'],
+                                                            inventory.get('Prefix', ""))
                 except KeyError:
                     continue
 
+                inventory_manifest = latest['Key']
                 if inventory_manifest.__len__() == 0:
                     continue
+                previous = {}
+                if state is not None:
+                    previous = state.get('Inventory', {})
+                    if previous.get('Id') != inventory['Id'] or previous.get('PrefixScope') != prefix_scope():
+                        previous = {}
+                    elif previous.get('ManifestKey') == inventory_manifest and \
+                            previous.get('ManifestETag') == latest['ETag'] and 'Aggregate' in previous:
+                        if settings._VERBOSE > 1:
+                            print("Inventory of bucket {} unchanged since {}".format(bucket_name, inventory_manifest))
+                        aggregate = StorageClassAggregate().add_state(previous)
+                        break
                 manifest = load_manifest(inventory['Bucket'], inventory_manifest)
                 if settings._VERBOSE > 2:
                     print("manifest: {}".format(manifest))
-                schema = [item.strip() for item in manifest['fileSchema'].split(",")]
+                schema = None
+                reader = columnar_inventory_readers.get(inventory['Format'])
+                if reader is None:
+                    schema = [item.strip() for item in manifest['fileSchema'].split(",")]
                 if settings._VERBOSE > 2:
                     print("schema: {}".format(schema))
                     print("files: {}".format(manifest['files'][0]['key']))
 
-                if settings._S3SELECT:
-                    inv_agg = pd.concat(
-                        s3select_inventory_csv(inventory['Bucket'], files['key'], schema).groupby('StorageClass',
-                                                                                                  as_index=False).agg(
-                            {'Count': 'sum', 'Size': 'sum', 'LastModifiedDate': 'max'}) for files in
-                        manifest['files']).groupby('StorageClass', as_index=False).agg(
-                        {'Count': 'sum', 'Size': 'max', 'LastModifiedDate': 'max'})
-                else:
-                    inv_agg = pd.concat(
-                        read_inventory_file(inventory['Bucket'], files['key'], schema).groupby('StorageClass',
-                                                                                               as_index=False).agg(
-                            {'Count': 'sum', 'Size': 'sum', 'LastModifiedDate': 'max'}) for files in
-                        manifest['files']).groupby('StorageClass', as_index=False).agg(
-                        {'Count': 'sum', 'Size': 'max', 'LastModifiedDate': 'max'})
+                on_file = None
+                known_files = {}
+                if state is not None:
+                    known_files = previous.get('Files', {})
+                    current = {'Id': inventory['Id'], 'ManifestKey': inventory_manifest,
+                               'ManifestETag': latest['ETag'], 'PrefixScope': prefix_scope(), 'Files': {}}
+                    state['Inventory'] = current
+
+                    def on_file(manifest_file, file_aggregate):
+                        # Saved after every file so an interrupted refresh resumes where it stopped.
+                        current['Files'][manifest_file['key']] = dict(file_aggregate.to_state(),
+                                                                      MD5checksum=manifest_file.get('MD5checksum'))
+                        write_refresh_state(bucket_name, state)
+
+                aggregate = aggregate_inventory_files(bucket_name, inventory['Bucket'], manifest['files'], schema,
+                                                      known_files, on_file, reader)
+                if state is not None:
+                    current.update(aggregate.to_state())
+                    write_refresh_state(bucket_name, state)
                 break
             except Exception as e:
+                # Still throttled after every retry, listing the bucket instead would only add to the load.
+                if is_throttling_error(e):
+                    raise
                 print("load_inventory exception:", e)
                 continue
-    #    inv_agg.rename(columns={'LastModifiedDate': 'LastModified'})
-    return inv_agg
+    return aggregate
+
+
+def aggregate_inventory_files(bucket_name, inventory_bucket, files, schema, known_files=None, on_file=None,
+                              reader=None):
+    # Inventory data files are independent, download and parse them concurrently and fold each result in as it
+    # completes. --file-workers bounds this per bucket, separately from the bucket level --max-threads.
+    # Files already aggregated by a previous run, same key and checksum in known_files, are not read again.
+    if reader is None:
+        reader = select_inventory_file if settings._S3SELECT else read_inventory_file
+    aggregate = StorageClassAggregate()
+    pending = []
+    for manifest_file in files:
+        known = (known_files or {}).get(manifest_file['key'])
+        if known is not None and known['MD5checksum'] == manifest_file.get('MD5checksum'):
+            file_aggregate = StorageClassAggregate().add_state(known)
+            aggregate.merge(file_aggregate)
+            if on_file is not None:
+                on_file(manifest_file, file_aggregate)
+        else:
+            pending.append(manifest_file)
+    if settings._VERBOSE > 1 and len(pending) < len(files):
+        print("Inventory of bucket {}: {} of {} files already aggregated".format(
+            bucket_name, len(files) - len(pending), len(files)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, settings._FILE_WORKERS)) as executor:
+        # With -t 3 the files go to the shared process pool and only their small aggregates come back. The files of
+        # an oversized bucket go to the shared work queue, its own file workers and idle bucket workers run them.
+        submit = executor.submit
+        read = profiler.bind(timed_inventory_read, 'S3Select' if reader is select_inventory_file else 'InventoryRead')
+        if settings._THREADED == 3:
+            # Requests made by the worker processes are not profiled.
+            submit = get_inventory_process_pool().submit
+            read = timed_inventory_read
+        elif bucket_name in oversized_buckets:
+            submit = shared_work.submit
+        futures = {submit(read, reader, inventory_bucket, f['key'], schema): f for f in pending}
+        if submit == shared_work.submit:
+            for worker in range(max(1, settings._FILE_WORKERS)):
+                executor.submit(shared_work.help_until, list(futures))
+        try:
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                file_aggregate, elapsed = future.result()
+                aggregate.merge(file_aggregate)
+                if on_file is not None:
+                    on_file(futures[future], file_aggregate)
+                if settings._VERBOSE > 1:
+                    print("Inventory file {}/{} for bucket {}: {} ({} objects, {:.3f}s)".format(
+                        done, len(pending), bucket_name, futures[future]['key'], file_aggregate.count(), elapsed))
+                elif settings._VERBOSE > 0:
+                    print("Inventory file {}/{} for bucket {}".format(done, len(pending), bucket_name), end="\r")
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    return aggregate
+
+
+def timed_inventory_read(reader, inventory_bucket, key, schema):
+    start = time.perf_counter()
+    return reader(inventory_bucket, key, schema), time.perf_counter() - start
+
+
+class StorageClassAggregate(object):
+    '''
+    Running object count, byte total and most recent LastModified per StorageClass.
+    Memory only grows with the number of storage classes, never with the number of objects.
+    '''
+
+    def __init__(self):
+        self.classes = {}
+        self.scan_stats = {}
+        self.prefixes = PrefixAggregate(settings._PREFIX_DEPTH, settings._MAX_PREFIXES) \
+            if settings._PREFIX_DEPTH > 0 else None
+
+    def __len__(self):
+        return len(self.classes)
+
+    def add(self, storage_class, count, size, last_modified):
+        last_modified = as_datetime(last_modified)
+        entry = self.classes.get(storage_class)
+        if entry is None:
+            self.classes[storage_class] = [int(count), int(size), last_modified]
+            return
+        entry[0] += int(count)
+        entry[1] += int(size)
+        if last_modified is not None and (entry[2] is None or last_modified > entry[2]):
+            entry[2] = last_modified
+
+    def add_objects(self, contents):
+        # Called for every ListObjects page, so keep it to plain dict lookups and arithmetic.
+        classes = self.classes
+        for obj in contents:
+            entry = classes.get(obj['StorageClass'])
+            if entry is None:
+                classes[obj['StorageClass']] = [1, obj['Size'], obj['LastModified']]
+            else:
+                entry[0] += 1
+                entry[1] += obj['Size']
+                if obj['LastModified'] > entry[2]:
+                    entry[2] = obj['LastModified']
+        if self.prefixes is not None:
+            self.prefixes.add_objects(contents)
+
+    def add_rows(self, frame):
+        # One row per object with StorageClass, Size and LastModifiedDate columns, only the per class result is kept.
+        grouped = frame.groupby('StorageClass', sort=False).agg(
+            Count=('StorageClass', 'size'), Size=('Size', 'sum'), LastModifiedDate=('LastModifiedDate', 'max'))
+        for storage_class, count, size, last_modified in zip(grouped.index, grouped['Count'], grouped['Size'],
+                                                              grouped['LastModifiedDate']):
+            self.add(storage_class, count, size, last_modified)
+        if self.prefixes is not None and 'Key' in frame:
+            self.prefixes.add_rows(frame)
+        return self
+
+    def add_scan_stats(self, details):
+        # S3 Select BytesScanned/BytesProcessed/BytesReturned.
+        for name, value in details.items():
+            self.scan_stats[name] = self.scan_stats.get(name, 0) + value
+
+    def merge(self, other):
+        for storage_class, (count, size, last_modified) in other.classes.items():
+            self.add(storage_class, count, size, last_modified)
+        self.add_scan_stats(other.scan_stats)
+        if self.prefixes is not None and other.prefixes is not None:
+            self.prefixes.merge(other.prefixes)
+        return self
+
+    def count(self):
+        return sum(entry[0] for entry in self.classes.values())
+
+    def size(self):
+        return sum(entry[1] for entry in self.classes.values())
+
+    def last_modified(self):
+        dates = [entry[2] for entry in self.classes.values() if entry[2] is not None]
+        return max(dates) if dates else None
+
+    def to_entries(self):
+        # JSON friendly form, read back with add_entries.
+        return [[storage_class, count, size, None if last_modified is None else str(last_modified)]
+                for storage_class, (count, size, last_modified) in sorted(self.classes.items())]
+
+    def add_entries(self, entries):
+        for storage_class, count, size, last_modified in entries:
+            self.add(storage_class, count, size, last_modified)
+        return self
+
+    def to_state(self):
+        # Aggregate entries, and with --prefix-depth the prefix entries, as kept in the refresh state.
+        state = {'Aggregate': self.to_entries()}
+        if self.prefixes is not None:
+            state['Prefixes'] = self.prefixes.to_entries()
+        return state
+
+    def add_state(self, state):
+        self.add_entries(state['Aggregate'])
+        if self.prefixes is not None and state.get('Prefixes'):
+            self.prefixes.add_entries(state['Prefixes'])
+        return self
+
+    def to_content(self):
+        return [{'StorageClass': storage_class, 'Count': count, 'Size': size, 'LastModified': str(last_modified)}
+                for storage_class, (count, size, last_modified) in sorted(self.classes.items())]
+
+
+class MetricsAggregate(StorageClassAggregate):
+    '''
+    Daily CloudWatch storage metrics of a bucket: bytes per storage class, but only a bucket wide object count and no
+    modification dates. With -metricsfallback the per class counts and dates come from the detail aggregate, read from
+    the object cache or the inventory of the bucket, otherwise they are reported as null.
+    '''
+
+    def __init__(self, objects, timestamp):
+        super().__init__()
+        # Metrics have no keys to break down.
+        self.prefixes = None
+        self.objects = objects
+        self.timestamp = timestamp
+        self.detail = None
+
+    def count(self):
+        return self.objects
+
+    def last_modified(self):
+        return None if self.detail is None else self.detail.last_modified()
+
+    def to_content(self):
+        content = super().to_content()
+        for storage_class in content:
+            entry = (self.detail.classes if self.detail is not None else {}).get(storage_class['StorageClass'])
+            storage_class['Count'] = None if entry is None else entry[0]
+            storage_class['LastModified'] = None if entry is None or entry[2] is None else str(entry[2])
+        return content
+
+
+'''
+--prefix-depth N: count, bytes and latest LastModified per storage class of every key prefix down to N '/' levels,
+in the same pass over listing pages, inventory rows or cached objects. A page or chunk is first grouped by its
+deepest prefix, so the trie is only walked once per distinct prefix. Every level keeps a bounded set of candidates,
+a few times --max-prefixes, so memory stays bounded on buckets with millions of directories: a new prefix on a full
+level evicts the smallest candidate of that level, heavy hitters style, and its totals move to the '*' entry of its
+parent. The reported prefixes are then chosen level by level, the larger ones first, up to --max-prefixes and only
+the smaller ones are collapsed in '*' entries. A '*' entry that would repeat the totals of its parent is left out.
+'''
+
+
+def prefix_scope():
+    # Refresh state and checkpoints are only reused by runs breaking prefixes down the same way.
+    return [settings._PREFIX_DEPTH, settings._MAX_PREFIXES] if settings._PREFIX_DEPTH > 0 else None
+
+
+def add_prefix_class(classes, storage_class, count, size, last_modified):
+    entry = classes.get(storage_class)
+    if entry is None:
+        classes[storage_class] = [int(count), int(size), last_modified]
+        return
+    entry[0] += int(count)
+    entry[1] += int(size)
+    if last_modified is not None and (entry[2] is None or last_modified > entry[2]):
+        entry[2] = last_modified
+
+
+class PrefixAggregate(object):
+    # A trie node is [classes, children], classes {StorageClass: [count, size, last_modified]} covers every object
+    # below the node and children are keyed by '/' terminated segment. Collapsed prefixes have no children, evicted
+    # nodes have their children set to None.
+    other = "*"
+    # Candidates tracked per level, in multiples of the reported limit.
+    headroom = 4
+
+    def __init__(self, depth, limit):
+        self.depth = depth
+        self.limit = limit
+        self.capacity = max(1, limit * self.headroom)
+        self.tracked = [0] * depth
+        # Per level min-heaps of [size, sequence, parent, segment, node]. Sizes only grow, so a stale size is a lower
+        # bound and is refreshed when it reaches the top.
+        self.heaps = [[] for level in range(depth)]
+        self.sequence = itertools.count()
+        self.root = [{}, {}]
+        self.pattern = re.compile(r"^((?:[^/]*/){{1,{}}})".format(depth))
+
+    def key_prefix(self, key):
+        end = -1
+        for level in range(self.depth):
+            found = key.find("/", end + 1)
+            if found < 0:
+                break
+            end = found
+        return key[:end + 1]
+
+    def child(self, node, segment, level):
+        child = node[1].get(segment)
+        if child is None:
+            if self.tracked[level] >= self.capacity:
+                self.evict(level)
+            child = node[1][segment] = [{}, {}]
+            self.tracked[level] += 1
+            heap = self.heaps[level]
+            heapq.heappush(heap, [0, next(self.sequence), node, segment, child])
+            if len(heap) > 2 * self.capacity:
+                # Entries of evicted nodes are only skipped when popped, drop them before they pile up.
+                heap[:] = [entry for entry in heap if entry[4][1] is not None]
+                heapq.heapify(heap)
+        return child
+
+    def evict(self, level):
+        heap = self.heaps[level]
+        while heap:
+            entry = heapq.heappop(heap)
+            size, sequence, parent, segment, node = entry
+            if node[1] is None:
+                continue
+            current = prefix_node_size(node)
+            if current > size:
+                entry[0] = current
+                heapq.heappush(heap, entry)
+                continue
+            self.fold(parent, segment, level)
+            return
+
+    def fold(self, node, segment, level):
+        # Moves a child, its subtree included, to the '*' entry of node.
+        child = node[1].pop(segment)
+        collapsed = self.collapsed(node)[0]
+        for storage_class, (count, size, last_modified) in child[0].items():
+            add_prefix_class(collapsed, storage_class, count, size, last_modified)
+        self.drop(child, level)
+
+    def drop(self, node, level):
+        for segment, child in node[1].items():
+            if child[1] is not None:
+                self.drop(child, level + 1)
+        node[1] = None
+        self.tracked[level] -= 1
+
+    def collapsed(self, node):
+        child = node[1].get(self.other)
+        if child is None:
+            child = node[1][self.other] = [{}, None]
+        return child
+
+    def add(self, prefix, storage_class, count, size, last_modified):
+        last_modified = as_datetime(last_modified)
+        node = self.root
+        level = 0
+        start = 0
+        end = prefix.find("/")
+        while end >= 0:
+            child = self.child(node, prefix[start:end + 1], level)
+            add_prefix_class(child[0], storage_class, count, size, last_modified)
+            node = child
+            level += 1
+            start = end + 1
+            end = prefix.find("/", start)
+    def add_objects(self, contents):
+        # Called for every ListObjects page, objects are grouped by prefix before the trie is walked.
+        grouped = {}
+        key_prefix = self.key_prefix
+        for obj in contents:
+            group = (key_prefix(obj['Key']), obj['StorageClass'])
+            entry = grouped.get(group)
+            if entry is None:
+                grouped[group] = [1, obj['Size'], obj['LastModified']]
+            else:
+                entry[0] += 1
+                entry[1] += obj['Size']
+                if obj['LastModified'] > entry[2]:
+                    entry[2] = obj['LastModified']
+        for (prefix, storage_class), (count, size, last_modified) in grouped.items():
+            if prefix:
+                self.add(prefix, storage_class, count, size, last_modified)
+
+    def add_rows(self, frame):
+        # One row per object with Key, StorageClass, Size and LastModified(Date) columns. Keys without a '/' have no
+        # prefix and are dropped by the grouping.
+        last_column = 'LastModified' if 'LastModified' in frame else 'LastModifiedDate'
+        grouped = frame.assign(Prefix=frame['Key'].str.extract(self.pattern, expand=False)).groupby(
+            ['Prefix', 'StorageClass'], sort=False).agg(
+            Count=('StorageClass', 'size'), Size=('Size', 'sum'), LastModified=(last_column, 'max'))
+        for (prefix, storage_class), count, size, last_modified in zip(grouped.index, grouped['Count'],
+                                                                      grouped['Size'], grouped['LastModified']):
+            self.add(prefix, storage_class, count, size, last_modified)
+        return self
+
+    def merge(self, other):
+        self.merge_node(self.root, other.root, 0)
+        return self
+
+    def merge_node(self, node, other_node, level):
+        for segment, other_child in other_node[1].items():
+            child = self.collapsed(node) if segment == self.other else self.child(node, segment, level)
+            for storage_class, (count, size, last_modified) in other_child[0].items():
+                add_prefix_class(child[0], storage_class, count, size, last_modified)
+            if child[1] is not None and other_child[1] is not None:
+                self.merge_node(child, other_child, level + 1)
+
+    def prune(self):
+        # Keeps the larger candidates level by level up to limit, the others are folded in the '*' entry of their
+        # parent.
+        kept = 0
+        parents = [(self.root, "")]
+        for level in range(self.depth):
+            candidates = sorted(((-prefix_node_size(child), prefix + segment, segment, node, child)
+                                 for node, prefix in parents for segment, child in node[1].items()
+                                 if segment != self.other), key=lambda candidate: candidate[:2])
+            room = max(0, self.limit - kept)
+            for weight, prefix, segment, node, child in candidates[room:]:
+                self.fold(node, segment, level)
+            parents = [(child, prefix) for weight, prefix, segment, node, child in candidates[:room]]
+            kept += len(parents)
+        return self
+
+    def walk(self, node=None, prefix="", whole=True):
+        # Tracked prefixes depth first, the larger ones first, each followed by the '*' entry of its collapsed ones.
+        # Without whole, a '*' entry is left out when it is the only child and holds all of its parent.
+        node = self.root if node is None else node
+        children = sorted(node[1].items(), key=lambda item: (item[0] == self.other, -prefix_node_size(item[1])))
+        for segment, child in children:
+            if not whole and segment == self.other and len(children) == 1 and (
+                    node is self.root or prefix_node_totals(child) == prefix_node_totals(node)):
+                continue
+            yield prefix + segment, child[0]
+            if child[1]:
+                yield from self.walk(child, prefix + segment, whole)
+
+    def to_entries(self):
+        # JSON friendly form, read back with add_entries.
+        return [[prefix, [[storage_class, count, size, None if last_modified is None else str(last_modified)]
+                          for storage_class, (count, size, last_modified) in sorted(classes.items())]]
+                for prefix, classes in self.walk()]
+
+    def add_entries(self, entries):
+        # Entries hold the totals of their node, parents included, so they are rebuilt as a trie and merged.
+        entries_trie = PrefixAggregate(self.depth, len(entries))
+        for prefix, classes in entries:
+            node = entries_trie.root
+            segments = prefix.split("/")
+            for level, segment in enumerate(segments[:-1]):
+                node = entries_trie.child(node, segment + "/", level)
+            if segments[-1] == self.other:
+                node = entries_trie.collapsed(node)
+            for storage_class, count, size, last_modified in classes:
+                add_prefix_class(node[0], storage_class, count, size, as_datetime(last_modified))
+        return self.merge(entries_trie)
+
+    def to_content(self, class_sizes, class_costs):
+        # The cost of a storage class is shared among prefixes in proportion to their bytes of that class.
+        content = []
+        for prefix, classes in self.prune().walk(whole=False):
+            cost = sum(class_costs.get(storage_class, 0) * size / class_sizes[storage_class]
+                       for storage_class, (count, size, last_modified) in classes.items()
+                       if class_sizes.get(storage_class))
+            dates = [last_modified for count, size, last_modified in classes.values() if last_modified is not None]
+            content.append({'Prefix': prefix, 'Count': sum(int(entry[0]) for entry in classes.values()),
+                            'Size': sum(int(entry[1]) for entry in classes.values()),
+                            'LastModified': str(max(dates)) if dates else None,
+                            'CostUSD': round(cost, 6) if cost > 0 else None})
+        return content
+
+
+def prefix_node_size(node):
+    return sum(entry[1] for entry in node[0].values())
+
+
+def prefix_node_totals(node):
+    return sum(entry[0] for entry in node[0].values()), prefix_node_size(node)
+
+
+def as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return pd.Timestamp(value).to_pydatetime()
+    except (TypeError, ValueError):
+        return None
 
 
 def display_size(size_bytes, sizeformat=-1):
@@ -359,21 +1944,222 @@ def display_size(size_bytes, sizeformat=-1):
     return "{0}{1}".format(s, tuple(sizes_name)[i])
 
 
-def write_cache_csv(bucket_name, objects):
-    with open(bucket_name + ".cache", 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
-        writer.writeheader()
-        for data in objects:
-            writer.writerow(data)
+'''
+Columnar object cache, one directory per bucket in the cache directory with a file per column.
+StorageClass is dictionary encoded to one byte, Size and LastModified (milliseconds since the epoch) are int64
+and keys are optional, stored as one UTF-8 blob with an end offset per object.
+'''
+
 
+def object_cache_path(bucket_name):
+    return cache_path(bucket_name + ".cache")
 
-def read_cache_csv(bucket_name):
-    data = []
-    df = pd.read_csv(bucket_name + ".cache")
-    for index, row in df.iterrows():
-        d = row.to_dict()
-        data.append(d)
-    return data
+
+def read_object_cache_meta(path):
+    try:
+        with open(os.path.join(path, object_cache_meta_name)) as metafile:
+            meta = json.load(metafile)
+        return meta if meta.get('Version') == 1 else None
+    except (OSError, ValueError):
+        return None
+
+
+def object_cache_exists(bucket_name):
+    return read_object_cache_meta(object_cache_path(bucket_name)) is not None
+
+
+def remove_object_cache(bucket_name):
+    path = object_cache_path(bucket_name)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        # <bucket>.cache CSV file of older versions.
+        os.remove(path)
+
+
+class ObjectCacheWriter(object):
+    '''
+    Appends ListObjects pages to the columnar cache of a bucket as they arrive, from any number of listing threads.
+    Columns are written in a temporary directory that only replaces the cache once the listing completed.
+    '''
+
+    def __init__(self, bucket_name, keys=False, prefix=""):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.path = object_cache_path(bucket_name)
+        self.tmp = "{}.{}.{}.tmp".format(self.path, os.getpid(), get_ident())
+        self.keys = keys
+        self.classes = {}
+        self.rows = 0
+        self.key_bytes = 0
+        self._lock = Lock()
+        os.makedirs(self.tmp)
+        names = [name for name, dtype in object_cache_columns]
+        if keys:
+            names += [name for name, dtype in object_cache_key_columns]
+        self._files = {name: open(os.path.join(self.tmp, name + ".bin"), 'wb') for name in names}
+
+    def append(self, contents):
+        count = len(contents)
+        sizes = np.fromiter((obj['Size'] for obj in contents), dtype='<i8', count=count)
+        modified = np.fromiter((int(obj['LastModified'].timestamp() * 1000) for obj in contents), dtype='<i8',
+                               count=count)
+        keys = [obj['Key'].encode('utf-8') for obj in contents] if self.keys else None
+        with self._lock:
+            classes = self.classes
+            codes = np.fromiter((classes.setdefault(obj['StorageClass'], len(classes)) for obj in contents),
+                                dtype='u1', count=count)
+            codes.tofile(self._files['StorageClass'])
+            sizes.tofile(self._files['Size'])
+            modified.tofile(self._files['LastModified'])
+            if keys is not None:
+                ends = np.cumsum(np.fromiter((len(key) for key in keys), dtype='<i8', count=count)) + self.key_bytes
+                ends.tofile(self._files['KeyEnd'])
+                self._files['Key'].write(b"".join(keys))
+                self.key_bytes = int(ends[-1]) if count else self.key_bytes
+            self.rows += count
+
+    def close(self):
+        for cachefile in self._files.values():
+            cachefile.close()
+        with open(os.path.join(self.tmp, object_cache_meta_name), 'w') as metafile:
+            json.dump({'Version': 1, 'Rows': self.rows, 'Classes': sorted(self.classes, key=self.classes.get),
+                       'Keys': self.keys, 'Prefix': self.prefix, 'Written': str(datetime.now())}, metafile)
+        remove_object_cache(self.bucket_name)
+        os.replace(self.tmp, self.path)
+        if settings._VERBOSE > 1:
+            print("Bucket {} cache written: {} objects".format(self.bucket_name, self.rows))
+
+    def abort(self):
+        for cachefile in self._files.values():
+            cachefile.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+'''
+Refresh state, what the aggregates of a bucket were built from: the inventory manifest and the aggregate of each of
+its data files, or the aggregate of each listing shard. Refreshing only processes what changed since.
+'''
+
+
+def read_refresh_state(bucket_name):
+    state = read_json_cache(bucket_name + ".state.json")
+    return state if state.get('Version') == 1 else {}
+
+
+def write_refresh_state(bucket_name, state):
+    state['Version'] = 1
+    write_json_cache(bucket_name + ".state.json", state)
+
+
+class ListingCheckpoint(object):
+    '''
+    Every --checkpoint-interval seconds a listing in progress writes the continuation token, last key and aggregate
+    of each of its shards to <bucket>.checkpoint.json. With -resume the next run of the same scope lists on from there
+    instead of from the start. The file is removed once the listing completes.
+    '''
+
+    def __init__(self, bucket_name, scope, snapshot=None):
+        self.bucket_name = bucket_name
+        self.scope = scope
+        self.snapshot = snapshot
+        self.writes = 0
+        self._lock = Lock()
+        self._written = time.monotonic()
+
+    def name(self):
+        return self.bucket_name + ".checkpoint.json"
+
+    def maybe_write(self):
+        if settings._CHECKPOINT_INTERVAL <= 0 or time.monotonic() - self._written < settings._CHECKPOINT_INTERVAL:
+            return
+        # Shards finishing a page at the same time do not queue up behind a write, one of them is enough.
+        if self._lock.acquire(blocking=False):
+            try:
+                if time.monotonic() - self._written >= settings._CHECKPOINT_INTERVAL:
+                    self._write()
+            finally:
+                self._lock.release()
+
+    def write(self):
+        if settings._CHECKPOINT_INTERVAL > 0 and self.snapshot is not None:
+            with self._lock:
+                self._write()
+
+    def _write(self):
+        write_json_cache(self.name(), {'Version': 1, 'Scope': self.scope, 'Written': time.time(),
+                                       'Shards': self.snapshot()})
+        self._written = time.monotonic()
+        self.writes += 1
+
+    def remove(self):
+        with self._lock:
+            try:
+                os.remove(cache_path(self.name()))
+            except FileNotFoundError:
+                pass
+
+
+def read_listing_checkpoint(bucket_name, scope):
+    checkpoint = read_json_cache(bucket_name + ".checkpoint.json")
+    if checkpoint.get('Version') != 1:
+        return []
+    if checkpoint.get('Scope') != scope:
+        if settings._VERBOSE > 0:
+            print("Checkpoint of bucket {} is for {}, listing from the start".format(bucket_name, checkpoint['Scope']))
+        return []
+    return checkpoint['Shards']
+
+
+def object_cache_usable(bucket_name):
+    # With -daemon only the first refresh of a bucket may come from its object cache, later ones list it again.
+    if daemon_state is not None and daemon_state.refreshed(bucket_name):
+        return False
+    if not settings._CACHE or settings._REFRESHCACHE:
+        return False
+    meta = read_object_cache_meta(object_cache_path(bucket_name))
+    # The cache only holds the objects of the --key-prefix it was listed with, caches that do not record it are
+    # listed again. A --prefix-depth breakdown needs the keys in the cache.
+    return meta is not None and meta.get('Prefix') == listing_prefix()[0] and (
+        settings._PREFIX_DEPTH == 0 or meta['Keys'])
+
+
+def read_object_cache(bucket_name):
+    # The columns are memory mapped and grouped a slice at a time, no Python object is created per cached object.
+    path = object_cache_path(bucket_name)
+    meta = read_object_cache_meta(path)
+    aggregate = StorageClassAggregate()
+    if meta is None or meta['Rows'] == 0:
+        return aggregate
+    columns = {name: np.memmap(os.path.join(path, name + ".bin"), dtype=dtype, mode='r', shape=(meta['Rows'],))
+               for name, dtype in object_cache_columns}
+    for start in range(0, meta['Rows'], object_cache_chunk_rows):
+        chunk = pd.DataFrame({name: column[start:start + object_cache_chunk_rows] for name, column in columns.items()})
+        grouped = chunk.groupby('StorageClass', sort=False).agg(
+            Count=('Size', 'size'), Size=('Size', 'sum'), LastModified=('LastModified', 'max'))
+        for code, count, size, last_modified in zip(grouped.index, grouped['Count'], grouped['Size'],
+                                                    grouped['LastModified']):
+            aggregate.add(meta['Classes'][code], count, size,
+                          datetime.fromtimestamp(int(last_modified) / 1000, timezone.utc))
+        if aggregate.prefixes is not None:
+            aggregate.prefixes.add_rows(object_cache_key_frame(path, meta, chunk, start))
+    return aggregate
+
+
+def object_cache_key_frame(path, meta, chunk, start):
+    # Keys are decoded for the rows of one chunk only.
+    key_end = np.memmap(os.path.join(path, "KeyEnd.bin"), dtype='<i8', mode='r', shape=(meta['Rows'],))
+    ends = key_end[start:start + len(chunk)]
+    first = int(key_end[start - 1]) if start > 0 else 0
+    with open(os.path.join(path, "Key.bin"), 'rb') as keyfile:
+        keyfile.seek(first)
+        keys = keyfile.read(int(ends[-1]) - first)
+    starts = np.concatenate(([first], ends[:-1])) - first
+    return pd.DataFrame({
+        'Key': [keys[begin:end].decode('utf-8') for begin, end in zip(starts.tolist(), (ends - first).tolist())],
+        'StorageClass': np.array(meta['Classes'])[chunk['StorageClass'].to_numpy()],
+        'Size': chunk['Size'].to_numpy(),
+        'LastModified': pd.to_datetime(chunk['LastModified'].to_numpy(), unit='ms', utc=True)})
 
 
 '''
@@ -384,13 +2170,10 @@ Analyse from compressed CSV file in the bucket via S3 Select
 def s3select_inventory_csv(bucket_name, key, cols_names):
     content_options = {"FieldDelimiter": ",", 'AllowQuotedRecordDelimiter': False}
     # expression = "select * from s3object"
-    size_pos = cols_names.index('Size')
-    lastmodified_pos = cols_names.index('LastModifiedDate')
-    storage_pos = cols_names.index('StorageClass')
-    encryption_pos = cols_names.index('EncryptionStatus')
-    expression = "select _{},_{},_{},_{} from s3object".format(size_pos + 1, lastmodified_pos + 1, storage_pos + 1,
-                                                               encryption_pos + 1)
-    req = s3.select_object_content(
+    columns = inventory_read_columns()
+    expression = "select {} from s3object".format(
+        ",".join("_{}".format(cols_names.index(column) + 1) for column in columns))
+    req = bucket_client(bucket_name).select_object_content(
         Bucket=bucket_name,
         Key=key,
         ExpressionType='SQL',
@@ -398,22 +2181,124 @@ def s3select_inventory_csv(bucket_name, key, cols_names):
         InputSerialization={'CompressionType': "GZIP", "CSV": content_options},
         OutputSerialization={'CSV': {}},
     )
-    records = []
+    # Records are parsed as the events arrive. An event can end in the middle of a row, or of a UTF-8 character,
+    # so the incomplete tail is carried over to the next event. Complete rows are buffered up to
+    # select_parse_bytes to keep the pandas overhead per parse call small.
+    aggregate = StorageClassAggregate()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ""
+    rows = []
+    rows_size = 0
+    for event in req['Payload']:
+        if "Records" in event:
+            text = pending + decoder.decode(event['Records']['Payload'])
+            cut = text.rfind("\n") + 1
+            pending = text[cut:]
+            if cut > 0:
+                rows.append(text[:cut])
+                rows_size += cut
+            if rows_size >= select_parse_bytes:
+                parse_select_records("".join(rows), aggregate, columns)
+                rows = []
+                rows_size = 0
+        elif "Stats" in event:
+            aggregate.add_scan_stats(event['Stats']['Details'])
+    rows.append(pending + decoder.decode(b"", final=True))
+    parse_select_records("".join(rows), aggregate, columns)
+    if settings._VERBOSE > 2:
+        print("s3select {}: {} objects, {}".format(key, aggregate.count(), aggregate.scan_stats))
+    return aggregate
+
+
+class PushdownUnsupported(Exception):
+    pass
+
+
+def select_inventory_file(bucket_name, key, cols_names):
+    # Pushdown only returns per class totals, a --prefix-depth breakdown needs the keys.
+    if settings._PUSHDOWN and settings._PREFIX_DEPTH == 0 and not pushdown_disabled.is_set():
+        try:
+            return s3select_pushdown_inventory_csv(bucket_name, key, cols_names)
+        except PushdownUnsupported as e:
+            if settings._VERBOSE > 1:
+                print("S3 Select pushdown not possible for {}, streaming rows instead: {}".format(key, e))
+        except ClientError as e:
+            if e.response['Error']['Code'] in transient_error_codes:
+                raise
+            # The expression itself is rejected, it will be for every other file too.
+            pushdown_disabled.set()
+            print("S3 Select pushdown disabled, streaming rows instead:", e)
+    return s3select_inventory_csv(bucket_name, key, cols_names)
+
+
+'''
+Aggregate inside S3 Select, one row per inventory file with count, size and latest date for every known class.
+Objects outside of the known classes make the counts disagree with the total, the file is then read as rows.
+'''
+
+
+def s3select_pushdown_inventory_csv(bucket_name, key, cols_names):
+    size_column = "CAST(COALESCE(NULLIF(s._{}, ''), '0') AS INT)".format(cols_names.index('Size') + 1)
+    last_column = "TO_TIMESTAMP(s._{})".format(cols_names.index('LastModifiedDate') + 1)
+    class_column = "s._{}".format(cols_names.index('StorageClass') + 1)
+    aggregates = ["SUM(CASE WHEN {} <> '' THEN 1 ELSE 0 END)".format(class_column)]
+    for storage_class in known_storage_classes:
+        match = "{} = '{}'".format(class_column, storage_class)
+        aggregates += ["SUM(CASE WHEN {} THEN 1 ELSE 0 END)".format(match),
+                       "SUM(CASE WHEN {} THEN {} ELSE 0 END)".format(match, size_column),
+                       "MAX(CASE WHEN {} THEN {} END)".format(match, last_column)]
+    req = bucket_client(bucket_name).select_object_content(
+        Bucket=bucket_name,
+        Key=key,
+        ExpressionType='SQL',
+        Expression="SELECT {} FROM s3object s".format(", ".join(aggregates)),
+        InputSerialization={'CompressionType': "GZIP",
+                            "CSV": {"FieldDelimiter": ",", 'AllowQuotedRecordDelimiter': False}},
+        OutputSerialization={'CSV': {}},
+    )
+    aggregate = StorageClassAggregate()
+    payload = []
     for event in req['Payload']:
         if "Records" in event:
-            records.append(event['Records']['Payload'].decode('utf-8'))
+            payload.append(event['Records']['Payload'])
         elif "Stats" in event:
-            stats = event['Stats']['Details']
-    file_str = "".join(r for r in records)
+            aggregate.add_scan_stats(event['Stats']['Details'])
+    rows = list(csv.reader(StringIO(b"".join(payload).decode('utf-8'))))
+    if len(rows) != 1 or len(rows[0]) != len(aggregates):
+        raise PushdownUnsupported("unexpected result {}".format(rows))
+    row = rows[0]
+    counted = 0
+    for index, storage_class in enumerate(known_storage_classes):
+        count, size, last_modified = row[1 + 3 * index:4 + 3 * index]
+        if int(count or 0) > 0:
+            aggregate.add(storage_class, int(count), int(size or 0), last_modified or None)
+            counted += int(count)
+    if counted != int(row[0] or 0):
+        raise PushdownUnsupported("{} objects outside of the known storage classes".format(int(row[0]) - counted))
     if settings._VERBOSE > 2:
-        print("s3select strlen: {}  records:{}".format(file_str.__len__(), records.__len__()))
-    df = pd.read_csv(StringIO(file_str), names=['Size', 'LastModifiedDate', 'StorageClass', 'EncryptionStatus'])
+        print("s3select pushdown {}: {} objects, {}".format(key, aggregate.count(), aggregate.scan_stats))
+    return aggregate
+
+
+def parse_select_records(text, aggregate, columns=inventory_columns):
+    if len(text.strip()) == 0:
+        return
+    aggregate.add_rows(decode_inventory_keys(pd.read_csv(
+        StringIO(text), header=None, names=columns, dtype={column: inventory_dtypes.get(column, str)
+                                                            for column in columns})))
+
+
+def inventory_read_columns(columns=None):
+    # The Key column is only read for --prefix-depth.
+    read_columns = inventory_columns + (['Key'] if settings._PREFIX_DEPTH > 0 else [])
+    return read_columns + [column for column in columns or [] if column not in read_columns]
+
 
-    aggr = df.groupby('StorageClass').agg({'StorageClass': 'count', 'Size': 'sum', 'LastModifiedDate': 'max'}).rename(
-        columns={'StorageClass': 'Count'}).reset_index()
-    if settings._VERBOSE > 4:
-        print(">>>>", aggr)
-    return aggr
+def decode_inventory_keys(chunk):
+    # Keys of CSV inventories are URL encoded.
+    if 'Key' in chunk:
+        chunk['Key'] = chunk['Key'].map(unquote_plus)
+    return chunk
 
 
 '''
@@ -421,30 +2306,129 @@ Analyse from compressed CSV file in the bucket
 '''
 
 
-def read_inventory_file(bucket_name, key, cols_names):
+def read_inventory_file(bucket_name, key, cols_names, columns=None, on_chunk=None):
+    # The object body is decompressed as a stream and parsed in chunks of --csv-chunk-rows rows, keeping only the
+    # columns needed, so peak memory does not depend on the size of the inventory file.
     if settings._VERBOSE > 1:
         print("read_inventory_file: {} {} {}".format(bucket_name, key, cols_names))
-    s3_client = boto3.client("s3", config=Config(s3={'use_accelerate_endpoint': True}))
-    try:
-        status = s3_client.get_bucket_accelerate_configuration(Bucket=bucket_name)['Status']
-        if settings._VERBOSE > 1:
-            print("Loading inventory '{:50}' using acceleration {}".format(key, status))
-    except Exception:
-        # Acceleration not possible
-        s3_client = s3
-    data = []
+    s3_client = inventory_transfer_client(bucket_name)
+    if settings._VERBOSE > 1:
+        print("Loading inventory '{:50}' using acceleration {}".format(key, get_acceleration(bucket_name)))
     if settings._VERBOSE > 2:
         print("read_inventory file: s3://{}/{}  Schema:{}".format(bucket_name, key, cols_names))
-    read_file = s3_client.get_object(Bucket=bucket_name, Key=key)
-    gzipfile = gzip.GzipFile(fileobj=BytesIO(read_file['Body'].read()))
+    usecols = inventory_read_columns(columns)
+    aggregate = StorageClassAggregate()
+    # Only the wait for the response is hedged, the body of a whole inventory file is read from the winner alone.
+    read_file = request_hedger.call('GetObject', s3_client.get_object,
+                                    discard=lambda response: response['Body'].close(), Bucket=bucket_name, Key=key)
+    with gzip.GzipFile(fileobj=read_file['Body']) as gzipfile:
+        for chunk in pd.read_csv(gzipfile, sep=',', header=None, names=cols_names, usecols=usecols,
+                                 dtype={column: inventory_dtypes.get(column, str) for column in usecols},
+                                 chunksize=max(1, settings._CSV_CHUNK_ROWS)):
+            aggregate.add_rows(decode_inventory_keys(chunk))
+            if on_chunk is not None:
+                on_chunk(chunk)
+    if settings._VERBOSE > 2:
+        print("read_inventory read {} objects from {}.".format(aggregate.count(), key))
+    return aggregate
+
 
-    df = pd.read_csv(gzipfile, sep=',', header=None, names=cols_names)
+'''
+Parquet and ORC inventories are read with pyarrow through ranged GETs: the footer first, then only the column chunks
+of the projected columns, one row group or stripe at a time.
+'''
+
+
+class S3RangedFile(RawIOBase):
+    '''
+    Seekable read only file over an S3 object, every read is a ranged GET.
+    '''
+
+    def __init__(self, client, bucket_name, key):
+        self._client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+        self.requests = 0
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self._position
+        elif whence == SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        end = min(self.size, self._position + len(buffer))
+        if end <= self._position:
+            return 0
+        data = request_hedger.call('GetObject', self.read_range, Range="bytes={}-{}".format(self._position, end - 1))
+        memoryview(buffer)[:len(data)] = data
+        self._position += len(data)
+        self.requests += 1
+        return len(data)
+
+    def read_range(self, Range):
+        # Ranges are small enough to be hedged as a whole, body included.
+        return self._client.get_object(Bucket=self.bucket_name, Key=self.key, Range=Range)['Body'].read()
+
+
+def columnar_inventory_name(column):
+    # Parquet and ORC inventories name the CSV fileSchema fields in snake case, LastModifiedDate is last_modified_date.
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", column).lower()
 
-    aggr = df.groupby('StorageClass').agg({'StorageClass': 'count', 'Size': 'sum', 'LastModifiedDate': 'max'}).rename(
-        columns={'StorageClass': 'Count'}).reset_index()
+
+def read_columnar_batches(bucket_name, key, cols_names, columns, on_chunk, batches):
+    if settings._VERBOSE > 1:
+        print("Loading inventory '{:50}' using acceleration {}".format(key, get_acceleration(bucket_name)))
+    usecols = inventory_read_columns(columns)
+    names = {columnar_inventory_name(column): column for column in usecols}
+    aggregate = StorageClassAggregate()
+    rawfile = S3RangedFile(inventory_transfer_client(bucket_name), bucket_name, key)
+    # ORC reads every stream of a stripe separately, buffering turns those into a few larger GETs.
+    for batch in batches(BufferedReader(rawfile, columnar_read_buffer), list(names)):
+        chunk = batch.to_pandas().rename(columns=names)
+        aggregate.add_rows(chunk)
+        if on_chunk is not None:
+            on_chunk(chunk)
     if settings._VERBOSE > 2:
-        print("read_inventory read {} objects from {}.".format(data.__len__(), key))
-    return aggr
+        print("read_inventory read {} objects from {} in {} requests.".format(aggregate.count(), key,
+                                                                             rawfile.requests))
+    return aggregate
+
+
+def read_parquet_inventory_file(bucket_name, key, cols_names=None, columns=None, on_chunk=None):
+    # cols_names is not needed, Parquet files carry their schema.
+    def batches(rawfile, names):
+        parquet_file = pyarrow.parquet.ParquetFile(rawfile)
+        for batch in parquet_file.iter_batches(batch_size=max(1, settings._CSV_CHUNK_ROWS), columns=names):
+            yield batch
+
+    return read_columnar_batches(bucket_name, key, cols_names, columns, on_chunk, batches)
+
+
+def read_orc_inventory_file(bucket_name, key, cols_names=None, columns=None, on_chunk=None):
+    # cols_names is not needed, ORC files carry their schema.
+    def batches(rawfile, names):
+        orc_file = pyarrow.orc.ORCFile(rawfile)
+        for stripe in range(orc_file.nstripes):
+            yield orc_file.read_stripe(stripe, columns=names)
+
+    return read_columnar_batches(bucket_name, key, cols_names, columns, on_chunk, batches)
+
+
+columnar_inventory_readers = {'Parquet': read_parquet_inventory_file, 'ORC': read_orc_inventory_file}
 
 
 def add_bool_arg(parser, name, default=False, description=""):
@@ -459,6 +2443,8 @@ def add_bool_arg(parser, name, default=False, description=""):
 def get_bucket_cost_for_storageclass(bucket_region, storageClass, storageSize):
     objects_size = storageSize / math.pow(1024, 3)
     pricing = get_priceDimensions_for_region_volume(bucket_region, storageClass)
+    if len(pricing) == 0:
+        return -1
     cost = 0
     while objects_size > 0:
         for x in pricing:
@@ -475,248 +2461,719 @@ def get_bucket_cost_for_storageclass(bucket_region, storageClass, storageSize):
     return -1
 
 
-def threaded_analyse_bucket_contents(bucket_name, result=None, i=0):
-    processing_start = time.perf_counter()
+def list_bucket_pages(bucket_name, shard):
+    # Paginated by hand so that every page can be hedged and a resumed shard starts from its continuation token.
+    s3_client = bucket_client(bucket_name)
+    kwargs = listing_kwargs(shard, {'Bucket': bucket_name, 'Prefix': shard.prefix, 'MaxKeys': 1000})
+    while True:
+        page = list_objects_page(s3_client, shard, kwargs)
+        yield page
+        if not page.get('IsTruncated'):
+            return
+        # A new dict per page, the parameters of a request already sent are never changed.
+        kwargs = dict(kwargs, ContinuationToken=page['NextContinuationToken'])
 
-    prefix = settings._KEY_PREFIX
+
+def listing_kwargs(shard, kwargs):
+    if shard.continuation_token is not None:
+        kwargs['ContinuationToken'] = shard.continuation_token
+    elif shard.last_key is not None:
+        kwargs['StartAfter'] = shard.last_key
+    elif shard.start_after:
+        kwargs['StartAfter'] = shard.start_after
+    return kwargs
+
+
+def list_objects_page(s3_client, shard, kwargs):
+    try:
+        page = request_hedger.call('ListObjectsV2', s3_client.list_objects_v2, **kwargs)
+    except ClientError as e:
+        # The continuation token of a checkpoint may no longer be accepted, the listing then goes on after the last
+        # key the checkpoint had seen.
+        if not shard.resumed or shard.last_key is None or 'ContinuationToken' not in kwargs:
+            raise
+        if settings._VERBOSE > 0:
+            print("Continuation token of bucket {} rejected ({}), resuming after {}".format(
+                kwargs['Bucket'], e.response.get('Error', {}).get('Code'), shard.last_key))
+        kwargs = {name: value for name, value in kwargs.items() if name != 'ContinuationToken'}
+        kwargs['StartAfter'] = shard.last_key
+        page = request_hedger.call('ListObjectsV2', s3_client.list_objects_v2, **kwargs)
+    shard.resumed = False
+    return page
+
+
+'''
+Sharded listing for buckets without inventory.
+Every shard lists its prefix with a '/' delimiter: objects directly under it are aggregated by the shard and every
+common prefix becomes a new shard, so the keyspace is discovered while it is being listed. Every --shard-split-pages
+pages, a shard that still has keys left hands part of its remaining key range to new shards when workers are idle.
+'''
+
+
+class ListShard(object):
+    def __init__(self, prefix, start_after="", end_before=None):
+        self.prefix = prefix
+        self.start_after = start_after
+        self.end_before = end_before
+        self.continuation_token = None
+        self.last_key = None
+        self.resumed = False
+        self.pages = 0
+        self.fetched = None
+        self.aggregate = StorageClassAggregate()
+
+    def to_state(self):
+        return dict(self.aggregate.to_state(), Prefix=self.prefix, StartAfter=self.start_after,
+                    EndBefore=self.end_before, Fetched=self.fetched)
+
+    def to_checkpoint(self):
+        # Unfinished shards have no Fetched time, their aggregate covers the pages up to the continuation token.
+        state = self.to_state()
+        state.update({'ContinuationToken': self.continuation_token, 'LastKey': self.last_key, 'Pages': self.pages})
+        return state
+
+
+def restore_list_shard(entry):
+    shard = ListShard(entry['Prefix'], entry['StartAfter'], entry['EndBefore'])
+    shard.fetched = entry['Fetched']
+    shard.continuation_token = entry.get('ContinuationToken')
+    shard.last_key = entry.get('LastKey')
+    shard.pages = entry.get('Pages', 0)
+    shard.resumed = shard.continuation_token is not None or shard.last_key is not None
+    shard.aggregate.add_state(entry)
+    return shard
+
+
+def shard_is_fresh(entry):
+    # Expiry is spread over the second half of --shard-ttl so the shards listed by one run are not all due again
+    # on the same later run.
+    key = "{}|{}|{}".format(entry['Prefix'], entry['StartAfter'], entry['EndBefore'])
+    spread = 1 - (zlib.crc32(key.encode('utf-8')) % 1000) / 2000.0
+    return entry['Fetched'] is not None and time.time() - entry['Fetched'] < settings._SHARD_TTL * 3600 * spread
+
+
+class ShardedLister(object):
     delimiter = "/"
-    start_after = ""
-    aggs = []
-    if settings._CACHE and os.path.isfile(bucket_name + ".cache"):
-        print("Processing via local Cache for bucket {}".format(bucket_name), end="\r")
-        aggs = read_cache_csv(bucket_name)
-    elif settings._INVENTORY:
-        inventory = get_inventory_configurations(bucket_name)
-        if inventory != "Disabled" and inventory.__len__() > 0:
-            print("Processing via Inventory for bucket {}".format(bucket_name), end="\r")
-            aggs = load_inventory_csv(bucket_name, inventory)
 
-    if aggs.__len__() == 0:
-        # at this point we could not find any data from the cache or inventory and we have to revert to listing all objects from the bucket
-        print("Processing via ListObjects for bucket {}".format(bucket_name), end="\r")
-        prefix = prefix[1:] if prefix.startswith(delimiter) else prefix
-        start_after = (start_after or prefix) if prefix.endswith(delimiter) else start_after
-        s3_paginator = s3.get_paginator("list_objects_v2")
-        if settings._CACHE and settings._REFRESHCACHE:
-            for p in s3_paginator.paginate(Bucket=bucket_name, Prefix=prefix, StartAfter=start_after,
-                                           PaginationConfig={'PageSize': 1000}):
-                write_cache_csv(bucket_name, p.get('Contents'))
+    def __init__(self, bucket_name, prefix, start_after, on_page=None, previous_shards=(), checkpoint=None,
+                 resume_shards=()):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.start_after = start_after
+        self.on_page = on_page
+        self.previous_shards = previous_shards
+        self.resume_shards = resume_shards
+        self.checkpoint = checkpoint
+        self.workers = max(1, settings._LIST_WORKERS)
+        self.shards = []
+        self.splits = 0
+        self.reused = 0
+        self.resumed = 0
+        # Prefixes that already have shards from the previous run or the checkpoint, listing a parent must not add
+        # them again.
+        self.known_prefixes = {entry['Prefix'] for entry in list(previous_shards) + list(resume_shards)}
+        self._client = bucket_client(bucket_name)
+        self._executor = None
+        self._lock = Lock()
+        self._page_lock = Lock()
+        # Held while a page is folded into its shard and while shards are split, so a checkpoint never sees an
+        # aggregate without its continuation token or a key range twice.
+        self._checkpoint_lock = Lock()
+        self._active = set()
+        self._finished = Condition(self._lock)
+        self._pending = 0
+        self._errors = []
+        self._stop = Event()
+        # Shards of an oversized bucket go to the shared work queue, see WorkQueue.
+        self._shared = bucket_name in oversized_buckets
+        self._futures = []
+
+    def run(self):
+        if self.checkpoint is not None:
+            self.checkpoint.snapshot = self.checkpoint_shards
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as self._executor:
+            for entry in self.resume_shards:
+                shard = restore_list_shard(entry)
+                self.resumed += 1
+                if shard.fetched is not None:
+                    with self._lock:
+                        self.shards.append(shard)
+                else:
+                    self.submit(shard)
+            for entry in self.previous_shards:
+                if shard_is_fresh(entry):
+                    with self._lock:
+                        self.shards.append(restore_list_shard(entry))
+                        self.reused += 1
+                else:
+                    self.submit(ListShard(entry['Prefix'], entry['StartAfter'], entry['EndBefore']))
+            if not self.previous_shards and not self.resume_shards:
+                self.submit(ListShard(self.prefix, self.start_after))
+            if self._shared:
+                for worker in range(self.workers):
+                    self._executor.submit(self.help_shared)
+            with self._lock:
+                while self._pending > 0:
+                    self._finished.wait()
+        if self._errors:
+            raise self._errors[0]
+        if settings._VERBOSE > 1:
+            print("Listed bucket {} in {} shards ({} splits, {} reused, {} resumed)".format(
+                self.bucket_name, len(self.shards), self.splits, self.reused, self.resumed))
+        aggregate = StorageClassAggregate()
+        for shard in self.shards:
+            aggregate.merge(shard.aggregate)
+        return aggregate
+
+    def submit(self, shard):
+        with self._lock:
+            self._pending += 1
+            self._active.add(shard)
+        if self._shared:
+            self._futures.append(shared_work.submit(profiler.bind(self._run_shard), shard))
+        else:
+            self._executor.submit(profiler.bind(self._run_shard), shard)
+
+    def help_shared(self):
+        while True:
+            with self._lock:
+                if self._pending == 0:
+                    return
+            shared_work.run_one(0.05)
+
+    def checkpoint_shards(self):
+        with self._checkpoint_lock:
+            with self._lock:
+                return [shard.to_checkpoint() for shard in self.shards + list(self._active)]
+
+    def idle_workers(self):
+        with self._lock:
+            return max(0, self.workers - self._pending)
+
+    def _run_shard(self, shard):
         try:
-            if settings._LOWMEMORY:
-                # low memory
-                datas = pd.concat((pd.DataFrame(d.get("Contents"),
-                                                columns=['StorageClass', 'Size', 'LastModified']).groupby(
-                    ['StorageClass']).agg({'StorageClass': 'count', 'Size': 'sum', 'LastModified': 'max'}).rename(
-                    columns={'StorageClass': 'Count'}) for d in
-                    s3_paginator.paginate(Bucket=bucket_name, Prefix=prefix, StartAfter=start_after,
-                                          PaginationConfig={'PageSize': 1000}))).groupby(
-                    'StorageClass').agg({'Count': 'sum', 'Size': 'sum', 'LastModified': 'max'})
-                aggs = (
-                    datas.groupby(['StorageClass']).agg({'Count': 'sum', 'Size': 'sum', 'LastModified': 'max'}).rename(
-                        columns={'StorageClass': 'Count'}).reset_index())
-            else:
-                # high memory
-                datas = pd.concat(
-                    pd.DataFrame(d.get("Contents"), columns=['StorageClass', 'Size', 'LastModified']) for d in
-                    s3_paginator.paginate(Bucket=bucket_name, Prefix=prefix, StartAfter=start_after,
-                                          PaginationConfig={'PageSize': 1000}))
-                aggs = (datas.groupby(['StorageClass']).agg(
-                    {'StorageClass': 'count', 'Size': 'sum', 'LastModified': 'max'}).rename(
-                    columns={'StorageClass': 'Count'}).reset_index())
-
+            if not self.list_shard(shard):
+                return
+            with self._checkpoint_lock:
+                shard.fetched = time.time()
+                with self._lock:
+                    self._active.discard(shard)
+                    self.shards.append(shard)
         except Exception as e:
-            if settings._VERBOSE > 1: print(e)
-            return []
+            self._stop.set()
+            with self._lock:
+                self._errors.append(e)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._finished.notify_all()
+
+    def list_shard(self, shard):
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': shard.prefix, 'Delimiter': self.delimiter, 'MaxKeys': 1000}
+        # Returns False when stopped by the error of another shard, the shard then stays unfinished in the checkpoint.
+        while not self._stop.is_set():
+            page = list_objects_page(self._client, shard, listing_kwargs(shard, kwargs))
+            shard.pages += 1
+            contents = page.get('Contents', [])
+            prefixes = [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+            done = not page.get('IsTruncated')
+            if shard.end_before is not None:
+                in_range = [obj for obj in contents if obj['Key'] < shard.end_before]
+                in_range_prefixes = [p for p in prefixes if p < shard.end_before]
+                done = done or len(in_range) < len(contents) or len(in_range_prefixes) < len(prefixes)
+                contents, prefixes = in_range, in_range_prefixes
+            page_aggregate = StorageClassAggregate()
+            page_aggregate.add_objects(contents)
+            if self.on_page is not None:
+                with self._page_lock:
+                    self.on_page(contents)
+            with self._checkpoint_lock:
+                # A common prefix belongs to the shard whose range holds the prefix itself, split ranges may see it
+                # twice.
+                for prefix in prefixes:
+                    if prefix > shard.start_after and prefix not in self.known_prefixes:
+                        self.submit(ListShard(prefix))
+                shard.aggregate.merge(page_aggregate)
+                shard.last_key = max([obj['Key'] for obj in contents[-1:]] + prefixes[-1:] + [shard.last_key or ""])
+                shard.continuation_token = None if done else page['NextContinuationToken']
+            if self.checkpoint is not None:
+                self.checkpoint.maybe_write()
+            if done:
+                return True
+            if shard.pages % max(1, settings._SHARD_SPLIT_PAGES) == 0:
+                idle = self.idle_workers()
+                if idle > 0:
+                    last = max([obj['Key'] for obj in contents[-1:]] + prefixes[-1:] + [shard.start_after])
+                    self.split_shard(shard, last, idle + 1)
+        return False
+
+    def has_keys_after(self, shard, start_after):
+        if shard.end_before is not None and start_after >= shard.end_before:
+            return False
+        probe = self._client.list_objects_v2(Bucket=self.bucket_name, Prefix=shard.prefix, StartAfter=start_after,
+                                             Delimiter=self.delimiter, MaxKeys=1)
+        first = [obj['Key'] for obj in probe.get('Contents', [])] + [p['Prefix'] for p in
+                                                                     probe.get('CommonPrefixes', [])]
+        return len(first) > 0 and (shard.end_before is None or min(first) < shard.end_before)
+
+    def split_shard(self, shard, last, pieces):
+        # Python compares strings by code point which matches the UTF-8 binary order S3 lists keys in, so bumping a
+        # character of the last listed key skips every key sharing the characters before it. Find the shallowest
+        # character whose bump still leaves keys, binary search how far that character goes in the printable range
+        # and cut that range in even pieces. Keys are rarely spread evenly, so every step is checked with a probe.
+        for position in range(len(shard.prefix), min(len(last), len(shard.prefix) + 16)):
+            low = ord(last[position])
+            if low >= 0x7e or not self.has_keys_after(shard, last[:position] + chr(low + 1)):
+                continue
+            found, high = low + 1, 0x7f
+            while high - found > 1:
+                middle = (found + high) // 2
+                if self.has_keys_after(shard, last[:position] + chr(middle)):
+                    found = middle
+                else:
+                    high = middle
+            pieces = min(pieces, found - low + 1)
+            bounds = sorted({last[:position] + chr(low + max(1, (found + 1 - low) * i // pieces))
+                             for i in range(1, pieces)})
+            if not bounds:
+                return
+            # StartAfter excludes the bound from the shard starting there, so the shard ending there keeps it:
+            # bound + "\0" is the first string after the bound, an exclusive end just past it.
+            with self._checkpoint_lock:
+                end_before = shard.end_before
+                shard.end_before = bounds[0] + "\0"
+                for start_after, end in zip(bounds, [bound + "\0" for bound in bounds[1:]] + [end_before]):
+                    self.submit(ListShard(shard.prefix, start_after, end))
+            with self._lock:
+                self.splits += len(bounds)
+            return
+
+
+def listing_prefix():
+    # Prefix and StartAfter of the listing for --key-prefix.
+    delimiter = "/"
+    prefix = settings._KEY_PREFIX
+    prefix = prefix[1:] if prefix.startswith(delimiter) else prefix
+    return prefix, prefix if prefix.endswith(delimiter) else ""
+
+
+def list_bucket_aggregates(bucket_name):
+    # Pages are folded into the aggregate as they arrive so memory does not grow with the size of the bucket.
+    prefix, start_after = listing_prefix()
+    # With -cache the per shard aggregates are kept in the refresh state, shards younger than --shard-ttl are
+    # reused instead of listed again. A serial listing is a single shard.
+    scope = {'Prefix': prefix, 'StartAfter': start_after, 'Sharded': settings._SHARDED}
+    if prefix_scope() is not None:
+        scope['PrefixScope'] = prefix_scope()
+    state = read_refresh_state(bucket_name) if settings._CACHE else {}
+    listing = state.get('Listing', {})
+    previous_shards = listing.get('Shards', []) if listing.get('Scope') == scope else []
+    resume_shards = read_listing_checkpoint(bucket_name, scope) if settings._RESUME else []
+    if resume_shards:
+        # The checkpoint is newer than anything in the refresh state.
+        previous_shards = []
+        if settings._VERBOSE > 0:
+            print("Resuming the listing of bucket {} from its checkpoint".format(bucket_name))
+    checkpoint = ListingCheckpoint(bucket_name, scope)
+    writer = None
+    on_page = None
+    if settings._CACHE:
+        writer = ObjectCacheWriter(bucket_name, settings._CACHE_KEYS or settings._PREFIX_DEPTH > 0, prefix)
+        on_page = writer.append
+    try:
+        if settings._SHARDED:
+            lister = ShardedLister(bucket_name, prefix, start_after, on_page, previous_shards, checkpoint,
+                                   resume_shards)
+            aggregate = lister.run()
+            shards, reused = lister.shards, lister.reused + lister.resumed
+        elif len(previous_shards) == 1 and shard_is_fresh(previous_shards[0]):
+            shards, reused = [restore_list_shard(previous_shards[0])], 1
+            aggregate = StorageClassAggregate().merge(shards[0].aggregate)
+        else:
+            shard = restore_list_shard(resume_shards[0]) if resume_shards else ListShard(prefix, start_after)
+            checkpoint.snapshot = lambda: [shard.to_checkpoint()]
+            if shard.fetched is None:
+                for page in list_bucket_pages(bucket_name, shard):
+                    contents = page.get('Contents', [])
+                    if on_page is not None:
+                        on_page(contents)
+                    shard.aggregate.add_objects(contents)
+                    shard.pages += 1
+                    shard.last_key = contents[-1]['Key'] if contents else shard.last_key
+                    shard.continuation_token = page.get('NextContinuationToken')
+                    checkpoint.maybe_write()
+                shard.fetched = time.time()
+            shards, reused = [shard], len(resume_shards)
+            aggregate = StorageClassAggregate().merge(shard.aggregate)
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        # Whatever was listed since the last checkpoint is kept for -resume.
+        checkpoint.write()
+        raise
+    checkpoint.remove()
+    if writer is not None:
+        if reused == 0:
+            writer.close()
+        else:
+            # Reused shards were not listed so the object cache would be incomplete, and stale if any was listed.
+            writer.abort()
+            if reused < len(shards):
+                remove_object_cache(bucket_name)
+        if settings._VERBOSE > 1:
+            print("Bucket {}: {} of {} listing shards reused".format(bucket_name, reused, len(shards)))
+        state['Listing'] = {'Scope': scope, 'Shards': [shard.to_state() for shard in shards]}
+        write_refresh_state(bucket_name, state)
+    return aggregate
 
-    bucket_objects = aggs['Count'].sum()
-    bucket_size = aggs['Size'].sum()
-    if 'LastModified' in aggs:
-        bucket_last = aggs['LastModified'].max()
-    else:
-        bucket_last = aggs['LastModifiedDate'].max()
+
+def build_bucket_stats(bucket_name, aggs, bucket_region, inventory, processing_start):
+    bucket_objects = aggs.count()
+    bucket_size = aggs.size()
+    bucket_last = aggs.last_modified()
 
     bucket_cost = 0.0
-    bucket = boto3.resource("s3").Bucket(bucket_name)
-    bucket_region = get_region(bucket_name)
-    content = aggs.to_dict('rows')
-    for storageClass in content:
-        cost = get_bucket_cost_for_storageclass(bucket_region, storageClass['StorageClass'], storageClass['Size'])
-        if cost > 0:
-            storageClass['Cost'] = "${:,.2f}".format(cost)
-            bucket_cost += cost
+    if bucket_region is None:
+        bucket_region = get_region(bucket_name)
+    content = aggs.to_content()
+    class_costs = {}
+    with profiler.phase(bucket_name, 'Cost'):
+        for storageClass in content:
+            # Inventory sizes are parsed as floats and cached ones are numpy integers, bytes are written as integers.
+            storageClass['Size'] = int(storageClass['Size'])
+            if storageClass['Count'] is not None:
+                storageClass['Count'] = int(storageClass['Count'])
+            cost = get_bucket_cost_for_storageclass(bucket_region, storageClass['StorageClass'], storageClass['Size'])
+            if cost > 0:
+                storageClass['Cost'] = "${:,.2f}".format(cost)
+                storageClass['CostUSD'] = round(cost, 6)
+                class_costs[storageClass['StorageClass']] = cost
+                bucket_cost += cost
 
     if bucket_cost > 0:
         bucket_cost_str = "${:,.2f}".format(bucket_cost)
     else:
         bucket_cost_str = "n/a"
-    bucket_stats = [
-        {
-            'Name': bucket_name,
-            'CreationDate': str(bucket.creation_date),
-            'LastModified': str(bucket_last),
-            'Versioning': get_versioning(bucket_name),
-            'WebSite': get_website(bucket_name),
-            'Analytics': get_analytics(bucket_name),
-            'Acceleration': get_acceleration(bucket_name),
-            'Replication': get_replication(bucket_name),
-            'Policy': get_policy(bucket_name),
-            'ObjectLock': get_object_lock_configuration(bucket_name),
-            'Inventory': get_inventory_configurations(bucket_name),
-            'Region': bucket_region,
-            'LocationConstraint': get_location(bucket_name),
-            'Grantee': get_grantees(bucket_name),
-            'Encryption': get_encryption(bucket_name),
-            'Size': display_size(bucket_size),
-            'Count': bucket_objects,
-            'Cost': bucket_cost_str,
-            'Content': content
-        }
-    ]
 
-    global grand_total_cost
-    global grand_total_size
-    global grand_total_objects
-    grand_total_cost += round(bucket_cost, 2)
-    grand_total_objects += bucket_objects
-    grand_total_size += bucket_size
+    with profiler.phase(bucket_name, 'Metadata'):
+        metadata, metadata_latency = collect_bucket_metadata(bucket_name, inventory)
+    stats = {
+        'Name': bucket_name,
+        'CreationDate': get_creation_date(bucket_name),
+        'LastModified': None if bucket_last is None else str(bucket_last)
+    }
+    stats.update(metadata)
+    stats.update({
+        'Region': bucket_region,
+        'Size': display_size(bucket_size),
+        'SizeBytes': int(bucket_size),
+        'Count': int(bucket_objects),
+        'Cost': bucket_cost_str,
+        'CostUSD': round(bucket_cost, 6) if bucket_cost > 0 else None,
+        'Content': content
+    })
+    if aggs.prefixes is not None:
+        stats['Prefixes'] = aggs.prefixes.to_content(
+            {storage_class: entry[1] for storage_class, entry in aggs.classes.items()}, class_costs)
+        collapsed = [entry for entry in stats['Prefixes'] if entry['Prefix'].endswith(PrefixAggregate.other)]
+        if collapsed and settings._VERBOSE > 0:
+            print("Bucket {}: prefixes beyond --max-prefixes {} are collapsed in '*' entries".format(
+                bucket_name, settings._MAX_PREFIXES))
+    if aggs.scan_stats:
+        stats['S3SelectStats'] = aggs.scan_stats
+    if isinstance(aggs, MetricsAggregate):
+        stats['MetricsTimestamp'] = str(aggs.timestamp)
+    requests_made = request_counters.get(bucket_name)
+    if requests_made['Retries'] > 0 or requests_made['Throttles'] > 0:
+        stats['Requests'] = requests_made
+    if metadata_latency:
+        # Seconds per configuration section, the sections are fetched concurrently.
+        stats['MetadataLatency'] = metadata_latency
+    bucket_stats = [stats]
+
+    # A daemon refreshes the same buckets over and over, its totals are those of the latest stats of every bucket.
+    if daemon_state is None:
+        run_totals.add(bucket_objects, bucket_size, round(bucket_cost, 2))
 
     bucket_processing_time = timedelta(milliseconds=round(1000 * (time.perf_counter() - processing_start)))
+    if settings._PROFILE:
+        stats['Profile'] = profiler.bucket_profile(bucket_name, time.perf_counter() - processing_start)
+    if output_sink is not None:
+        output_sink.write(stats)
+    return bucket_stats, bucket_processing_time
+
+
+'''
+Buckets are scheduled largest first, from an estimate of their number of objects: the --source cloudwatch metrics, the
+previous run's refresh state or object cache, or the file sizes of the latest inventory manifest. Only what is local
+or fetched by the run anyway is used, buckets without any of these are estimated at 0 and left to work stealing.
+'''
+
+
+def estimate_bucket_objects(bucket_name):
+    if bucket_name in bucket_metrics:
+        return bucket_metrics[bucket_name].count()
+    try:
+        state = read_refresh_state(bucket_name)
+        if 'Aggregate' in state.get('Inventory', {}):
+            return StorageClassAggregate().add_entries(state['Inventory']['Aggregate']).count()
+        if state.get('Listing', {}).get('Shards'):
+            return sum(entry[1] for shard in state['Listing']['Shards'] for entry in shard['Aggregate'])
+        meta = read_object_cache_meta(object_cache_path(bucket_name))
+        if meta is not None:
+            return meta['Rows']
+        if settings._INVENTORY:
+            for inventory in get_inventory_configurations(bucket_name):
+                if inventory['IsEnabled'] and inventory['Format'] in inventory_formats:
+                    manifest = load_manifest(inventory['Bucket'], find_latest_inventory_manifest_key(
+                        bucket_name, inventory['Bucket'], inventory['Id'], inventory.get('Prefix', "")))
+                    return sum(f.get('size', 0) for f in manifest['files']) // inventory_bytes_per_object[
+                        inventory['Format']]
+        return 0
+    except Exception as e:
+        if settings._VERBOSE > 1:
+            print("Could not estimate the size of bucket {}: {}".format(bucket_name, e))
+        return 0
+
+
+def schedule_buckets(bucket_names, concurrency):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, settings._REGION_WORKERS)) as executor:
+        estimates = dict(zip(bucket_names, executor.map(estimate_bucket_objects, bucket_names)))
+    ordered = sorted(bucket_names, key=lambda bucket_name: estimates[bucket_name], reverse=True)
+    # A bucket holding more than its share of the run would otherwise finish long after every other worker.
+    total = sum(estimates.values())
+    if len(bucket_names) > 1 and settings._THREADED in (2, 3):
+        oversized_buckets.update(b for b in bucket_names if estimates[b] * max(1, concurrency) > total > 0)
+    if settings._VERBOSE > 1:
+        print("Bucket estimates (objects): {}, split: {}".format(
+            {bucket_name: estimates[bucket_name] for bucket_name in ordered}, sorted(oversized_buckets)))
+    return ordered
+
+
+'''
+--source cloudwatch: sizes and counts come from the BucketSizeBytes and NumberOfObjects metrics S3 publishes daily.
+Per region, ListMetrics finds the bucket/storage type pairs that exist and GetMetricData fetches up to 500 of them per
+call. Buckets without metrics, new or empty ones, go through the cache/inventory/listing path.
+'''
+
+
+def fetch_bucket_metrics(bucket_regions_map):
+    by_region = {}
+    for bucket_name, region in bucket_regions_map.items():
+        if region is not None:
+            by_region.setdefault(region, set()).add(bucket_name)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(by_region), settings._REGION_WORKERS))) \
+            as executor:
+        futures = {executor.submit(fetch_region_bucket_metrics, region, bucket_names): region
+                   for region, bucket_names in by_region.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                bucket_metrics.update(future.result())
+            except Exception as e:
+                print("Could not fetch CloudWatch metrics for region {}: {}".format(futures[future], e))
+    if settings._VERBOSE > 0:
+        print("CloudWatch metrics found for {} of {} buckets".format(len(bucket_metrics), len(bucket_regions_map)))
+
+
+def fetch_region_bucket_metrics(region, bucket_names):
+    cloudwatch = client_pool.get('cloudwatch', region)
+    metrics = []
+    for metric_name in ('NumberOfObjects', 'BucketSizeBytes'):
+        for page in cloudwatch.get_paginator('list_metrics').paginate(Namespace='AWS/S3', MetricName=metric_name):
+            for metric in page['Metrics']:
+                dimensions = {d['Name']: d['Value'] for d in metric['Dimensions']}
+                if dimensions.get('BucketName') in bucket_names and (
+                        dimensions.get('StorageType') in cloudwatch_storage_types or
+                        metric_name == 'NumberOfObjects' and dimensions.get('StorageType') == 'AllStorageTypes'):
+                    metrics.append(metric)
+    end = datetime.now(timezone.utc)
+    latest = {}
+    for batch in range(0, len(metrics), cloudwatch_metrics_per_call):
+        queries = [{'Id': "m{}".format(index), 'ReturnData': True,
+                    'MetricStat': {'Metric': metric, 'Period': 86400, 'Stat': 'Average'}}
+                   for index, metric in enumerate(metrics[batch:batch + cloudwatch_metrics_per_call], batch)]
+        kwargs = {'MetricDataQueries': queries, 'StartTime': end - timedelta(days=3), 'EndTime': end,
+                  'ScanBy': 'TimestampDescending'}
+        while True:
+            response = cloudwatch.get_metric_data(**kwargs)
+            for result in response['MetricDataResults']:
+                if result['Values'] and result['Id'] not in latest:
+                    latest[result['Id']] = (result['Values'][0], result['Timestamps'][0])
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+    objects = {}
+    sizes = {}
+    for index, metric in enumerate(metrics):
+        if "m{}".format(index) not in latest:
+            continue
+        value, timestamp = latest["m{}".format(index)]
+        dimensions = {d['Name']: d['Value'] for d in metric['Dimensions']}
+        if metric['MetricName'] == 'NumberOfObjects':
+            objects[dimensions['BucketName']] = (int(value), timestamp)
+        else:
+            sizes.setdefault(dimensions['BucketName'], []).append(
+                (cloudwatch_storage_types[dimensions['StorageType']], int(value)))
+    aggregates = {}
+    for bucket_name, (count, timestamp) in objects.items():
+        aggregate = MetricsAggregate(count, timestamp)
+        for storage_class, size in sizes.get(bucket_name, []):
+            aggregate.add(storage_class, 0, size, None)
+        aggregates[bucket_name] = aggregate
+    return aggregates
+
+
+def metrics_aggregate(bucket_name):
+    aggregate = bucket_metrics[bucket_name]
+    if settings._METRICS_FALLBACK and aggregate.detail is None:
+        try:
+            aggregate.detail = metrics_detail(bucket_name)
+        except Exception as e:
+            # The metrics are still right, only the fields they cannot provide stay null.
+            print("Could not read the per class counts of bucket {}: {}".format(bucket_name, e), file=sys.stderr)
+    return aggregate
+
+
+def metrics_detail(bucket_name):
+    # Only from what is cheap to read: the object cache or the latest inventory. Listing the bucket would cost more
+    # than the whole metrics run.
+    if object_cache_usable(bucket_name):
+        with profiler.phase(bucket_name, 'Cache'):
+            return read_object_cache(bucket_name)
+    if settings._INVENTORY:
+        with profiler.phase(bucket_name, 'Inventory'):
+            inventory = get_inventory_configurations(bucket_name)
+            if inventory != "Disabled" and len(inventory) > 0:
+                detail = load_inventory(bucket_name, inventory)
+                if len(detail) > 0:
+                    return detail
+    return None
+
+
+def bounded_analyse_bucket_contents(slots, *args):
+    try:
+        threaded_analyse_bucket_contents(*args)
+    finally:
+        slots.release()
+
+
+def threaded_analyse_bucket_contents(bucket_name, result=None, i=0, bucket_region=None):
+    processing_start = time.perf_counter()
+
+    aggs = []
+    inventory = None
+    if bucket_name in bucket_metrics:
+        print("Processing via CloudWatch metrics for bucket {}".format(bucket_name), end="\r")
+        aggs = metrics_aggregate(bucket_name)
+    elif object_cache_usable(bucket_name):
+        print("Processing via local Cache for bucket {}".format(bucket_name), end="\r")
+        with profiler.phase(bucket_name, 'Cache'):
+            aggs = read_object_cache(bucket_name)
+    elif settings._INVENTORY:
+        with profiler.phase(bucket_name, 'Inventory'):
+            try:
+                inventory = get_inventory_configurations(bucket_name)
+            except Exception as e:
+                run_totals.add_failure(bucket_name, e)
+                return []
+            if inventory != "Disabled" and inventory.__len__() > 0:
+                print("Processing via Inventory for bucket {}".format(bucket_name), end="\r")
+                try:
+                    aggs = load_inventory(bucket_name, inventory)
+                except Exception as e:
+                    run_totals.add_failure(bucket_name, e)
+                    return []
+
+    if aggs.__len__() == 0:
+        # at this point we could not find any data from the cache or inventory and we have to revert to listing all objects from the bucket
+        print("Processing via ListObjects for bucket {}".format(bucket_name), end="\r")
+        try:
+            with profiler.phase(bucket_name, 'Listing'):
+                aggs = list_bucket_aggregates(bucket_name)
+        except Exception as e:
+            run_totals.add_failure(bucket_name, e)
+            return []
+
+    try:
+        bucket_stats, bucket_processing_time = build_bucket_stats(bucket_name, aggs, bucket_region, inventory,
+                                                                  processing_start)
+    except Exception as e:
+        run_totals.add_failure(bucket_name, e)
+        return []
 
     if result is not None:
         result[i] = bucket_stats, bucket_processing_time
     else:
         return bucket_stats, bucket_processing_time, "{:60}{:>30}{:>20}{:>20}{:>30}{:>20}{:>40}".format(
             bucket_stats[0].get('Name'),
-            bucket_stats[0]['CreationDate'],
+            str(bucket_stats[0]['CreationDate']),
             bucket_stats[0]['Count'],
-            bucket_stats[0]['Size'], bucket_stats[0]['LastModified'],
+            bucket_stats[0]['Size'], str(bucket_stats[0]['LastModified']),
             bucket_stats[0]['Cost'],
             str(bucket_processing_time))
 
     print(
         "{:60}{:>30}{:>20}{:>20}{:>30}{:>20}{:>40}".format(bucket_stats[0].get('Name'),
-                                                           bucket_stats[0]['CreationDate'],
+                                                           str(bucket_stats[0]['CreationDate']),
                                                            bucket_stats[0]['Count'],
-                                                           bucket_stats[0]['Size'], bucket_stats[0]['LastModified'],
+                                                           bucket_stats[0]['Size'],
+                                                           str(bucket_stats[0]['LastModified']),
                                                            bucket_stats[0]['Cost'],
                                                            str(bucket_processing_time)),
         file=sys.stderr)
 
 
-def analyse_bucket_contents(bucket_name):
+def analyse_bucket_contents(bucket_name, bucket_region=None):
     processing_start = time.perf_counter()
 
-    prefix = settings._KEY_PREFIX
-    delimiter = "/"
-    start_after = ""
     aggs = []
-    if settings._CACHE and os.path.isfile(bucket_name + ".cache"):
+    inventory = None
+    if bucket_name in bucket_metrics:
+        print("Processing via CloudWatch metrics for bucket {}".format(bucket_name), end="\r")
+        aggs = metrics_aggregate(bucket_name)
+    elif object_cache_usable(bucket_name):
         print("Processing via local Cache for bucket {}".format(bucket_name), end="\r")
-        aggs = read_cache_csv(bucket_name)
+        with profiler.phase(bucket_name, 'Cache'):
+            aggs = read_object_cache(bucket_name)
     elif settings._INVENTORY:
-        inventory = get_inventory_configurations(bucket_name)
-        if inventory != "Disabled" and inventory.__len__() > 0:
-            print("Processing via Inventory for bucket {}".format(bucket_name), end="\r")
-            aggs = load_inventory_csv(bucket_name, inventory)
-        elif settings._PUT_INVENTORY:
-           put_inventory_configuration(bucket_name)
+        with profiler.phase(bucket_name, 'Inventory'):
+            try:
+                inventory = get_inventory_configurations(bucket_name)
+            except Exception as e:
+                run_totals.add_failure(bucket_name, e)
+                return []
+            if inventory != "Disabled" and inventory.__len__() > 0:
+                print("Processing via Inventory for bucket {}".format(bucket_name), end="\r")
+                try:
+                    aggs = load_inventory(bucket_name, inventory)
+                except Exception as e:
+                    run_totals.add_failure(bucket_name, e)
+                    return []
+            elif settings._PUT_INVENTORY:
+               put_inventory_configuration(bucket_name)
 
     if aggs.__len__() == 0:
         # at this point we could not find any data from the cache or inventory and we have to revert to listing all objects from the bucket
         print("Processing via ListObjects for bucket {}".format(bucket_name), end="\r")
-        prefix = prefix[1:] if prefix.startswith(delimiter) else prefix
-        start_after = (start_after or prefix) if prefix.endswith(delimiter) else start_after
-        s3_paginator = s3.get_paginator("list_objects_v2")
-        if settings._CACHE and settings._REFRESHCACHE:
-            for p in s3_paginator.paginate(Bucket=bucket_name, Prefix=prefix, StartAfter=start_after,
-                                           PaginationConfig={'PageSize': 1000}):
-                write_cache_csv(bucket_name, p.get('Contents'))
         try:
-            if settings._LOWMEMORY:
-                # low memory
-                datas = pd.concat((pd.DataFrame(d.get("Contents"),
-                                                columns=['StorageClass', 'Size', 'LastModified']).groupby(
-                    ['StorageClass']).agg({'StorageClass': 'count', 'Size': 'sum', 'LastModified': 'max'}).rename(
-                    columns={'StorageClass': 'Count'}) for d in
-                    s3_paginator.paginate(Bucket=bucket_name, Prefix=prefix, StartAfter=start_after,
-                                          PaginationConfig={'PageSize': 1000}))).groupby(
-                    'StorageClass').agg({'Count': 'sum', 'Size': 'sum', 'LastModified': 'max'})
-                aggs = (
-                    datas.groupby(['StorageClass']).agg({'Count': 'sum', 'Size': 'sum', 'LastModified': 'max'}).rename(
-                        columns={'StorageClass': 'Count'}).reset_index())
-            else:
-                # high memory
-                datas = pd.concat(
-                    pd.DataFrame(d.get("Contents"), columns=['StorageClass', 'Size', 'LastModified']) for d in
-                    s3_paginator.paginate(Bucket=bucket_name, Prefix=prefix, StartAfter=start_after,
-                                          PaginationConfig={'PageSize': 1000}))
-                aggs = (datas.groupby(['StorageClass']).agg(
-                    {'StorageClass': 'count', 'Size': 'sum', 'LastModified': 'max'}).rename(
-                    columns={'StorageClass': 'Count'}).reset_index())
-
+            with profiler.phase(bucket_name, 'Listing'):
+                aggs = list_bucket_aggregates(bucket_name)
         except Exception as e:
-            if settings._VERBOSE > 1: print(e)
+            run_totals.add_failure(bucket_name, e)
             return []
 
-    bucket_objects = aggs['Count'].sum()
-    bucket_size = aggs['Size'].sum()
-    if 'LastModified' in aggs:
-        bucket_last = aggs['LastModified'].max()
-    else:
-        bucket_last = aggs['LastModifiedDate'].max()
-
-    bucket_cost = 0.0
-    bucket = boto3.resource("s3").Bucket(bucket_name)
-    bucket_region = get_region(bucket_name)
-    content = aggs.to_dict('rows')
-    for storageClass in content:
-        cost = get_bucket_cost_for_storageclass(bucket_region, storageClass['StorageClass'], storageClass['Size'])
-        if cost > 0:
-            storageClass['Cost'] = "${:,.2f}".format(cost)
-            bucket_cost += cost
-
-    if bucket_cost > 0:
-        bucket_cost_str = "${:,.2f}".format(bucket_cost)
-    else:
-        bucket_cost_str = "n/a"
-    bucket_stats = [
-        {
-            'Name': bucket_name,
-            'CreationDate': str(bucket.creation_date),
-            'LastModified': str(bucket_last),
-            'Versioning': get_versioning(bucket_name),
-            'WebSite': get_website(bucket_name),
-            'Analytics': get_analytics(bucket_name),
-            'Acceleration': get_acceleration(bucket_name),
-            'Replication': get_replication(bucket_name),
-            'Policy': get_policy(bucket_name),
-            'ObjectLock': get_object_lock_configuration(bucket_name),
-            'Inventory': get_inventory_configurations(bucket_name),
-            'Region': bucket_region,
-            'LocationConstraint': get_location(bucket_name),
-            'Grantee': get_grantees(bucket_name),
-            'Encryption': get_encryption(bucket_name),
-            'Size': display_size(bucket_size),
-            'Count': bucket_objects,
-            'Cost': bucket_cost_str,
-            'Content': content
-        }
-    ]
-
-    global grand_total_cost
-    global grand_total_size
-    global grand_total_objects
-    grand_total_cost += round(bucket_cost, 2)
-    grand_total_objects += bucket_objects
-    grand_total_size += bucket_size
-
-    bucket_processing_time = timedelta(milliseconds=round(1000 * (time.perf_counter() - processing_start)))
+    try:
+        bucket_stats, bucket_processing_time = build_bucket_stats(bucket_name, aggs, bucket_region, inventory,
+                                                                  processing_start)
+    except Exception as e:
+        run_totals.add_failure(bucket_name, e)
+        return []
 
     yield bucket_stats, bucket_processing_time
 
 
 def load_aws_pricing(region, vol):
-    pricing = boto3.client('pricing', "us-east-1")
+    pricing = client_pool.get('pricing', "us-east-1")
     prefix = "/"
     delimiter = "/"
     start_after = ""
@@ -740,16 +3197,23 @@ def load_aws_pricing(region, vol):
 
             return json.loads(p.get('PriceList')[0])
     except Exception as e:
+        # Still throttled after every retry: failing the bucket beats reporting it without a cost.
+        if is_throttling_error(e):
+            raise
         print("EXCEPTION in get_products(region={},vol={}, loc={})".format(region, vol, loc), e)
     return {'terms': {'OnDemand': []}}
 
 
 def describe_region(region_id):
+    return region_names.get(region_id, lambda: lookup_region_name(region_id))
+
+
+def lookup_region_name(region_id):
     # First try via API, this would allow to pickup on new regions as they arise but does requires more permissions.
     try:
         # ec2 = boto3.client("ec2")
         # ec2_responses = ec2.describe_regions()
-        ssm_client = boto3.client('ssm')
+        ssm_client = client_pool.get('ssm')
         tmp = '/aws/service/global-infrastructure/regions/%s/longName' % region_id
         ssm_response = ssm_client.get_parameter(Name=tmp)
         region_name = ssm_response['Parameter']['Value']
@@ -776,7 +3240,50 @@ def describe_region(region_id):
     return region_name
 
 
+'''
+Price tables are memoized per (region, volumeType) for the run and persisted in the cache directory
+so that warm runs do not need to call the Pricing API or SSM at all.
+'''
+
+
 def get_priceDimensions_for_region_volume(region, volumeType):
+    return price_tables.get((region, volumeType), lambda: load_price_table(region, volumeType))
+
+
+def load_price_table_disk_cache():
+    global price_table_entries
+    with price_table_lock:
+        if price_table_entries is None:
+            if settings._REFRESH_PRICING:
+                price_table_entries = {}
+            else:
+                price_table_entries = read_json_cache(pricing_cache_name).get('Entries', {})
+        return price_table_entries
+
+
+def save_price_table(region, volumeType, price_dimensions):
+    entries = load_price_table_disk_cache()
+    with price_table_lock:
+        entries["{}|{}".format(region, volumeType)] = {'Fetched': time.time(), 'PriceDimensions': price_dimensions}
+        try:
+            write_json_cache(pricing_cache_name, {'Version': 1, 'Entries': entries})
+        except OSError as e:
+            if settings._VERBOSE > 1:
+                print("Could not write pricing cache:", e)
+
+
+def load_price_table(region, volumeType):
+    entry = load_price_table_disk_cache().get("{}|{}".format(region, volumeType))
+    if entry is not None and time.time() - entry['Fetched'] < settings._PRICING_TTL * 3600:
+        return entry['PriceDimensions']
+    price_dimensions = fetch_price_dimensions(region, volumeType)
+    # Failed lookups are only memoized for this run, never persisted.
+    if len(price_dimensions) > 0:
+        save_price_table(region, volumeType, price_dimensions)
+    return price_dimensions
+
+
+def fetch_price_dimensions(region, volumeType):
     volume_types = {
         "STANDARD": "Standard",
         "STANDARD_IA": "Standard - Infrequent Access",
@@ -799,6 +3306,280 @@ def get_priceDimensions_for_region_volume(region, volumeType):
     return sorted(price_dimensions, key=lambda i: int(i['beginRange']))
 
 
+def select_buckets(listed_buckets):
+    # Buckets matching --list-regex plus the ones named by --buckets, in a region matching --region-regex.
+    bucket_list = []
+    if settings._BUCKET_LIST_REGEX is not None:
+        bucket_list = [i['Name'] for i in listed_buckets if re.match(settings._BUCKET_LIST_REGEX, i['Name'])]
+    # If no bucket found we simply assume that the parameter is a targeted bucket name
+    if settings._BUCKETS is not None:
+        bucket_list.extend(settings._BUCKETS)
+    bucket_list = list(dict.fromkeys(bucket_list))
+    bucket_regions_map = resolve_bucket_regions(bucket_list)
+    bucket_list = [b for b in bucket_list if re.match(settings._REGION_FILTER, bucket_regions_map.get(b) or '')]
+    return bucket_list, bucket_regions_map
+
+
+'''
+-daemon: the process stays up with its clients, price tables, bucket regions and the latest stats of every bucket in
+memory, and refreshes each bucket --refresh-interval hours after its previous refresh. The second refreshes are spread
+over the second half of the interval so the buckets of the first pass do not stay in step. The latest stats are served
+on --listen: /stats as JSON, /stats/<bucket> for one bucket and /metrics in the Prometheus text format, rendered once
+per change so a scrape does not depend on the number of buckets.
+'''
+
+
+class DaemonState(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.refreshes = 0
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._buckets = {}
+        self._regions = {}
+        self._due = {}
+        self._running = set()
+        self._rendered = {}
+
+    def schedule(self, bucket_names, bucket_regions_map):
+        with self._changed:
+            for bucket_name in set(self._due) - set(bucket_names):
+                del self._due[bucket_name]
+                self._buckets.pop(bucket_name, None)
+            for bucket_name in bucket_names:
+                self._due.setdefault(bucket_name, time.time())
+                self._regions[bucket_name] = bucket_regions_map.get(bucket_name)
+            self._rendered = {}
+            self._changed.notify_all()
+
+    def take_due(self, now):
+        with self._lock:
+            due = [bucket_name for bucket_name, at in self._due.items()
+                   if at <= now and bucket_name not in self._running]
+            self._running.update(due)
+            return due
+
+    def wait(self, timeout):
+        # Woken early by every finished refresh and every new schedule.
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def next_due(self):
+        with self._lock:
+            return min((at for bucket_name, at in self._due.items() if bucket_name not in self._running),
+                       default=None)
+
+    def region(self, bucket_name):
+        with self._lock:
+            return self._regions.get(bucket_name)
+
+    def refreshed(self, bucket_name):
+        with self._lock:
+            return bucket_name in self._buckets
+
+    def finish(self, bucket_name, stats, duration, error):
+        now = time.time()
+        with self._changed:
+            self._running.discard(bucket_name)
+            entry = self._buckets.get(bucket_name)
+            first = entry is None
+            if first:
+                entry = self._buckets[bucket_name] = {'Stats': None}
+            # A failed refresh keeps serving the previous stats, with the error next to them.
+            if stats is not None:
+                entry['Stats'] = stats
+            entry.update({'Refreshed': now, 'Duration': round(duration, 3), 'Error': error})
+            if bucket_name in self._due:
+                spread = (zlib.crc32(bucket_name.encode('utf-8')) % 1000) / 1000.0
+                self._due[bucket_name] = now + self.interval * ((0.5 + spread / 2) if first else 1)
+            self.refreshes += 1
+            self._rendered = {}
+            self._changed.notify_all()
+
+    def render(self, kind):
+        with self._lock:
+            if kind not in self._rendered:
+                buckets = {bucket_name: dict(entry) for bucket_name, entry in self._buckets.items()}
+                if kind == 'metrics':
+                    self._rendered[kind] = render_prometheus(buckets, self.refreshes).encode('utf-8')
+                else:
+                    self._rendered[kind] = json.dumps({'Buckets': buckets, 'Refreshes': self.refreshes,
+                                                       'Totals': daemon_totals(buckets)},
+                                                      default=output_json_value).encode('utf-8')
+            return self._rendered[kind]
+
+    def render_bucket(self, bucket_name):
+        with self._lock:
+            entry = self._buckets.get(bucket_name)
+            return None if entry is None else json.dumps(entry, default=output_json_value).encode('utf-8')
+
+
+def daemon_totals(buckets):
+    stats = [entry['Stats'] for entry in buckets.values() if entry['Stats'] is not None]
+    return {'Count': sum(int(entry['Count']) for entry in stats),
+            'SizeBytes': sum(int(entry['SizeBytes']) for entry in stats),
+            'CostUSD': round(sum(entry['CostUSD'] or 0 for entry in stats), 6),
+            'Failed': sum(1 for entry in buckets.values() if entry['Error'] is not None)}
+
+
+def prometheus_labels(**labels):
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in labels.items())
+
+
+def render_prometheus(buckets, refreshes):
+    families = {
+        's3bucketstats_bucket_objects': ("gauge", "Objects in the bucket", []),
+        's3bucketstats_bucket_bytes': ("gauge", "Bytes stored in the bucket", []),
+        's3bucketstats_bucket_cost_usd': ("gauge", "Monthly storage cost of the bucket in USD", []),
+        's3bucketstats_bucket_last_modified_timestamp_seconds': ("gauge", "Newest object of the bucket", []),
+        's3bucketstats_storage_class_objects': ("gauge", "Objects in the bucket per storage class", []),
+        's3bucketstats_storage_class_bytes': ("gauge", "Bytes stored in the bucket per storage class", []),
+        's3bucketstats_storage_class_cost_usd': ("gauge", "Monthly storage cost per storage class in USD", []),
+        's3bucketstats_prefix_objects': ("gauge", "Objects under the prefix, with --prefix-depth", []),
+        's3bucketstats_prefix_bytes': ("gauge", "Bytes stored under the prefix, with --prefix-depth", []),
+        's3bucketstats_prefix_cost_usd': ("gauge", "Monthly storage cost under the prefix in USD", []),
+        's3bucketstats_refresh_timestamp_seconds': ("gauge", "End of the latest refresh of the bucket", []),
+        's3bucketstats_refresh_duration_seconds': ("gauge", "Duration of the latest refresh of the bucket", []),
+        's3bucketstats_refresh_success': ("gauge", "1 if the latest refresh of the bucket succeeded", []),
+    }
+    for bucket_name, entry in sorted(buckets.items()):
+        stats = entry['Stats']
+        families['s3bucketstats_refresh_timestamp_seconds'][2].append((prometheus_labels(bucket=bucket_name),
+                                                                       entry['Refreshed']))
+        families['s3bucketstats_refresh_duration_seconds'][2].append((prometheus_labels(bucket=bucket_name),
+                                                                      entry['Duration']))
+        families['s3bucketstats_refresh_success'][2].append((prometheus_labels(bucket=bucket_name),
+                                                             int(entry['Error'] is None)))
+        if stats is None:
+            continue
+        labels = prometheus_labels(bucket=bucket_name, region=stats['Region'])
+        families['s3bucketstats_bucket_objects'][2].append((labels, stats['Count']))
+        families['s3bucketstats_bucket_bytes'][2].append((labels, stats['SizeBytes']))
+        if stats['CostUSD'] is not None:
+            families['s3bucketstats_bucket_cost_usd'][2].append((labels, stats['CostUSD']))
+        last_modified = as_datetime(stats['LastModified'])
+        if last_modified is not None and not pd.isna(last_modified):
+            families['s3bucketstats_bucket_last_modified_timestamp_seconds'][2].append(
+                (labels, last_modified.timestamp()))
+        for content in stats['Content']:
+            labels = prometheus_labels(bucket=bucket_name, region=stats['Region'],
+                                       storage_class=content['StorageClass'])
+            if content['Count'] is not None:
+                families['s3bucketstats_storage_class_objects'][2].append((labels, content['Count']))
+            families['s3bucketstats_storage_class_bytes'][2].append((labels, content['Size']))
+            if content.get('CostUSD') is not None:
+                families['s3bucketstats_storage_class_cost_usd'][2].append((labels, content['CostUSD']))
+        for content in stats.get('Prefixes', []):
+            labels = prometheus_labels(bucket=bucket_name, region=stats['Region'], prefix=content['Prefix'])
+            families['s3bucketstats_prefix_objects'][2].append((labels, content['Count']))
+            families['s3bucketstats_prefix_bytes'][2].append((labels, content['Size']))
+            if content['CostUSD'] is not None:
+                families['s3bucketstats_prefix_cost_usd'][2].append((labels, content['CostUSD']))
+    lines = ["# HELP s3bucketstats_refreshes_total Bucket refreshes since the daemon started",
+             "# TYPE s3bucketstats_refreshes_total counter",
+             "s3bucketstats_refreshes_total {}".format(refreshes)]
+    for name, (kind, description, samples) in families.items():
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.extend("{}{{{}}} {}".format(name, labels, value) for labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = unquote(self.path.split("?")[0])
+        status, content_type, body = 200, "application/json", None
+        if path == "/metrics":
+            content_type, body = "text/plain; version=0.0.4; charset=utf-8", daemon_state.render('metrics')
+        elif path in ("/", "/stats"):
+            body = daemon_state.render('stats')
+        elif path.startswith("/stats/"):
+            body = daemon_state.render_bucket(path[len("/stats/"):])
+        elif path == "/health":
+            content_type, body = "text/plain; charset=utf-8", b"ok\n"
+        if body is None:
+            status, content_type, body = 404, "text/plain; charset=utf-8", b"not found\n"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if settings._VERBOSE > 1:
+            super().log_message(format, *args)
+
+
+def refresh_daemon_bucket(bucket_name):
+    start = time.perf_counter()
+    error = None
+    stats = None
+    try:
+        result = threaded_analyse_bucket_contents(bucket_name, bucket_region=daemon_state.region(bucket_name))
+        if result:
+            stats = result[0][0]
+        else:
+            error = run_totals.pop_failure(bucket_name)
+    except Exception as e:
+        error = str(e)
+    daemon_state.finish(bucket_name, stats, time.perf_counter() - start, error)
+
+
+def discover_daemon_buckets(s3):
+    try:
+        listed_buckets = s3.list_buckets()['Buckets']
+        bucket_creation_dates.update({b['Name']: b['CreationDate'] for b in listed_buckets})
+        bucket_list, bucket_regions_map = select_buckets(listed_buckets)
+        # The pool size only applies to clients created after it is set, the daemon keeps the one main sized from
+        # --max-buckets for every client.
+        if settings._SOURCE == 'cloudwatch':
+            fetch_bucket_metrics({bucket_name: bucket_regions_map.get(bucket_name) for bucket_name in bucket_list})
+    except Exception as e:
+        # The buckets already known keep being refreshed.
+        print("Could not list the buckets to refresh: {}".format(e), file=sys.stderr)
+        return
+    daemon_state.schedule(bucket_list, bucket_regions_map)
+
+
+def run_daemon(s3):
+    global daemon_state
+    interval = max(1.0, settings._REFRESH_INTERVAL * 3600)
+    daemon_state = DaemonState(interval)
+    host, port = settings._LISTEN.rsplit(":", 1)
+    server = ThreadingHTTPServer((host, int(port)), DaemonRequestHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    print("Serving bucket stats on http://{}:{}/stats and /metrics".format(host, port), file=sys.stderr)
+    workers = max(1, settings._MAX_BUCKETS if settings._THREADED == 1 else settings._MAX_THREADS)
+    discovered = None
+    pricing_reset = time.time()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                now = time.time()
+                if discovered is None or now - discovered >= interval:
+                    discover_daemon_buckets(s3)
+                    discovered = now
+                due = daemon_state.take_due(now)
+                if due:
+                    # Memoized for a run, a daemon must see new inventory deliveries and configurations.
+                    for memo in (inventory_configurations, inventory_manifests, manifest_contents):
+                        memo.clear()
+                    if now - pricing_reset >= settings._PRICING_TTL * 3600:
+                        price_tables.clear()
+                        pricing_reset = now
+                    for bucket_name in schedule_buckets(due, workers):
+                        executor.submit(profiler.bind(refresh_daemon_bucket), bucket_name)
+                next_due = daemon_state.next_due()
+                wait = discovered + interval - time.time()
+                if next_due is not None:
+                    wait = min(wait, next_due - time.time())
+                daemon_state.wait(max(0.5, wait))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
 def set_arguments_parameters(parser):
     parser.add_argument("-v", "--verbose", dest="verbose", required=False, default=1,
                         help="Verbose level, 0 for quiet.")
@@ -809,21 +3590,92 @@ def set_arguments_parameters(parser):
     parser.add_argument("-r", "--region-regex", dest="region_filter", required=False, default='.*',
                         help="Regex Region filter")
     parser.add_argument("-o", "--output", dest="output", required=False, default=None, help="Output to File")
+    parser.add_argument("--output-format", dest="output_format", choices=['dict', 'ndjson', 'csv'], required=False,
+                        default='dict', help="Format of --output: dict appends the whole run at its end, ndjson and "
+                                             "csv append a line per bucket as soon as it is done, default=dict")
     parser.add_argument("-s", "--display-size", dest="size", type=str, required=False, default="GB",
                         help="Possible values:  [ B | KB | MB | GB | TB | PB | EB | ZB | YB ]")
     parser.add_argument("-b", "--buckets", dest="buckets", type=str, nargs='+', required=False, default="",
                         help="List of specific buckets to scan. Multiple seperated by space")
     parser.add_argument("-t", "--thread-type", dest="threaded", type=int, required=False, default=1,
-                        help="Thread type, 0 to disable, 1 for Process (Default), 2 for Pool")
+                        help="Thread type, 0 to disable, 1 for Process (Default), 2 for Pool, "
+                             "3 for Pool with inventory files parsed in a process pool")
     parser.add_argument("-m", "--max-threads", dest="maxthreads", type=int, required=False, default=1,
                         help="Max number of pool threads")
+    parser.add_argument("--source", dest="source", choices=['auto', 'cloudwatch'], required=False, default='auto',
+                        help="Where sizes come from: auto for cache, inventory or listing, cloudwatch for the daily "
+                             "storage metrics (per class counts and dates are null unless -metricsfallback, fastest "
+                             "with --metadata none), default=auto")
+    parser.add_argument("--max-attempts", dest="max_attempts", type=int, required=False, default=10,
+                        help="Attempts per AWS request, retries back off with jitter, default=10")
+    parser.add_argument("--max-request-rate", dest="max_request_rate", type=float, required=False, default=0,
+                        help="Initial requests per second per service and region, 0 for none until throttled, "
+                             "default=0")
+    parser.add_argument("--max-buckets", dest="max_buckets", type=int, required=False, default=64,
+                        help="Max number of buckets analysed at once with -t 1, default=64")
+    parser.add_argument("--processes", dest="processes", type=int, required=False, default=os.cpu_count() or 1,
+                        help="Number of inventory parsing processes with -t 3, default=number of CPUs")
     parser.add_argument("-i", "--put-inventory", dest="put_inventory", action="store_true", required=False, default=False, help="Add inventory if not exist")
+    parser.add_argument("--cache-dir", dest="cache_dir", type=str, required=False, default='.',
+                        help="Directory where cache files are kept, default='.'")
+    parser.add_argument("--pricing-ttl", dest="pricing_ttl", type=float, required=False, default=168,
+                        help="Hours before cached pricing is fetched again, default=168")
+    parser.add_argument("--prefix-depth", dest="prefix_depth", type=int, required=False, default=0,
+                        help="Also break count, size and cost down per key prefix down to this many '/' levels, "
+                             "0 to disable, default=0")
+    parser.add_argument("--max-prefixes", dest="max_prefixes", type=int, required=False, default=10000,
+                        help="With --prefix-depth, prefixes reported per bucket, shallow levels first and the larger "
+                             "ones first, the others are collapsed in a '*' entry of their parent, default=10000")
+    parser.add_argument("--shard-ttl", dest="shard_ttl", type=float, required=False, default=168,
+                        help="Hours before a cached listing shard is listed again on refresh, default=168")
+    parser.add_argument("--region-ttl", dest="region_ttl", type=float, required=False, default=720,
+                        help="Hours before a cached bucket region is resolved again, default=720")
+    parser.add_argument("--region-workers", dest="region_workers", type=int, required=False, default=32,
+                        help="Number of concurrent bucket region lookups, default=32")
+    parser.add_argument("--metadata", dest="metadata", type=str, required=False, default="all",
+                        help="Comma separated bucket configuration sections to collect, 'all' or 'none'. "
+                             "Sections: " + ",".join(metadata_collectors))
+    parser.add_argument("--list-workers", dest="list_workers", type=int, required=False, default=8,
+                        help="Concurrent shard listings per bucket with -sharded, default=8")
+    parser.add_argument("--shard-split-pages", dest="shard_split_pages", type=int, required=False, default=10,
+                        help="Pages a shard lists before splitting its remaining range for idle workers, default=10")
+    parser.add_argument("--file-workers", dest="file_workers", type=int, required=False, default=4,
+                        help="Inventory data files read concurrently per bucket, default=4")
+    parser.add_argument("--csv-chunk-rows", dest="csv_chunk_rows", type=int, required=False, default=100000,
+                        help="Rows parsed at once from a downloaded inventory file, default=100000")
+    parser.add_argument("--refresh-interval", dest="refresh_interval", type=float, required=False, default=1,
+                        help="With -daemon, hours between two refreshes of a bucket, default=1")
+    parser.add_argument("--listen", dest="listen", type=str, required=False, default='127.0.0.1:9180',
+                        help="With -daemon, host:port serving /stats and /metrics, default=127.0.0.1:9180")
+    parser.add_argument("--profile-top", dest="profile_top", type=int, required=False, default=10,
+                        help="With -profile, number of slowest buckets and operations summarized, default=10")
+    parser.add_argument("--cprofile", dest="cprofile", type=str, required=False, default='',
+                        help="Write a cProfile capture of the bucket threads and their workers to this file")
+    parser.add_argument("--checkpoint-interval", dest="checkpoint_interval", type=float, required=False, default=60,
+                        help="Seconds between checkpoints of a listing in progress, 0 to disable, default=60")
+    parser.add_argument("--hedge-percentile", dest="hedge_percentile", type=float, required=False, default=95,
+                        help="With -hedge, latency percentile of an operation after which a request is duplicated, "
+                             "default=95")
+    parser.add_argument("--hedge-budget", dest="hedge_budget", type=float, required=False, default=5,
+                        help="With -hedge, max duplicated requests in percent of the requests, default=5")
+    parser.add_argument("--metadata-threads", dest="metadata_threads", type=int, required=False, default=12,
+                        help="Concurrent bucket configuration calls per bucket thread, default=12")
 
     add_bool_arg(parser, "cache", False, "Use Cache file if available")
     add_bool_arg(parser, "refresh", False, "Force Refresh Cache")
+    add_bool_arg(parser, "cachekeys", False, "Also store object keys in the Cache")
     add_bool_arg(parser, "inventory", True, "Use Inventory if exist")
     add_bool_arg(parser, "s3select", True, "Use S3 Select to parse inventory result files")
-    add_bool_arg(parser, "lowmemory", False, "If you have low memory.")
+    add_bool_arg(parser, "lowmemory", False, "If you have low memory. (Listings are always streamed)")
+    add_bool_arg(parser, "refreshpricing", False, "Force Refresh Pricing Cache")
+    add_bool_arg(parser, "pushdown", False, "Aggregate inside S3 Select instead of returning every inventory row")
+    add_bool_arg(parser, "metricsfallback", False,
+                 "With --source cloudwatch, read the per class counts and dates from the cache or inventory if any")
+    add_bool_arg(parser, "sharded", False, "List buckets without inventory in parallel prefix shards")
+    add_bool_arg(parser, "daemon", False, "Keep running, refresh the buckets on a schedule and serve their stats")
+    add_bool_arg(parser, "profile", False, "Add the time, requests and bytes of every phase and API operation")
+    add_bool_arg(parser, "resume", False, "Resume interrupted listings from their checkpoint")
+    add_bool_arg(parser, "hedge", False, "Send a second copy of slow listing and inventory requests")
     # add_bool_arg(parser, "threaded", True, "Use Multi-Thread.")
 
     arguments = parser.parse_args()
@@ -834,16 +3686,60 @@ def set_arguments_parameters(parser):
     if arguments.region_filter: settings.set_region_filter(arguments.region_filter)
     if arguments.key_prefix: settings.set_key_prefix(arguments.key_prefix)
     if arguments.output is not None: settings.set_output_file(arguments.output)
+    settings.set_output_format(arguments.output_format)
 
     if arguments.put_inventory: settings.set_put_inventory(arguments.put_inventory)
 
     settings.set_refresh_cache(arguments.refresh)
     settings.set_cache(arguments.cache)
+    settings.set_cache_keys(arguments.cachekeys)
+    settings.set_prefix_depth(max(0, arguments.prefix_depth))
+    settings.set_max_prefixes(max(1, arguments.max_prefixes))
     settings.set_inventory(arguments.inventory)
     settings.set_s3select(arguments.s3select)
+    settings.set_pushdown(arguments.pushdown)
     settings.set_lowmemory(arguments.lowmemory)
     settings.set_threaded(arguments.threaded)
     settings.set_maxthreads(arguments.maxthreads)
+    settings.set_processes(arguments.processes)
+    settings.set_max_buckets(arguments.max_buckets)
+    settings.set_source(arguments.source)
+    settings.set_metrics_fallback(arguments.metricsfallback)
+    settings.set_max_attempts(arguments.max_attempts)
+    settings.set_max_request_rate(arguments.max_request_rate)
+    settings.set_cache_dir(arguments.cache_dir)
+    settings.set_pricing_ttl(arguments.pricing_ttl)
+    settings.set_refresh_pricing(arguments.refreshpricing)
+    settings.set_region_ttl(arguments.region_ttl)
+    settings.set_shard_ttl(arguments.shard_ttl)
+    settings.set_region_workers(arguments.region_workers)
+    settings.set_metadata_threads(arguments.metadata_threads)
+    settings.set_sharded(arguments.sharded)
+    settings.set_list_workers(arguments.list_workers)
+    settings.set_shard_split_pages(arguments.shard_split_pages)
+    settings.set_file_workers(arguments.file_workers)
+    settings.set_csv_chunk_rows(arguments.csv_chunk_rows)
+    settings.set_hedge(arguments.hedge)
+    settings.set_resume(arguments.resume)
+    settings.set_profile(arguments.profile)
+    settings.set_daemon(arguments.daemon)
+    settings.set_refresh_interval(arguments.refresh_interval)
+    settings.set_listen(arguments.listen)
+    settings.set_profile_top(arguments.profile_top)
+    settings.set_cprofile(arguments.cprofile)
+    settings.set_checkpoint_interval(arguments.checkpoint_interval)
+    settings.set_hedge_percentile(arguments.hedge_percentile)
+    settings.set_hedge_budget(arguments.hedge_budget)
+    if arguments.metadata == "all":
+        settings.set_metadata(list(metadata_collectors))
+    elif arguments.metadata == "none":
+        settings.set_metadata([])
+    else:
+        sections = [section.strip() for section in arguments.metadata.split(",") if section.strip()]
+        unknown = [section for section in sections if section not in metadata_collectors]
+        if unknown:
+            parser.error("Unknown metadata sections: {}".format(", ".join(unknown)))
+        settings.set_metadata(sections)
 
     settings.set_display_size(sizes_name.index(arguments.size))
 
@@ -858,34 +3754,38 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     set_arguments_parameters(parser)
 
+    # The bucket count is not known before listing them, the clients created until then are sized for the most buckets
+    # that can be in flight.
+    client_pool.set_pool_size(client_pool_size(settings._MAX_BUCKETS))
     try:
-        s3 = boto3.client('s3')
+        s3 = client_pool.get('s3')
         buckets = s3.list_buckets()
+        bucket_creation_dates.update({b['Name']: b['CreationDate'] for b in buckets['Buckets']})
     except Exception as e:
         print("Try setting the environment variables AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY/AWS_SESSION_TOKEN")
         exit(1)
 
     buckets_stats_array = []
-    bucket_list = []
-
-    # Filter buckets based on bucket list regex parameter.
-    if settings._BUCKET_LIST_REGEX is not None:
-        bucket_list = [i['Name'] for i in buckets['Buckets'] if re.match(settings._BUCKET_LIST_REGEX, i['Name'])]
 
-    # If no bucket found we simply assume that the parameter is a targeted bucket name
-    if settings._BUCKETS is not None:
-        bucket_list.extend(settings._BUCKETS)
+    if settings._OUTPUT_FILE.__len__() > 0 and settings._OUTPUT_FORMAT != 'dict':
+        output_sink = OutputSink(settings._OUTPUT_FILE, settings._OUTPUT_FORMAT)
+    if settings._DAEMON:
+        run_daemon(s3)
+        if output_sink is not None:
+            output_sink.close()
+        exit(0)
 
+    # Filter buckets based on the bucket list regex, bucket names and region filter parameters.
+    bucket_list, bucket_regions_map = select_buckets(buckets['Buckets'])
     if bucket_list.__len__() == 0:
         print("No buckets to scan found. run with -h to see available options")
         exit(0)
 
-    # Filter buckets based on requested region filter.
-    [bucket_list.remove(b) for b in bucket_list if not re.match(settings._REGION_FILTER, get_region(b))]
-
-    grand_total_size = 0
-    grand_total_objects = 0
-    grand_total_cost = 0
+    client_pool.set_pool_size(client_pool_size(len(bucket_list)))
+    if settings._SOURCE == 'cloudwatch':
+        fetch_bucket_metrics({bucket_name: bucket_regions_map.get(bucket_name) for bucket_name in bucket_list})
+    bucket_list = schedule_buckets(bucket_list, settings._MAX_BUCKETS if settings._THREADED == 1 else
+                                   settings._MAX_THREADS)
 
     print("{:60}{:>30}{:>20}{:>20}{:>30}{:>20}{:>40}".format("Bucket", "Created", "Objects", "Size", "LastModified",
                                                              "Cost (USD)", "Processing Time"), file=sys.stderr)
@@ -894,9 +3794,12 @@ if __name__ == "__main__":
     if settings._THREADED == 1:
         buckets_results = [{} for i in bucket_list]
         threads = []
+        slots = BoundedSemaphore(max(1, settings._MAX_BUCKETS))
 
         for i in range(len(bucket_list)):
-            process = Thread(target=threaded_analyse_bucket_contents, args=[bucket_list[i], buckets_results, i])
+            slots.acquire()
+            process = Thread(target=profiler.bind(bounded_analyse_bucket_contents),
+                             args=[slots, bucket_list[i], buckets_results, i, bucket_regions_map.get(bucket_list[i])])
             process.start()
             threads.append(process)
         for process in threads:
@@ -906,49 +3809,58 @@ if __name__ == "__main__":
                 object = bucket[0]
                 buckets_stats_array.extend(object)
 
-    elif settings._THREADED == 2:
+    elif settings._THREADED in (2, 3):
         # We can use a with statement to ensure threads are cleaned up promptly
         with concurrent.futures.ThreadPoolExecutor(max_workers=settings._MAX_THREADS) as executor:
             # Start the load operations and mark each future with its URL
-            future_to_url = {executor.submit(threaded_analyse_bucket_contents, bucket_name): bucket_name for bucket_name
-                             in bucket_list}
+            future_to_url = {executor.submit(profiler.bind(threaded_analyse_bucket_contents), bucket_name,
+                                             bucket_region=bucket_regions_map.get(bucket_name)): bucket_name
+                             for bucket_name in bucket_list}
+            # Queued behind the buckets, these only start on workers left without a bucket.
+            for worker in range(max(1, settings._MAX_THREADS)):
+                executor.submit(shared_work.help_until, list(future_to_url), True)
             for future in concurrent.futures.as_completed(future_to_url):
                 bucket_info = future_to_url[future]
                 try:
-                    data, processingtime, info = future.result()
+                    result = future.result()
                 except Exception as exc:
                     print('%r generated an exception: %s' % (bucket_info, exc))
                 else:
-                    buckets_stats_array.extend(data)
-                    print(info)
+                    # Failed buckets return nothing, they are reported with the Grand Total.
+                    if result:
+                        data, processingtime, info = result
+                        buckets_stats_array.extend(data)
+                        print(info)
 
     else:
         for bucket_name in bucket_list:
 
-            if settings._REFRESHCACHE and os.path.isfile(bucket_name + ".cache"):
-                os.remove(bucket_name + ".cache")
+            if settings._REFRESHCACHE and settings._CACHE and object_cache_exists(bucket_name):
+                remove_object_cache(bucket_name)
                 if settings._VERBOSE > 1:
                     print("Bucket {} cache removed!".format(bucket_name))
 
             print("{0:60}".format(bucket_name), file=sys.stderr, end="\r")
             buckets.append(bucket_name)
 
-            bucket_creation = boto3.resource("s3").Bucket(bucket_name).creation_date
             start = time.perf_counter()
-            for bucket in analyse_bucket_contents(bucket_name):
+            results = profiler.bind(lambda: list(analyse_bucket_contents(bucket_name,
+                                                                         bucket_regions_map.get(bucket_name))))()
+            for bucket in results:
                 object = bucket[0]
                 timing = bucket[1]
                 print(
-                    "{:60}{:>30}{:>20}{:>20}{:>30}{:>20}".format(bucket_name, object[0]['CreationDate'],
+                    "{:60}{:>30}{:>20}{:>20}{:>30}{:>20}".format(bucket_name, str(object[0]['CreationDate']),
                                                                  object[0]['Count'],
-                                                                 object[0]['Size'], object[0]['LastModified'],
+                                                                 object[0]['Size'], str(object[0]['LastModified']),
                                                                  object[0]['Cost']), file=sys.stderr,
                     end="\r")
                 buckets_stats_array.extend(object)
                 print(
-                    "{:60}{:>30}{:>20}{:>20}{:>30}{:>20}{:>40}".format(bucket_name, object[0]['CreationDate'],
+                    "{:60}{:>30}{:>20}{:>20}{:>30}{:>20}{:>40}".format(bucket_name, str(object[0]['CreationDate']),
                                                                        object[0]['Count'],
-                                                                       object[0]['Size'], object[0]['LastModified'],
+                                                                       object[0]['Size'],
+                                                                       str(object[0]['LastModified']),
                                                                        object[0]["Cost"],
                                                                        str(timing)
                                                                        # str(timedelta(milliseconds=round(1000 * (time.perf_counter() - start))))
@@ -959,8 +3871,10 @@ if __name__ == "__main__":
                 start = time.perf_counter()
 
     all_buckets_stats = {'Buckets': buckets_stats_array}
-    if settings._OUTPUT_FILE.__len__() > 0:
+    if settings._OUTPUT_FILE.__len__() > 0 and settings._OUTPUT_FORMAT == 'dict':
         append_output(str(all_buckets_stats))
+    if output_sink is not None:
+        output_sink.close()
     if settings._VERBOSE > 0:
         print(all_buckets_stats)
 
@@ -972,6 +3886,23 @@ if __name__ == "__main__":
           "  Processing Time: {:>40}"
         .format(
         len(all_buckets_stats['Buckets']),
-        grand_total_objects, display_size(grand_total_size), "${:,.2f}".format(grand_total_cost),
+        run_totals.objects, display_size(run_totals.size), "${:,.2f}".format(run_totals.cost),
         str(timedelta(milliseconds=round(1000 * (time.perf_counter() - realstart))))
     ), file=sys.stderr)
+    if run_totals.failures:
+        print("Failed Buckets:  {:>40}".format(len(run_totals.failures)), file=sys.stderr)
+        for bucket_name, error in sorted(run_totals.failures.items()):
+            print("  {}: {}".format(bucket_name, error), file=sys.stderr)
+    if settings._PROFILE:
+        print(profiler.summary(max(1, settings._PROFILE_TOP)), file=sys.stderr)
+    if settings._CPROFILE and profiler.dump_cprofile(settings._CPROFILE):
+        print("cProfile capture written to {}, read it with python -m pstats".format(settings._CPROFILE),
+              file=sys.stderr)
+    if settings._HEDGE:
+        print("Hedged Requests:", json.dumps(request_hedger.stats(), indent=2), file=sys.stderr)
+    if settings._VERBOSE > 1:
+        print("Client Pools:", json.dumps(client_pool.stats(), indent=2), file=sys.stderr)
+        print("Rate Limiters:", json.dumps(client_pool.limiter_stats(), indent=2), file=sys.stderr)
+        print("Shared work tasks run by idle bucket workers:", shared_work.stolen, file=sys.stderr)
+    if inventory_process_pool is not None:
+        inventory_process_pool.shutdown()
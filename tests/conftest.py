@@ -0,0 +1,50 @@
+import os
+import sys
+from datetime import datetime, timezone
+from threading import Lock
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3bucketstats
+from s3bucketbench import list_keys
+
+
+@pytest.fixture(autouse=True)
+def settings():
+    # The module reads its options from the global set up by __main__, every test starts from the defaults.
+    s3bucketstats.settings = s3bucketstats.Settings()
+    return s3bucketstats.settings
+
+
+class ListingClient(object):
+    # ListObjectsV2 over sorted keys, one byte STANDARD objects. Requests after fail_after raise an InternalError.
+    def __init__(self, keys, fail_after=None):
+        self.keys = sorted(keys)
+        self.fail_after = fail_after
+        self.calls = 0
+        self._lock = Lock()
+
+    def list_objects_v2(self, Bucket, **kwargs):
+        with self._lock:
+            self.calls += 1
+            if self.fail_after is not None and self.calls > self.fail_after:
+                raise ClientError({'Error': {'Code': "InternalError", 'Message': "injected"}}, "ListObjectsV2")
+        return list_keys(self.keys, listed_object, **kwargs)
+
+
+def listed_object(index, key):
+    return {'Key': key, 'Size': 1, 'StorageClass': 'STANDARD',
+            'LastModified': datetime(2024, 1, 1, tzinfo=timezone.utc)}
+
+
+@pytest.fixture
+def listed_bucket(monkeypatch):
+    # Every bucket is served by the returned client.
+    def install(keys, **kwargs):
+        client = ListingClient(keys, **kwargs)
+        monkeypatch.setattr(s3bucketstats, 'bucket_client', lambda bucket_name: client)
+        return client
+    return install
@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+import s3bucketstats
+from s3bucketstats import AdaptiveLimiter, ClientPool
+
+empty_listing = (b'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult><Name>bk</Name><KeyCount>0</KeyCount>'
+                 b'<IsTruncated>false</IsTruncated></ListBucketResult>')
+slow_down = b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>SlowDown</Code><Message>Slow</Message></Error>'
+
+
+class RawBody(object):
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class LocalResponder(object):
+    # Answers in place of the HTTP endpoint, after the before-send hooks of the pool have run, so the limiter and
+    # the meter see every request and response.
+    def __init__(self, responses, gate=None):
+        self.responses = responses
+        self.gate = gate
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def __call__(self, request, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            status, body = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if self.gate is not None:
+            self.gate.wait(0.2)
+        with self.lock:
+            self.in_flight -= 1
+        return AWSResponse(request.url, status, {}, RawBody(body))
+
+
+@pytest.fixture
+def local_client(monkeypatch, settings):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', "testing")
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', "testing")
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+
+    def create(responses, pool_size=4, max_attempts=1, gate=None):
+        settings.set_max_attempts(max_attempts)
+        pool = ClientPool(pool_size)
+        client = pool.get('s3', 'us-east-1')
+        responder = LocalResponder(responses, gate)
+        client.meta.events.register('before-send', responder)
+        return pool, client, responder
+    return create
+
+
+def test_requests_are_metered_and_released(local_client):
+    pool, client, responder = local_client([(200, empty_listing)])
+    for request in range(3):
+        assert client.list_objects_v2(Bucket='bk')['KeyCount'] == 0
+    meter = pool.stats()['s3:us-east-1']
+    assert meter['Requests'] == 3 and meter['PeakInFlight'] == 1
+    assert pool.limiter_stats()['s3:us-east-1']['Throttles'] == 0
+
+
+def test_concurrency_stays_within_the_pool(local_client):
+    gate = threading.Event()
+    pool, client, responder = local_client([(200, empty_listing)], pool_size=2, gate=gate)
+    threads = [threading.Thread(target=client.list_objects_v2, kwargs={'Bucket': 'bk'}) for thread in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert responder.peak_in_flight == 2
+    meter = pool.stats()['s3:us-east-1']
+    assert meter['Requests'] == 6 and meter['PeakInFlight'] == 2
+    assert pool.limiter_stats()['s3:us-east-1']['Waits'] > 0
+
+
+def test_throttled_responses_lower_the_limit(local_client, settings):
+    settings.set_max_request_rate(50)
+    pool, client, responder = local_client([(503, slow_down)], pool_size=8)
+    with pytest.raises(ClientError):
+        client.list_objects_v2(Bucket='bk')
+    limiter = pool.limiter_stats()['s3:us-east-1']
+    assert limiter['Throttles'] == 1 and limiter['Decreases'] == 1
+    assert limiter['ConcurrencyLimit'] == 4 and limiter['Rate'] < 50
+    assert pool.stats()['s3:us-east-1']['Requests'] == 1
+
+
+def test_limit_recovers_after_throttling(monkeypatch):
+    delays = []
+    monkeypatch.setattr(s3bucketstats.time, 'sleep', delays.append)
+    limiter = AdaptiveLimiter(8)
+    limiter.acquire()
+    limiter.release({'Error': {'Code': 'SlowDown'}})
+    assert int(limiter.limit) == 4
+    # A second throttle within the same second does not halve it again.
+    limiter.acquire()
+    limiter.release({'ResponseMetadata': {'HTTPStatusCode': 429}})
+    assert int(limiter.limit) == 4 and limiter.throttles == 2
+    for request in range(40):
+        limiter.acquire()
+        limiter.release({})
+    assert int(limiter.limit) == 8 and limiter.in_flight == 0
+    # The throttle also set a rate from the one observed, later requests were paced by it.
+    assert limiter.rate is not None and delays
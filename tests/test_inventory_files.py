@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from s3bucketstats import StorageClassAggregate, aggregate_inventory_files
+
+files = [{'key': "inventory/data/part-{}.csv.gz".format(number), 'MD5checksum': "md5-{}".format(number)}
+         for number in range(8)]
+
+
+class InventoryReader(object):
+    # Each data file holds as many objects as its number plus one, reads take a little while.
+    def __init__(self, failing=None):
+        self.failing = failing
+        self.lock = threading.Lock()
+        self.read = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def __call__(self, inventory_bucket, key, schema):
+        with self.lock:
+            self.read.append(key)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        if key == self.failing:
+            raise ValueError("corrupt file")
+        number = int(key.rsplit("-", 1)[1].split(".")[0])
+        return StorageClassAggregate().add_entries([('STANDARD', number + 1, 10 * (number + 1), None)])
+
+
+def test_files_are_read_concurrently_within_file_workers(settings):
+    settings.set_file_workers(3)
+    reader = InventoryReader()
+    done = []
+    aggregate = aggregate_inventory_files('bk', 'inventory-bk', files, [], on_file=lambda f, a: done.append(f['key']),
+                                          reader=reader)
+    assert aggregate.count() == sum(range(1, 9)) and aggregate.size() == 10 * sum(range(1, 9))
+    assert reader.peak_in_flight == 3
+    assert sorted(done) == sorted(reader.read) == [f['key'] for f in files]
+
+
+def test_known_files_are_not_read_again(settings):
+    reader = InventoryReader()
+    known = {f['key']: StorageClassAggregate().add_entries([('STANDARD', 100, 1000, None)]).to_state()
+             for f in files[:5]}
+    # A file rewritten since, with another checksum, is read again.
+    known[files[0]['key']]['MD5checksum'] = "changed"
+    for f in files[1:5]:
+        known[f['key']]['MD5checksum'] = f['MD5checksum']
+    aggregate = aggregate_inventory_files('bk', 'inventory-bk', files, [], known_files=known, reader=reader)
+    assert sorted(reader.read) == sorted(f['key'] for f in [files[0]] + files[5:])
+    assert aggregate.count() == 4 * 100 + 1 + 6 + 7 + 8
+
+
+def test_failed_file_fails_the_inventory(settings):
+    settings.set_file_workers(2)
+    reader = InventoryReader(failing=files[1]['key'])
+    with pytest.raises(ValueError):
+        aggregate_inventory_files('bk', 'inventory-bk', files, [], reader=reader)
+    # Files not started when the error came back are cancelled.
+    assert len(reader.read) < len(files)
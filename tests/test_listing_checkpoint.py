@@ -0,0 +1,46 @@
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+import s3bucketstats
+from s3bucketstats import list_bucket_aggregates
+
+keys = ["d{}/{:05d}".format(index % 4, index) for index in range(6000)]
+
+
+def full_listing_calls(listed_bucket):
+    client = listed_bucket(keys)
+    list_bucket_aggregates('bk')
+    return client.calls
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_failed_listing_resumes_from_its_checkpoint(listed_bucket, settings, tmp_path, sharded):
+    settings.set_cache_dir(str(tmp_path))
+    settings.set_sharded(sharded)
+    settings.set_list_workers(2)
+    settings.set_resume(True)
+    calls = full_listing_calls(listed_bucket)
+    listed_bucket(keys, fail_after=calls // 2)
+    with pytest.raises(ClientError):
+        list_bucket_aggregates('bk')
+    checkpoint = s3bucketstats.read_json_cache("bk.checkpoint.json")
+    assert checkpoint['Scope']['Sharded'] == sharded and checkpoint['Shards']
+    client = listed_bucket(keys)
+    aggregate = list_bucket_aggregates('bk')
+    assert aggregate.count() == len(keys)
+    assert client.calls < calls
+    assert not os.path.exists(tmp_path / "bk.checkpoint.json")
+
+
+def test_checkpoint_of_another_scope_is_ignored(listed_bucket, settings, tmp_path):
+    settings.set_cache_dir(str(tmp_path))
+    settings.set_resume(True)
+    listed_bucket(keys, fail_after=3)
+    with pytest.raises(ClientError):
+        list_bucket_aggregates('bk')
+    settings.set_sharded(True)
+    client = listed_bucket(keys)
+    assert list_bucket_aggregates('bk').count() == len(keys)
+    assert client.calls == full_listing_calls(listed_bucket)
@@ -0,0 +1,65 @@
+import csv
+import json
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import s3bucketstats
+from s3bucketstats import OutputSink, RunTotals
+
+
+def bucket_stats():
+    # As built by build_bucket_stats, with the numpy counts of a bucket read from its object cache.
+    return {'Name': 'bk', 'CreationDate': datetime(2020, 5, 1, tzinfo=timezone.utc), 'LastModified': None,
+            'Region': 'us-east-1', 'Size': '1.5 GB', 'SizeBytes': 1610612736, 'Count': np.int64(3),
+            'Cost': '$0.04', 'CostUSD': 0.037,
+            'Content': [{'StorageClass': 'STANDARD', 'Count': 2, 'Size': 1073741824, 'CostUSD': 0.025},
+                        {'StorageClass': 'GLACIER', 'Count': 1, 'Size': 536870912}]}
+
+
+def written(path, output_format, monkeypatch):
+    sink = OutputSink(str(path), output_format)
+    monkeypatch.setattr(s3bucketstats, 'output_sink', sink)
+    sink.write(bucket_stats())
+    RunTotals().add_failure('broken', "Access Denied")
+    sink.close()
+
+
+def test_ndjson_lines_keep_numbers(tmp_path, monkeypatch):
+    path = tmp_path / "stats.ndjson"
+    written(path, 'ndjson', monkeypatch)
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) == 2
+    assert lines[0]['Count'] == 3 and lines[0]['SizeBytes'] == 1610612736 and lines[0]['CostUSD'] == 0.037
+    assert lines[0]['CreationDate'] == "2020-05-01 00:00:00+00:00" and lines[0]['LastModified'] is None
+    assert lines[0]['Content'][1] == {'StorageClass': 'GLACIER', 'Count': 1, 'Size': 536870912}
+    assert lines[1] == {'Name': 'broken', 'Error': "Access Denied"}
+
+
+def test_csv_rows_have_a_column_per_storage_class(tmp_path, monkeypatch):
+    path = tmp_path / "stats.csv"
+    written(path, 'csv', monkeypatch)
+    # Appending to the file of an earlier run keeps its single header.
+    written(path, 'csv', monkeypatch)
+    with open(path, newline="") as csvfile:
+        assert csvfile.read().count("Name,Region") == 1
+    with open(path, newline="") as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    assert list(rows[0]) == s3bucketstats.output_csv_columns
+    assert len(rows) == 4
+    stats, failure = rows[0], rows[1]
+    assert stats['Count'] == "3" and stats['SizeBytes'] == "1610612736" and stats['Error'] == ""
+    assert stats['STANDARD_Count'] == "2" and stats['STANDARD_SizeBytes'] == "1073741824"
+    assert stats['STANDARD_CostUSD'] == "0.025" and stats['GLACIER_CostUSD'] == "" and stats['GLACIER_Count'] == "1"
+    assert stats['DEEP_ARCHIVE_Count'] == ""
+    assert failure['Name'] == 'broken' and failure['Error'] == "Access Denied" and failure['Count'] == ""
+
+
+@pytest.mark.parametrize('output_format', ['ndjson', 'csv'])
+def test_rows_are_flushed_as_written(tmp_path, output_format):
+    path = tmp_path / "stats.out"
+    sink = OutputSink(str(path), output_format)
+    sink.write(bucket_stats())
+    assert "bk" in path.read_text()
+    sink.close()
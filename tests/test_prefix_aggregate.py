@@ -0,0 +1,68 @@
+import random
+
+from s3bucketstats import PrefixAggregate
+
+
+def content(aggregate):
+    return [(entry['Prefix'], entry['Count']) for entry in aggregate.to_content({'STANDARD': 1}, {})]
+
+
+def test_collapse_keeps_the_largest_prefixes():
+    aggregate = PrefixAggregate(1, 5)
+    for i in range(11):
+        aggregate.add("d{:02}/".format(i), 'STANDARD', i + 1, 1000 * (i + 1), None)
+    assert content(aggregate) == [('d10/', 11), ('d09/', 10), ('d08/', 9), ('d07/', 8), ('d06/', 7), ('*', 21)]
+
+
+def test_collapsed_entry_never_repeats_its_parent():
+    aggregate = PrefixAggregate(2, 40)
+    for i in range(10):
+        for j in range(30):
+            aggregate.add("p{}/q{:02}/".format(i, j), 'STANDARD', 1, 10 + i * 30 + j, None)
+    entries = dict(content(aggregate))
+    assert len(entries) == 40
+    # The largest parent keeps all of its children, the others are reported whole without a '*' entry.
+    assert entries['p9/'] == 30 and len([prefix for prefix in entries if prefix.startswith('p9/q')]) == 30
+    assert not [prefix for prefix in entries if prefix.endswith('*')]
+
+
+def test_collapsed_entry_is_kept_next_to_reported_children():
+    aggregate = PrefixAggregate(2, 3)
+    aggregate.add("a/big/", 'STANDARD', 5, 500, None)
+    aggregate.add("a/small/", 'STANDARD', 1, 10, None)
+    aggregate.add("a/tiny/", 'STANDARD', 1, 5, None)
+    assert content(aggregate) == [('a/', 7), ('a/big/', 5), ('a/small/', 1), ('a/*', 1)]
+
+
+def test_eviction_keeps_heavy_hitters_and_totals():
+    rnd = random.Random(3)
+    aggregate = PrefixAggregate(2, 10)
+    for i in range(20000):
+        if rnd.random() < 0.3:
+            prefix = "heavy{}/sub{}/".format(rnd.randrange(5), rnd.randrange(3))
+        else:
+            prefix = "tail{}/x{}/".format(rnd.randrange(10000), rnd.randrange(50))
+        aggregate.add(prefix, 'STANDARD', 1, 1, None)
+    assert aggregate.tracked == [aggregate.capacity, aggregate.capacity]
+    entries = content(aggregate)
+    assert {prefix for prefix, count in entries[:5]} == {"heavy{}/".format(i) for i in range(5)}
+    assert sum(count for prefix, count in entries if prefix == "*" or prefix.find("/") == len(prefix) - 1) == 20000
+
+
+def test_merge_matches_a_single_pass():
+    # Fewer distinct prefixes than candidates, only the reported ones are capped.
+    prefixes = ["d{}/s{}/".format(i % 7, i % 13) for i in range(500)]
+    single = PrefixAggregate(2, 30)
+    shards = [PrefixAggregate(2, 30), PrefixAggregate(2, 30)]
+    for i, prefix in enumerate(prefixes):
+        single.add(prefix, 'STANDARD', 1, i, None)
+        shards[i % 2].add(prefix, 'STANDARD', 1, i, None)
+    assert content(shards[1].merge(shards[0])) == content(single)
+
+
+def test_entries_round_trip():
+    aggregate = PrefixAggregate(2, 4)
+    for i in range(40):
+        aggregate.add("d{}/s{}/".format(i % 5, i % 3), 'GLACIER' if i % 2 else 'STANDARD', 1, i, None)
+    restored = PrefixAggregate(2, 4).add_entries(aggregate.to_entries())
+    assert restored.to_entries() == aggregate.to_entries()
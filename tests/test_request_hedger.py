@@ -0,0 +1,82 @@
+import threading
+
+import s3bucketstats
+from s3bucketstats import ListShard, RequestHedger, list_bucket_pages
+
+
+def primed_hedger(operation):
+    # Enough fast samples for the threshold to stay at the minimum hedge delay while the test adds slow ones.
+    hedger = RequestHedger()
+    for sample in range(500):
+        hedger.record(operation, 0.001)
+    return hedger
+
+
+class SlowFirstRequest(object):
+    # The first request of every distinct set of parameters is slow, its duplicate answers at once.
+    def __init__(self, respond, delay=2):
+        self.respond = respond
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.requests = []
+        self.release = threading.Event()
+
+    def __call__(self, **kwargs):
+        key = tuple(sorted(kwargs.items()))
+        with self.lock:
+            self.requests.append(dict(kwargs))
+            first = key not in self.seen
+            self.seen.add(key)
+        if first:
+            self.release.wait(self.delay)
+        return self.respond(first, **kwargs)
+
+
+def test_slow_request_is_hedged_and_loser_discarded(settings):
+    settings.set_hedge(True)
+    hedger = primed_hedger('GetObject')
+    request = SlowFirstRequest(lambda first, **kwargs: 'slow' if first else 'fast')
+    discarded = []
+    assert hedger.call('GetObject', request, discard=discarded.append, Key='data.csv.gz') == 'fast'
+    request.release.set()
+    hedger.get_executor().shutdown(wait=True)
+    assert discarded == ['slow']
+    assert request.requests == [{'Key': 'data.csv.gz'}, {'Key': 'data.csv.gz'}]
+    assert hedger.stats()['GetObject']['HedgeWins'] == 1
+
+
+def test_duplicates_stay_within_budget(settings):
+    settings.set_hedge(True)
+    settings.set_hedge_budget(0)
+    hedger = primed_hedger('GetObject')
+    request = SlowFirstRequest(lambda first, **kwargs: kwargs['Key'], delay=0.2)
+    for i in range(s3bucketstats.hedge_burst + 3):
+        assert hedger.call('GetObject', request, Key=str(i)) == str(i)
+    hedger.get_executor().shutdown(wait=True)
+    counters = hedger.stats()['GetObject']
+    assert counters['Hedged'] == s3bucketstats.hedge_burst
+    assert counters['OverBudget'] == 3
+
+
+def test_hedged_listing_sends_every_page_token_once(settings, monkeypatch):
+    settings.set_hedge(True)
+    monkeypatch.setattr(s3bucketstats, 'request_hedger', primed_hedger('ListObjectsV2'))
+    tokens = [None, 't1', 't2']
+
+    def respond(first, ContinuationToken=None, **kwargs):
+        page = tokens.index(ContinuationToken)
+        response = {'Contents': [{'Key': "k{}".format(page)}], 'IsTruncated': page < len(tokens) - 1}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = tokens[page + 1]
+        return response
+
+    client = SlowFirstRequest(respond)
+    client.list_objects_v2 = client
+    monkeypatch.setattr(s3bucketstats, 'bucket_client', lambda bucket_name: client)
+    pages = list(list_bucket_pages('bk', ListShard("")))
+    client.release.set()
+    s3bucketstats.request_hedger.get_executor().shutdown(wait=True)
+    assert [page['Contents'][0]['Key'] for page in pages] == ['k0', 'k1', 'k2']
+    # Each page is asked twice, original and duplicate, both with the token of that page.
+    assert [request.get('ContinuationToken') for request in client.requests] == [None, None, 't1', 't1', 't2', 't2']
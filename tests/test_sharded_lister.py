@@ -0,0 +1,35 @@
+from s3bucketstats import ListShard, ShardedLister
+
+# Single character keys are bumped characters themselves, so split bounds fall on existing keys.
+keys = ["a{:04d}".format(index) for index in range(3000)] + [chr(letter) for letter in range(98, 123)]
+
+
+def in_range(key, shard):
+    return key > shard.start_after and (shard.end_before is None or key < shard.end_before)
+
+
+def test_split_ranges_hold_every_key_once(listed_bucket, monkeypatch):
+    listed_bucket(keys)
+    lister = ShardedLister('bk', "", "")
+    submitted = []
+    monkeypatch.setattr(lister, 'submit', submitted.append)
+    shard = ListShard("")
+    lister.split_shard(shard, "a0999", 4)
+    assert submitted and lister.splits == len(submitted)
+    assert any(split.start_after in keys for split in submitted)
+    for key in keys:
+        if key > "a0999":
+            assert len([part for part in [shard] + submitted if in_range(key, part)]) == 1, key
+    # The first shard ends just past its bound, the key equal to it stays with the shard that lists up to it.
+    bound = submitted[0].start_after
+    assert shard.end_before == bound + "\0" and in_range(bound, shard)
+
+
+def test_split_listing_lists_every_key_once(listed_bucket, settings):
+    client = listed_bucket(keys + ["dir{}/{:03d}".format(index % 3, index) for index in range(900)])
+    settings.set_list_workers(4)
+    settings.set_shard_split_pages(1)
+    lister = ShardedLister('bk', "", "")
+    aggregate = lister.run()
+    assert lister.splits > 0
+    assert aggregate.count() == len(client.keys)